@@ -7,12 +7,18 @@
 #****************************************************************************
 
 import os
+import re
+import shutil
+import asyncio
 from subprocess import Popen, PIPE, call
 import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 import atexit
 import sys
-from io import BytesIO
+import itertools
+from io import BytesIO, TextIOWrapper
 
 import numpy as np
 from ase import Atoms
@@ -23,6 +29,17 @@ from .atomic_configs import hundmag
 from .worldstub import world
 from . import subdirs
 from . import utils
+from . import pwparser
+from . import projwfc
+from . import pwsave
+from . import upf
+from . import archive
+from . import scfcheck
+from .resultcache import ResultCache
+from .gridcache import GridCache, statefingerprint
+from .chunkstore import ChunkStore
+from .timing import Timings, timed, registry
+from .sessionpool import Session, SessionPool, sharedpool, inputkey, preamble
 
 try:
     from ase.calculators.calculator import FileIOCalculator as Calculator
@@ -52,11 +69,54 @@ class ConvergenceError(Exception):
 
 
 class KohnShamConvergenceError(ConvergenceError):
-    pass
+    """The SCF cycle did not converge. If it was aborted early
+    (scfabort), diagnosis says why and history holds its iterations
+    (as an entry of espresso.scf_history)."""
+
+    def __init__(self, message='', history=None, diagnosis=None):
+        ConvergenceError.__init__(self, message)
+        self.history = history
+        self.diagnosis = diagnosis
+
+
+# timing phases of the waits for pw.x's output, by the first event
+# kind waited for
+_WAIT_PHASES = {
+    pwparser.TOTAL_ENERGY: 'scf',
+    pwparser.SMEARING: 'scf',
+    pwparser.ASE_FORCES: 'forces',
+    pwparser.FORCES: 'forces',
+}
+
+
+def waitphase(request):
+    return _WAIT_PHASES.get(request[0], 'wait')
 
 pkgpath = os.path.abspath(os.path.dirname(__file__))
 rootpath = os.path.dirname(pkgpath)
 
+# short names of the quantities for espresso.extract_many
+ppx_quantities = {
+    'charge': 'extract_charge_density',
+    'potential': 'extract_total_potential',
+    'ionic_potential': 'extract_local_ionic_potential',
+    'ldos_efermi': 'extract_local_dos_at_efermi',
+    'entropy': 'extract_local_entropy_density',
+    'stm': 'extract_stm_data',
+    'magnetization': 'extract_magnetization_density',
+    'wavefunction': 'extract_wavefunction_density',
+    'elf': 'extract_electron_localization_function',
+    'density_minus_atomic': 'extract_density_minus_atomic',
+    'ildos': 'extract_int_local_dos',
+    'ionic_hartree_potential': 'extract_ionic_and_hartree_potential',
+    'sawtooth': 'extract_sawtooth_potential',
+    'noncollinear_magnetization': 'extract_noncollinear_magnetization',
+    'ae_charge': 'extract_ae_charge_density',
+    'noncollinear_xcmag': 'extract_noncollinear_xcmag',
+    'reduced_density_gradient': 'extract_reduced_density_gradient',
+    'hessian_eig': 'extract_middle_density_hessian_eig'
+}
+
 class espresso(Calculator):
     """ASE interface for Quantum Espresso"""
 
@@ -148,7 +208,16 @@ class espresso(Calculator):
             single_calculator=True,  # if True, only one espresso job will be running
             procrange=None,  # let this espresso calculator run only on a subset of the requested cpus
             numcalcs=None,  # used / set by multiespresso class
+            procs=None,  # explicit list of processes (hosts) to run on (set by scheduler)
             alwayscreatenewarrayforforces=True,
+            drainoutput=True,  # read pw.x's output in a background thread
+            resultcache=None,  # directory (or ResultCache) to reuse results from
+            gridcache=None,  # settings of the cache of pp.x grids
+            archive=None,  # settings of the save_* archives
+            chunkstore=None,  # directory (or ChunkStore) for save_*/load_*
+            sessionpool=None,  # SessionPool (or its size) of idle ase3 pw.x sessions
+            profile=False,  # record the wall time of the phases in self.timings
+            scfabort=None,  # settings (or True) of the early abort of hopeless SCF cycles
             verbose='low',
             # automatically generated list of parameters
             # some coincide with ase-style names
@@ -459,6 +528,64 @@ class espresso(Calculator):
            Parallelization flags for Quantum Espresso.
            E.g. parflags='-npool 2' will distribute k-points (and spin if
            spin-polarized) over two nodes.
+        drainoutput (True)
+           read and log pw.x's output continuously in a background thread,
+           so pw.x never blocks on a full pipe while python is busy
+           (e.g. with an ase optimizer step)
+        resultcache (None)
+           directory of a persistent cache of energies, forces, stress
+           and magnetic moments (or a ResultCache instance). Results of
+           'ase3' and 'scf' calculations are stored under the hash of the
+           input file and pseudopotentials and reused instead of running
+           pw.x again. If None, site.resultcache is used if defined.
+        gridcache (None)
+           dictionary with settings of the cache of grids extracted with
+           pp.x (extract_* methods, get_work_function):
+           'maxsize' (256*1024**2): bytes kept in memory, 0 disables it;
+           'persist' (False): also store the grids as compressed .npz
+           files in localtmp/gridcache.
+           Entries are only reused for unchanged pw.x output (calc.save).
+        archive (None)
+           dictionary with settings of the archives written by the save_*
+           methods: 'codec' ('gz': gzip compressed in parallel blocks,
+           'zst': multi-threaded zstd (needs the zstandard module),
+           'none': plain tar; default: by file name extension, i.e. zst
+           for .tar.zst/.tzst, none for .tar and gz otherwise), 'level'
+           (compression level) and 'threads' (default: all cpus).
+           The load_* methods detect the format of the archive.
+        chunkstore (None)
+           root directory of a deduplicating chunk store (or a ChunkStore
+           instance). If given, the save_* methods store snapshots named
+           by filename there instead of writing archives, and the load_*
+           methods restore such snapshots (falling back to archive files
+           of that name). If None, site.chunkstore is used if defined.
+        sessionpool (None)
+           SessionPool instance, or the number of sessions kept in the
+           pool shared by all calculators of this process. An 'ase3'
+           pw.x stopped by this calculator (e.g. on a change of the cell
+           or composition) is kept running in the pool, and starting
+           pw.x for an input equal to that of a pooled session (apart
+           from the positions) takes the session over instead of
+           starting a new process. Files pw.x writes stay in the scratch
+           directory of the calculator that started it. pw.x is stopped
+           for good when its files are needed (save_*, pp.x, ...).
+        profile (False)
+           record the wall time spent in the phases of the calculations
+           (input generation, scratch setup, pw.x launch, time to its
+           first output, waiting for the SCF and forces, log flushes,
+           stopping pw.x, cleanup) in self.timings, a timing.Timings
+           object, and in the per-process timing.registry. Both can
+           print a summary and export a Chrome trace
+           (write_chrome_trace).
+        scfabort (None)
+           if True (or a dictionary overriding some of the settings in
+           scfcheck.defaults), the trend of the estimated scf accuracy
+           is checked after every SCF iteration (see scfcheck.diagnose).
+           If the cycle is stagnating, sloshing or projected to need
+           more than electron_maxstep iterations, pw.x is asked to
+           stop (through calc.EXIT in its working directory) and a
+           KohnShamConvergenceError carrying the diagnosis and the
+           iterations is raised.
         verbose ('low')
            Can be 'high' or 'low'
         """
@@ -565,6 +692,38 @@ class espresso(Calculator):
         if parflags is not None:
             self.parflags += parflags
         self.single_calculator = single_calculator
+        self.drainoutput = drainoutput
+        self.gridcacheopts = gridcache
+        self.archiveopts = archive
+        self.chunkstore = chunkstore
+        if isinstance(sessionpool, int):
+            sessionpool = sharedpool(sessionpool)
+        self.sessionpool = sessionpool
+        self.timings = Timings(profile, str(outdir), registry)
+        self.pwclocks = []
+        self.scf_history = []
+        self.scf_callbacks = []
+        self.scfaborting = False
+        if scfabort is None or scfabort is False:
+            self.scfabort = None
+        else:
+            self.scfabort = dict(scfcheck.defaults)
+            if scfabort is not True:
+                for key in scfabort:
+                    if key not in scfcheck.defaults:
+                        raise ValueError('unknown scfabort setting %r' % key)
+                self.scfabort.update(scfabort)
+        self.sessionkey = None
+        self.sessionlog = None
+        self.session = None
+        self.ownscratch = None
+        self.pwidle = False
+        self.ppxthread = threading.local()
+        self.pdoscache = None
+        self.bandcache = None
+        self.resultcache = resultcache
+        self.resultsetup = None
+        self.inputready = False
         self.txt = txt
         self.writeversion = False
         self.atoms = None
@@ -572,6 +731,7 @@ class espresso(Calculator):
         self.started = False
         self.got_energy = False
         self.only_init = False
+        self.aproc = None
 
         # automatically generated list
         self.iprint = iprint
@@ -684,6 +844,14 @@ class espresso(Calculator):
         if not nproc or nproc > total_cpus:
             nproc = total_cpus
         self.site = espsite.Config()
+        if self.resultcache is None:
+            self.resultcache = getattr(self.site, 'resultcache', None)
+        if isinstance(self.resultcache, str):
+            self.resultcache = ResultCache(self.resultcache)
+        if self.chunkstore is None:
+            self.chunkstore = getattr(self.site, 'chunkstore', None)
+        if isinstance(self.chunkstore, str):
+            self.chunkstore = ChunkStore(self.chunkstore)
 
         # Variables that cannot be set by inputs
         self.nvalence = None
@@ -696,14 +864,28 @@ class espresso(Calculator):
         self.input_update()
 
         # Initialize lists of cpu subsets if needed
-        if procrange is None:
+        if procs is not None:
+            if len(procs) > 1 and not hasattr(self.site,
+                                              'perSpecProcMpiExec'):
+                raise ValueError(
+                    'running pw.x on a list of %d processes requires a '
+                    'perSpecProcMpiExec command template in espsite.py'
+                    % len(procs))
+            self.proclist = True
+            self.myncpus = len(procs)
+            self.mycpus = self.localtmp + '/myprocs.txt'
+            f = open(self.mycpus, 'w')
+            for p in procs:
+                print(p, file=f)
+            f.close()
+        elif procrange is None or not hasattr(self.site, 'procs'):
             self.proclist = False
         else:
             self.proclist = True
             procs = self.site.procs + []
             procs.sort()
             nprocs = len(procs)
-            self.myncpus = nprocs / numcalcs
+            self.myncpus = nprocs // numcalcs
             i1 = self.myncpus * procrange
             self.mycpus = self.localtmp + '/myprocs%04d.txt' % procrange
             f = open(self.mycpus, 'w')
@@ -771,32 +953,32 @@ class espresso(Calculator):
 
     def create_outdir(self):
         if self.onlycreatepwinp is None:
-            self.localtmp = subdirs.mklocaltmp(self.outdir, self.site)
+            with self.timings.phase('scratch setup'):
+                self.localtmp = subdirs.mklocaltmp(self.outdir, self.site)
             if not self.txt:
                 self.log = self.localtmp + '/log'
             elif self.txt[0] != '/':
                 self.log = self.sdir+'/'+self.txt
             else:
                 self.log = self.txt
-            self.scratch = subdirs.mkscratch(self.localtmp, self.site)
-            if self.output is not None:
-                if 'removewf' in self.output:
-                    removewf = self.output['removewf']
-                else:
-                    removewf = True
-                if 'removesave' in self.output:
-                    removesave = self.output['removesave']
+            self.logindex = pwparser.LogIndex(self.log)
+            opts = {'maxsize': 256 * 1024**2, 'persist': False}
+            if self.gridcacheopts is not None:
+                opts.update(self.gridcacheopts)
+            if opts['maxsize'] > 0:
+                if opts['persist']:
+                    cachedir = self.localtmp + '/gridcache'
                 else:
-                    removesave = False
+                    cachedir = None
+                self.gridcache = GridCache(opts['maxsize'], cachedir)
             else:
-                removewf = True
-                removesave = False
-            atexit.register(subdirs.cleanup, self.localtmp, self.scratch,
-                            removewf, removesave, self, self.site)
+                self.gridcache = None
+            self.scratch = self.newscratch()
             self.cancalc = True
         else:
             self.pwinp = self.onlycreatepwinp
             self.localtmp = ''
+            self.gridcache = None
             self.cancalc = False
 
     def set(self, **kwargs):
@@ -844,6 +1026,7 @@ class espresso(Calculator):
         self.input_update()
         self.recalculate = True
         self.results = {}
+        self.resultsetup = None
 
     def __del__(self):
         try:
@@ -851,6 +1034,7 @@ class espresso(Calculator):
         except BaseException:
             pass
 
+    @timed('atoms2species')
     def atoms2species(self):
         """Define several properties of the quantum espresso species
         from the ase atoms object. Takes into account that different
@@ -939,21 +1123,21 @@ class espresso(Calculator):
                 J=Jlist[i],
                 U_alpha=U_alphalist[i])
 
-    def get_nvalence(self):
-        nel = {}
+    def get_upf_headers(self):
+        """Dictionary of the (cached) UPF headers of the pseudopotentials
+        or PAW setups in use, keyed by element."""
+        headers = {}
         for x in self.species:
             el = self.specdict[x].s
-            # get number of valence electrons from pseudopotential or paw setup
-            p = Popen(
-                'egrep -i \'z\ valence|z_valence\' ' + self.psppath +
-                '/' + el + '.UPF | tr \'"\' \' \'',
-                shell=True, stdout=PIPE).stdout
-            out = p.readline().decode('utf-8')
-            for y in out.split():
-                if y[0].isdigit() or y[0] == '.':
-                    nel[el] = int(round(float(y)))
-                    break
-            p.close()
+            if el not in headers:
+                headers[el] = upf.header(self.psppath + '/' + el + '.UPF')
+        return headers
+
+    def get_nvalence(self):
+        # get number of valence electrons from pseudopotential or paw setup
+        nel = {}
+        for el, h in self.get_upf_headers().items():
+            nel[el] = int(round(h.z_valence))
         nvalence = np.zeros(len(self.specprops), dtype=int)
         for i, x in enumerate(self.specprops):
             nvalence[i] = nel[self.specdict[x[0]].s]
@@ -1021,6 +1205,7 @@ class espresso(Calculator):
                     f.write('/\n')
         f.close()
 
+    @timed('writeinputfile')
     def writeinputfile(self,
                        filename='pw.inp',
                        mode=None,
@@ -1801,18 +1986,18 @@ class espresso(Calculator):
             self.atoms = atoms.copy()
         else:
             if len(atoms) != len(self.atoms):
-                self.stop()
+                self.stop(park=True)
                 self.nvalence = None
                 self.nel = None
                 self.recalculate = True
 
             x = atoms.cell - self.atoms.cell
             if np.max(x) > 1E-13 or np.min(x) < -1E-13:
-                self.stop()
+                self.stop(park=True)
                 self.recalculate = True
             if (atoms.get_atomic_numbers() !=
                     self.atoms.get_atomic_numbers()).any():
-                self.stop()
+                self.stop(park=True)
                 self.nvalence = None
                 self.nel = None
                 self.recalculate = True
@@ -1822,9 +2007,9 @@ class espresso(Calculator):
                 self.recalculate = True
         self.atoms = atoms.copy()
 
-    def update(self, atoms):
-        if self.atoms is None:
-            self.set_atoms(atoms)
+    def check_update(self, atoms):
+        """Returns whether atoms requires a new calculation and
+        whether a running pw.x has to be stopped for it."""
         x = atoms.cell - self.atoms.cell
         morethanposchange = np.max(x) > 1E-13 \
             or np.min(x) < -1E-13 \
@@ -1838,18 +2023,117 @@ class espresso(Calculator):
         or morethanposchange \
         or (not self.started and not self.got_energy) \
         or self.recalculate:
+            restart = self.ion_dynamics != 'ase3' \
+                or self.calculation in ('scf','nscf') \
+                or morethanposchange
+            return True, restart
+        return False, False
+
+    def update(self, atoms):
+        if self.atoms is None:
+            self.set_atoms(atoms)
+        recalc, restart = self.check_update(atoms)
+        if recalc:
             self.recalculate = True
             self.results = {}
-            if self.ion_dynamics != 'ase3' \
-            or self.calculation in ('scf','nscf') \
-            or morethanposchange:
-                self.stop()
-            self.read(atoms)
+            key, cached = self.lookup_results(atoms, restart)
+            if restart:
+                self.stop(park=True)
+            if not cached:
+                self.read(atoms)
+                self.store_results(key)
         elif self.only_init:
             self.read(atoms)
         else:
             self.atoms = atoms.copy()
 
+    async def aupdate(self, atoms):
+        """Coroutine version of update, driving pw.x through asyncio."""
+        if self.atoms is None:
+            self.set_atoms(atoms)
+        recalc, restart = self.check_update(atoms)
+        if recalc:
+            self.recalculate = True
+            self.results = {}
+            key, cached = self.lookup_results(atoms, restart)
+            if restart:
+                await self.astop(park=True)
+            if not cached:
+                await self.aread(atoms)
+                self.store_results(key)
+        elif self.only_init:
+            await self.aread(atoms)
+        else:
+            self.atoms = atoms.copy()
+
+    def upffiles(self):
+        """List the pseudopotential files of the species in use."""
+        files = []
+        for x in self.species:
+            f = self.psppath + '/' + self.specdict[x].s + '.UPF'
+            if f not in files:
+                files.append(f)
+        return files
+
+    def lookup_results(self, atoms, restart=True):
+        """Look up the results for atoms in the result cache.
+        Returns the cache key (None if caching does not apply) and
+        whether the results were found (and set). While pw.x runs and
+        only the positions change (not restart), the key of its setup
+        is reused; otherwise the input file is written here (and not
+        again by initialize)."""
+        if (self.resultcache is None or not self.cancalc or
+                self.only_init or self.calculation not in ('ase3', 'scf')):
+            return None, False
+        if restart or not self.started or self.resultsetup is None:
+            self.createinput(atoms)
+            self.inputready = True
+            self.resultsetup = self.resultcache.setupkey(
+                self.localtmp + '/pw.inp', self.upffiles())
+        key = self.resultcache.key(self.resultsetup, atoms)
+        r = self.resultcache.get(key)
+        if r is None:
+            return key, False
+        self.inputready = False
+        self.energy_zero = r['energy']
+        self.energy_free = r['free_energy']
+        self.ST = 2.0 * (self.energy_zero - self.energy_free)
+        self.forces = r['forces']
+        self.results['energy'] = self.energy_zero
+        self.results['free_energy'] = self.energy_free
+        self.results['forces'] = self.forces
+        if r['magmoms'] is not None:
+            self.results['magmoms'] = r['magmoms']
+            self.results['magmom'] = np.sum(r['magmoms'])
+        if r['stress'] is not None:
+            self.results['stress'] = r['stress']
+        self.atom_occ = r['atom_occ']
+        self.atoms = atoms.copy()
+        self.got_energy = True
+        self.recalculate = False
+        return key, True
+
+    def store_results(self, key):
+        """Store the results of the calculation just read under key."""
+        if key is None or self.recalculate:
+            return
+        stress = None
+        if self.calcstress:
+            stress = self.logstress()
+        self.resultcache.put(key, self.natoms, self.energy_zero,
+                             self.energy_free, self.forces, stress,
+                             self.results.get('magmoms'), self.atom_occ)
+
+    def logstress(self):
+        """Stress (in Voigt notation and ASE's sign convention) of the
+        step just read, if pw.x has written it to the log already."""
+        stress = self.indexlog().stress
+        if stress is None or stress[0] < self.parser.logoffset:
+            return None
+        s = -stress[1] * Rydberg / Bohr**3
+        return np.array([s[0, 0], s[1, 1], s[2, 2], s[1, 2], s[0, 2],
+                         s[0, 1]])
+
     def calculate(self, atoms=None, properties=['energy'],
                   system_changes=None):
         """
@@ -1883,31 +2167,38 @@ class espresso(Calculator):
             elif self.recalculate:
                 self.only_init = True
                 if self.ion_dynamics == 'ase3':
-                    p = atoms.positions
-                    self.atoms = atoms.copy()
-                    self.cinp.write(b'G')
-                    for x in p:
-                        self.cinp.write(
-                            ('%.15e %.15e %.15e' % (x[0], x[1], x[2])
-                            ).replace('e', 'd').encode()
-                        )
+                    self.send_positions(atoms)
                 self.cinp.flush()
 
-    def read(self, atoms):
+    def send_positions(self, atoms):
+        """Pass new atomic positions to a running ase3-mode pw.x."""
+        p = atoms.positions
+        self.atoms = atoms.copy()
+        self.pwidle = False
+        self.parser.new_step()
+        self.cinp.write(b'G')
+        for x in p:
+            self.cinp.write(
+                ('%.15e %.15e %.15e' % (x[0], x[1], x[2])
+                ).replace('e', 'd').encode()
+            )
+
+    def writeversioninfo(self):
         if self.writeversion:
             self.writeversion = False
             with open(self.log, 'a') as s:
                 s.write('  python dir          : ' + pkgpath + '\n')
                 if len(self.exedir) == 0:
-                    stdout = Popen(
-                        'which pw.x', shell=True, stdout=PIPE).stdout
-                    exedir = os.path.dirname(stdout.readline().decode('utf-8'))
+                    exedir = os.path.dirname(shutil.which('pw.x') or '')
                 else:
                     exedir = self.exedir
                 s.write('  espresso dir        : ' + str(exedir) + '\n')
                 s.write('  pseudo dir          : ' + self.psppath + '\n')
                 s.write('  ase-espresso py git : ' + gitver + '\n\n\n')
 
+    def read(self, atoms):
+        self.writeversioninfo()
+
         if not self.started and not self.only_init:
             fresh = True
             self.initialize(atoms)
@@ -1916,261 +2207,334 @@ class espresso(Calculator):
         if self.recalculate:
             if not fresh and not self.only_init:
                 if self.ion_dynamics == 'ase3':
-                    p = atoms.positions
-                    self.atoms = atoms.copy()
-                    self.cinp.write(b'G')
-                    for x in p:
-                        self.cinp.write(
-                            ('%.15e %.15e %.15e' % (x[0], x[1], x[2])
-                            ).replace('e', 'd').encode()
-                        )
+                    self.send_positions(atoms)
                 self.cinp.flush()
             self.only_init = False
-            s = open(self.log, 'a')
-            a = self.cout.readline().decode('utf-8')
-            s.write(a)
-            atom_occ = {}
-            magmoms = np.zeros(len(atoms))
-            while (a != '' and
-                   a[:17] != '!    total energy' and
-                   a[:13] != '     stopping' and
-                   a[:20] != '     convergence NOT'):
-                a = self.cout.readline().decode('utf-8')
-                s.write(a)
-                s.flush()
-
-                if a[:19] == '     iteration #  1':
-                    while (a != '' and a[:17] != '!    total energy'
-                           and a[:13] != '     stopping'
-                           and a[:20] != '     convergence NOT'
-                           and a[:22] != ' --- exit write_ns ---'):
-                        a = self.cout.readline().decode('utf-8')
-                        s.write(a)
-                        s.flush()
-                        if a[:5] == 'atom ':
-                            atomnum = int(a[8:10])
-                            # 'atom    1   Tr[ns(na)] =   1.00000'
-                            if a[12:25] == 'Tr[ns(na)] = ':
-                                N0 = float(a[27:35]) / 2.
-                            elif a[12:42] == 'Tr[ns(na)] (up, down, total) =':
-                                N0 = [
-                                    float(a[42:52]),
-                                    float(a[53:62]),
-                                    float(a[63:71])
-                                ]
-                                N0 = N0[-1]  # only taking the total occupation
-                            atom_occ[atomnum - 1] = {}
-                            atom_occ[atomnum - 1][0] = N0
-                if a[:39] == '     End of self-consistent calculation':
-                    while (a != '' and
-                           a[:17] != '!    total energy' and
-                           a[:13] != '     stopping' and
-                           a[:20] != '     convergence NOT'):
-                        a = self.cout.readline().decode('utf-8')
-                        s.write(a)
-                        s.flush()
-                        if a[:5] == 'atom ':
-                            atomnum = int(a[8:10])
-                            if a[12:25] == 'Tr[ns(na)] = ':
-                                Nks = float(a[27:35]) / 2.
-                            elif a[12:42] == 'Tr[ns(na)] (up, down, total) =':
-                                Nks = [
-                                    float(a[42:52]),
-                                    float(a[53:62]),
-                                    float(a[63:71])
-                                ]
-                                # only taking the total occupation
-                                Nks = Nks[-1]
-                                magmom = Nks[0] - Nks[1]
-                                magmoms[atomnum] = magmom
-                            atom_occ[atomnum - 1]['ks'] = Nks
-                    break
-            if a[:20] == '     convergence NOT':
-                self.stop()
-                raise KohnShamConvergenceError(
-                    'scf cycles did not converge\nincrease maximum '
-                    'number of steps and/or decreasing mixing'
-                )
-            elif a[:13] == '     stopping':
-                self.stop()
-                self.checkerror()
-                # if checkerror shouldn't find an error here,
-                # throw this generic error
-                raise RuntimeError('SCF calculation failed')
-            elif a == '' and self.calculation in ('ase3', 'relax', 'scf',
-                                               'vc-relax', 'vc-md', 'md'):
-                self.checkerror()
-                # if checkerror shouldn't find an error here,
-                # throw this generic error
-                raise RuntimeError('SCF calculation failed')
-            self.atom_occ = atom_occ
-            self.results['magmoms'] = magmoms
-            self.results['magmom'] = np.sum(magmoms)
-            if self.calculation in ('ase3', 'relax', 'scf', 'vc-relax',
-                                    'vc-md', 'md', 'hund'):
-                self.energy_free = float(a.split()[-2]) * Rydberg
-                # get S*T correction (there is none for Marzari-Vanderbilt=Cold
-                # smearing)
-                if (self.occupations == 'smearing' and
-                    self.calculation != 'hund' and
-                    self.smearing[0].upper() != 'M' and
-                    self.smearing[0].upper() != 'C' and
-                    not self.optdamp):
-                    a = self.cout.readline().decode('utf-8')
-                    s.write(a)
-                    exx = False
-                    while a[:13] != '     smearing':
-                        a = self.cout.readline().decode('utf-8')
-                        s.write(a)
-                        if a.find('EXX') > -1:
-                            exx = True
-                            break
-                    if exx:
-                        self.ST = 0.0
-                        self.energy_zero = self.energy_free
-                    else:
-                        self.ST = -float(a.split()[-2]) * Rydberg
-                        self.energy_zero = self.energy_free + 0.5 * self.ST
-                else:
-                    self.ST = 0.0
-                    self.energy_zero = self.energy_free
-            else:
-                self.energy_free = None
-                self.energy_zero = None
-
-            self.got_energy = True
-            self.results['energy'] = self.energy_zero
-            self.results['free_energy'] = self.energy_free
-
-            a = self.cout.readline().decode('utf-8')
-            s.write(a)
-            s.flush()
-
-            if self.calculation in ('ase3', 'relax', 'scf', 'vc-relax',
-                                    'vc-md', 'md'):
-                if self.ion_dynamics == 'ase3' and self.calculation != 'scf':
-                    sys.stdout.flush()
-                    while a[:5] != ' !ASE':
-                        a = self.cout.readline().decode('utf-8')
-                        s.write(a)
-                        s.flush()
-                    self.forces = np.empty((self.natoms, 3), dtype=float)
-                    for i in range(self.natoms):
-                        self.cout.readline().decode('utf-8')
-                    for i in range(self.natoms):
-                        self.forces[i][:] = [
-                            float(x) for x in
-                            self.cout.readline().decode('utf-8').split()]
-                    self.forces *= (Rydberg / Bohr)
-                else:
-                    a = self.cout.readline().decode('utf-8')
-                    s.write(a)
-                    if not self.dontcalcforces:
-                        while a[:11] != '     Forces':
-                            a = self.cout.readline().decode('utf-8')
-                            s.write(a)
-                            s.flush()
-                        a = self.cout.readline().decode('utf-8')
-                        s.write(a)
-                        self.forces = np.empty((self.natoms, 3), dtype=float)
-                        for i in range(self.natoms):
-                            a = self.cout.readline().decode('utf-8')
-                            while a.find('force') < 0:
-                                s.write(a)
-                                a = self.cout.readline().decode('utf-8')
-                            s.write(a)
-                            forceinp = a.split()
-                            self.forces[i][:] = [
-                                float(x) for x in forceinp[len(forceinp) - 3:]
-                            ]
-                        self.forces *= (Rydberg / Bohr)
+            events = self.readevents()
+            try:
+                request = next(events)
+                while True:
+                    if request is None:
+                        self.stop()
+                        request = events.send(None)
                     else:
-                        self.forces = None
-            else:
-                self.forces = None
-            self.recalculate = False
-
-            # flush the rest of cout into the log file
-            s.write(self.cout.read().decode('utf-8'))
-            s.close()
+                        with self.timings.phase(waitphase(request)):
+                            ev = self.parser.wait_for(
+                                *request, skipped=self.scfevent)
+                        request = events.send(ev)
+            except StopIteration:
+                pass
+            except KohnShamConvergenceError as e:
+                if e.diagnosis is not None:
+                    self.writeexitfile()
+                    try:
+                        self.stop()
+                    finally:
+                        self.removeexitfile()
+                        self.scfaborting = False
+                raise
+            self.timefirstoutput()
+            # an ase3-mode pw.x now waits for new positions
+            self.pwidle = self.started and self.ion_dynamics == 'ase3'
 
-            self.results['forces'] = self.forces
-            if self.ion_dynamics != 'ase3':
-                self.stop()
+    async def aread(self, atoms):
+        """Coroutine version of read, driving pw.x through asyncio."""
+        self.writeversioninfo()
 
-            # get final energy and forces for internal QE relaxation run
-            if self.calculation in ('relax', 'vc-relax', 'vc-md', 'md'):
+        if not self.started and not self.only_init:
+            fresh = True
+            await self.ainitialize(atoms)
+        else:
+            fresh = False
+        if self.recalculate:
+            if not fresh and not self.only_init:
                 if self.ion_dynamics == 'ase3':
-                    self.stop()
-                p = Popen(
-                    'grep -a -n "!    total" ' + self.log + ' | tail -1',
-                    shell=True, stdout=PIPE).stdout
-                n = int(p.readline().decode('utf-8').split(':')[0]) - 1
-                f = open(self.log, 'r')
-                for i in range(n):
-                    f.readline()
-                self.energy_free = float(f.readline().split()[-2]) * Rydberg
-                # get S*T correction (there is none for Marzari-Vanderbilt=Cold
-                # smearing)
-                if (self.occupations == 'smearing' and
-                    self.calculation != 'hund' and
-                    self.smearing[0].upper() != 'M' and
-                    self.smearing[0].upper() != 'C' and
-                    not self.optdamp):
-                    a = f.readline()
-                    exx = False
-                    while a[:13] != '     smearing':
-                        a = f.readline()
-                        if a.find('EXX') > -1:
-                            exx = True
-                            break
-                    if exx:
-                        self.ST = 0.0
-                        self.energy_zero = self.energy_free
+                    self.send_positions(atoms)
+                await self.cinp.drain()
+            self.only_init = False
+            events = self.readevents()
+            try:
+                request = next(events)
+                while True:
+                    if request is None:
+                        await self.astop()
+                        request = events.send(None)
                     else:
-                        self.ST = -float(a.split()[-2]) * Rydberg
-                        self.energy_zero = self.energy_free + 0.5 * self.ST
-                else:
+                        with self.timings.phase(waitphase(request)):
+                            ev = await self.parser.await_for(
+                                *request, skipped=self.scfevent)
+                        request = events.send(ev)
+            except StopIteration:
+                pass
+            except KohnShamConvergenceError as e:
+                if e.diagnosis is not None:
+                    self.writeexitfile()
+                    try:
+                        await self.astop()
+                    finally:
+                        self.removeexitfile()
+                        self.scfaborting = False
+                raise
+            self.timefirstoutput()
+            # an ase3-mode pw.x now waits for new positions
+            self.pwidle = self.started and self.ion_dynamics == 'ase3'
+
+    def add_scf_callback(self, function):
+        """Call function(calc, iteration, energy, accuracy, seconds)
+        after each SCF iteration, with the total energy and estimated
+        accuracy in eV and the time since the start of the ionic step.
+        It is called by the thread waiting for pw.x's results."""
+        self.scf_callbacks.append(function)
+
+    def remove_scf_callback(self, function):
+        self.scf_callbacks.remove(function)
+
+    def scfevent(self, ev):
+        """Handle an event skipped while waiting for (or draining) the
+        results of pw.x: record the SCF cycles of pw.x's own ionic steps
+        and report SCF iterations."""
+        if self.scfaborting:
+            # pw.x is being stopped after an early abort
+            return
+        if ev.kind in (pwparser.TOTAL_ENERGY, pwparser.NOT_CONVERGED):
+            self.recordscf(ev.scf)
+            return
+        if ev.kind != pwparser.SCF_STEP:
+            return
+        if self.scf_callbacks:
+            n, e, acc, t = ev.value
+            e = np.nan if e is None else e * Rydberg
+            for function in self.scf_callbacks:
+                function(self, n, e, acc * Rydberg, t)
+        if self.scfabort is not None:
+            self.checkscf()
+
+    def checkscf(self):
+        """Raise a KohnShamConvergenceError if the SCF cycle so far is
+        not expected to converge in time (see scfabort)."""
+        with self.parser.cond:
+            accuracy = [x[2] for x in self.parser.scf if x[2] is not None]
+        maxsteps = self.electron_maxstep
+        if maxsteps is None:
+            maxsteps = (self.convergence or {}).get('maxsteps', 100)
+        diagnosis = scfcheck.diagnose(accuracy, self.conv_thr, maxsteps,
+                                      **self.scfabort)
+        if diagnosis is not None:
+            self.recordscf()
+            self.scfaborting = True
+            raise KohnShamConvergenceError(
+                'scf cycle aborted early: ' + diagnosis,
+                self.scf_history[-1], diagnosis)
+
+    def writeexitfile(self):
+        """Ask the running pw.x to stop at its next check by creating
+        calc.EXIT in its working directory."""
+        exitfile = self.localtmp + '/calc.EXIT'
+        open(exitfile, 'w').close()
+        subdirs.copy(exitfile, self.scratch, self.site)
+
+    def removeexitfile(self):
+        subdirs.remove(self.localtmp + '/calc.EXIT')
+        pernode = subdirs.pernodeexec(self.site)
+        if pernode is None:
+            subdirs.remove(self.scratch + '/calc.EXIT')
+        else:
+            call(pernode + ' rm -f ' + self.scratch + '/calc.EXIT',
+                 shell=True, cwd=self.localtmp)
+
+    def recordscf(self, scf=None):
+        """Append the SCF iterations scf of an ionic step (by default
+        those parsed so far) to self.scf_history, as a dictionary of
+        arrays: 'iteration', 'energy' and 'accuracy' (estimated, both
+        in eV) and 'time' (seconds since the start of the step)."""
+        if scf is None:
+            with self.parser.cond:
+                scf = list(self.parser.scf)
+        scf = [[np.nan if v is None else v for v in x] for x in scf]
+        a = np.array(scf, dtype=float).reshape(-1, 4)
+        self.scf_history.append({'iteration': a[:, 0].astype(int),
+                                 'energy': a[:, 1] * Rydberg,
+                                 'accuracy': a[:, 2] * Rydberg,
+                                 'time': a[:, 3]})
+
+    def collectclocks(self):
+        """Keep the clock report of the pw.x session just stopped."""
+        if self.parser.clocks:
+            self.pwclocks.append(self.parser.clocks)
+            self.publishclocks()
+
+    def publishclocks(self):
+        """Store the clock reports of pw.x in self.results:
+        'pw_clocks' is the list of reports of the sessions of this
+        calculator (the last report of each session, whose clocks are
+        cumulative over its ionic steps) and 'pw_clocks_total' their
+        sum. Each maps the routines to their 'cpu' and 'wall' time in
+        seconds, number of 'calls' and 'caller'."""
+        if not self.pwclocks:
+            return
+        total = {}
+        for clocks in self.pwclocks:
+            for name, c in clocks.items():
+                t = total.setdefault(name, {'cpu': 0., 'wall': 0., 'calls': 0,
+                                            'caller': c['caller']})
+                t['cpu'] += c['cpu']
+                t['wall'] += c['wall']
+                t['calls'] += c['calls']
+        self.results['pw_clocks'] = list(self.pwclocks)
+        self.results['pw_clocks_total'] = total
+
+    def timefirstoutput(self):
+        """Record the time pw.x took to respond in this step."""
+        if self.timings.enabled and self.parser.firstoutput is not None:
+            self.timings.add('first output', self.parser.stepstart,
+                             self.parser.firstoutput)
+
+    def readevents(self):
+        """Generator interpreting the output of a pw.x calculation.
+        It yields the tuple of event kinds it needs next and expects to
+        be sent the matching event, or it yields None, asking for pw.x
+        to be stopped. Driven by read and aread."""
+        parser = self.parser
+        ev = yield (pwparser.TOTAL_ENERGY,
+                    pwparser.STOPPING,
+                    pwparser.NOT_CONVERGED)
+        self.recordscf(ev.scf)
+        if ev.kind == pwparser.NOT_CONVERGED:
+            yield None
+            raise KohnShamConvergenceError(
+                'scf cycles did not converge\nincrease maximum '
+                'number of steps and/or decreasing mixing'
+            )
+        elif ev.kind == pwparser.STOPPING:
+            yield None
+            self.checkerror()
+            # if checkerror shouldn't find an error here,
+            # throw this generic error
+            raise RuntimeError('SCF calculation failed')
+        elif ev.kind == pwparser.EOF and self.calculation in (
+                'ase3', 'relax', 'scf', 'vc-relax', 'vc-md', 'md'):
+            parser.flush()
+            self.checkerror()
+            # if checkerror shouldn't find an error here,
+            # throw this generic error
+            raise RuntimeError('SCF calculation failed')
+        self.atom_occ = parser.atom_occ
+        magmoms = parser.magmoms.copy()
+        self.results['magmoms'] = magmoms
+        self.results['magmom'] = np.sum(magmoms)
+        if self.calculation in ('ase3', 'relax', 'scf', 'vc-relax',
+                                'vc-md', 'md', 'hund'):
+            self.energy_free = ev.value * Rydberg
+            # get S*T correction (there is none for Marzari-Vanderbilt=Cold
+            # smearing)
+            if (self.occupations == 'smearing' and
+                self.calculation != 'hund' and
+                self.smearing[0].upper() != 'M' and
+                self.smearing[0].upper() != 'C' and
+                not self.optdamp):
+                ev = yield (pwparser.SMEARING, pwparser.EXX)
+                if ev.kind != pwparser.SMEARING:
                     self.ST = 0.0
                     self.energy_zero = self.energy_free
+                else:
+                    self.ST = -ev.value * Rydberg
+                    self.energy_zero = self.energy_free + 0.5 * self.ST
+            else:
+                self.ST = 0.0
+                self.energy_zero = self.energy_free
+        else:
+            self.energy_free = None
+            self.energy_zero = None
+
+        self.got_energy = True
+        self.results['energy'] = self.energy_zero
+        self.results['free_energy'] = self.energy_free
+
+        if self.calculation in ('ase3', 'relax', 'scf', 'vc-relax',
+                                'vc-md', 'md'):
+            if self.ion_dynamics == 'ase3' and self.calculation != 'scf':
+                sys.stdout.flush()
+                ev = yield (pwparser.ASE_FORCES,)
+            elif not self.dontcalcforces:
+                ev = yield (pwparser.FORCES,)
+            else:
+                ev = None
+            if ev is None:
+                self.forces = None
+            elif ev.kind == pwparser.EOF:
+                parser.flush()
+                self.checkerror()
+                raise RuntimeError('SCF calculation failed')
+            else:
+                self.forces = ev.value * (Rydberg / Bohr)
+        else:
+            self.forces = None
+        self.recalculate = False
+        with self.timings.phase('log flush'):
+            parser.flush()
+
+        self.results['forces'] = self.forces
+        self.publishclocks()
+        if self.ion_dynamics != 'ase3':
+            yield None
+
+        # get final energy and forces for internal QE relaxation run
+        if self.calculation in ('relax', 'vc-relax', 'vc-md', 'md'):
+            if self.ion_dynamics == 'ase3':
+                yield None
+            # stopping has streamed the remaining output through the parser,
+            # which now holds the values of the last ionic step
+            self.energy_free = parser.energy * Rydberg
+            # get S*T correction (there is none for Marzari-Vanderbilt=Cold
+            # smearing)
+            if (self.occupations == 'smearing' and
+                self.calculation != 'hund' and
+                self.smearing[0].upper() != 'M' and
+                self.smearing[0].upper() != 'C' and
+                not self.optdamp and
+                not parser.exx and
+                parser.smearing is not None):
+                self.ST = -parser.smearing * Rydberg
+                self.energy_zero = self.energy_free + 0.5 * self.ST
+            else:
+                self.ST = 0.0
+                self.energy_zero = self.energy_free
 
-                if (self.U_projection_type == 'atomic' and not
-                    self.dontcalcforces):
-                    a = f.readline()
-                    while a[:11] != '     Forces':
-                        a = f.readline()
-                    f.readline()
-                    self.forces = np.empty((self.natoms, 3), dtype=float)
-                    for i in range(self.natoms):
-                        a = f.readline()
-                        while a.find('force') < 0:
-                            a = f.readline()
-                        forceinp = a.split()
-                        self.forces[i][:] = [
-                            float(x) for x in forceinp[len(forceinp) - 3:]
-                        ]
-                    self.forces *= (Rydberg / Bohr)
-                f.close()
+            if (self.U_projection_type == 'atomic' and not
+                self.dontcalcforces):
+                self.forces = parser.forces * (Rydberg / Bohr)
 
-            self.checkerror()
+        self.checkerror()
 
     def initialize(self, atoms):
         """Create the pw.inp input file and start the calculation.
         If onlycreatepwinp is specified in calculator setup,
         only the input file will be written for manual submission.
         """
-        if not self.started:
-            self.atoms = atoms.copy()
-
-            self.atoms2species()
-            self.natoms = len(self.atoms)
-            self.check_spinpol()
-            if self.use_environ:
-                self.writeenvinputfile()
-            self.writeinputfile()
+        if not self.started and not self.inputready:
+            self.createinput(atoms)
+        self.inputready = False
         if self.cancalc:
             self.start()
 
+    async def ainitialize(self, atoms):
+        """Coroutine version of initialize, starting pw.x through asyncio."""
+        if not self.started and not self.inputready:
+            self.createinput(atoms)
+        self.inputready = False
+        if self.cancalc:
+            await self.astart()
+
+    def createinput(self, atoms):
+        self.atoms = atoms.copy()
+
+        self.atoms2species()
+        self.natoms = len(self.atoms)
+        self.check_spinpol()
+        if self.use_environ:
+            self.writeenvinputfile()
+        self.writeinputfile()
+
     def check_spinpol(self):
         mm = self.atoms.get_initial_magnetic_moments()
         sp = mm.any()
@@ -2193,34 +2557,54 @@ class espresso(Calculator):
         if abs(self.sigma) <= self.sigma_small:
             self.occupations = 'fixed'
 
+    def writehundinputfile(self):
+        """Write pw2.inp for the second step of a 'hund' calculation:
+        pw.inp with fixed occupations, restarting from the wave functions
+        and potential of the first step."""
+        subs = [
+            ('occupations.*', "occupations='fixed',"),
+            ('ELECTRONS',
+             "ELECTRONS\n  startingwfc='file',\n  startingpot='file',"),
+            ('conv_thr.*', 'conv_thr=' + utils.num2str(self.conv_thr) + ','),
+            ('tot_magnetization.*',
+             'tot_magnetization=' + utils.num2str(self.totmag) + ',')
+        ]
+        with open(self.localtmp + '/pw.inp') as f:
+            lines = f.readlines()
+        with open(self.localtmp + '/pw2.inp', 'w') as f:
+            for line in lines:
+                for pattern, new in subs:
+                    line = re.sub(pattern, lambda m: new, line, count=1)
+                f.write(line)
+
+    @timed('start')
     def start(self):
         if not self.started:
             if self.single_calculator:
                 while len(espresso_calculators) > 0:
-                    espresso_calculators.pop().stop()
+                    espresso_calculators.pop().stop(park=True)
                 espresso_calculators.append(self)
+            if self.borrowsession():
+                return
             if self.site.batch:
                 cdir = os.getcwd()
                 os.chdir(self.localtmp)
-                call(self.site.perHostMpiExec + ' cp ' + self.localtmp +
-                     '/pw.inp ' + self.scratch, shell=True)
+                subdirs.copy(self.localtmp + '/pw.inp', self.scratch,
+                             self.site)
                 if self.use_environ:
-                    call(self.site.perHostMpiExec + ' cp ' + self.localtmp +
-                         '/environ.in ' + self.scratch, shell=True)
+                    subdirs.copy(self.localtmp + '/environ.in', self.scratch,
+                                 self.site)
 
                 if self.calculation != 'hund' and self.calculation != 'cp':
-                    #if not self.proclist:
-                    self.cinp, self.cout = self.site.do_perProcMpiExec(
-                        self.scratch, self.exedir + 'pw.x ' +
-                        self.parflags + ' -in pw.inp')
-                    #else:
-                    #    (self.cinp,
-                    #     self.cout,
-                    #     self.cerr) = self.site.do_perSpecProcMpiExec(
-                    #        self.mycpus, self.myncpus, self.scratch,
-                    #        self.exedir + 'pw.x ' + self.parflags +
-                    #        ' -in pw.inp|' + self.mypath + '/espfilter ' + str(
-                    #            self.natoms) + ' ' + self.log + '0')
+                    program = (self.exedir + 'pw.x ' + self.parflags +
+                               ' -in pw.inp')
+                    if self.useprocsubset():
+                        p = Popen(self.mpicommand(program), shell=True,
+                                  stdin=PIPE, stdout=PIPE)
+                        self.cinp, self.cout = (p.stdin, p.stdout)
+                    else:
+                        self.cinp, self.cout = self.site.do_perProcMpiExec(
+                            self.scratch, program)
                 elif self.calculation == 'cp':
                     self.cinp, self.cout = self.site.do_perProcMpiExec(
                     self.scratch, self.exedir + 'cp.x ' +
@@ -2229,30 +2613,20 @@ class espresso(Calculator):
                     self.site.runonly_perProcMpiExec(
                         self.scratch, self.exedir + 'pw.x ' + self.serflags +
                         ' -in pw.inp >>' + self.log)
-                    call(
-                        "sed s/occupations.*/occupations=\\'fixed\\',/ <" +
-                        self.localtmp +
-                        "/pw.inp | sed s/ELECTRONS/ELECTRONS\\\\n\ \ startingwfc=\\'file\\',\\\\n\ \ startingpot=\\'file\\',/ | sed s/conv_thr.*/conv_thr="
-                        + utils.num2str(self.conv_thr) +
-                        ",/ | sed s/tot_magnetization.*/tot_magnetization=" +
-                        utils.num2str(
-                            self.totmag) + ",/ >" + self.localtmp + "/pw2.inp",
-                        shell=True)
-                    call(self.site.perHostMpiExec + ' cp ' + self.localtmp +
-                         '/pw2.inp ' + self.scratch, shell=True)
+                    self.writehundinputfile()
+                    subdirs.copy(self.localtmp + '/pw2.inp', self.scratch,
+                                 self.site)
                     if self.use_environ:
-                        call(self.site.perHostMpiExec + ' cp ' + self.localtmp +
-                             '/environ.in ' + self.scratch, shell=True)
+                        subdirs.copy(self.localtmp + '/environ.in',
+                                     self.scratch, self.site)
                     self.cinp, self.cout = self.site.do_perProcMpiExec(
                         self.scratch,
                         self.exedir + 'pw.x ' + self.parflags + ' -in pw2.inp')
                 os.chdir(cdir)
             elif self.calculation == 'cp' or self.calculation == 'vc-cp' or self.calculation == 'vc-cp-wf':
-                call('cp ' + self.localtmp + '/pw.inp ' + self.scratch,
-                    shell=True)
+                shutil.copy(self.localtmp + '/pw.inp', self.scratch)
                 if self.use_environ:
-                    call('cp ' + self.localtmp + '/environ.in ' + self.scratch,
-                        shell=True)
+                    shutil.copy(self.localtmp + '/environ.in', self.scratch)
                 if self.calculation != 'hund':
                     cmd = 'cd ' + self.scratch + ' ; ' + self.exedir + 'cp.x ' + self.serflags + ' -in pw.inp'
                     print(cmd)
@@ -2263,33 +2637,26 @@ class espresso(Calculator):
                     call(
                         'cd ' + self.scratch + ' ; ' + self.exedir + 'cp.x ' +
                         self.serflags + ' -in pw.inp >>' + self.log, shell=True)
-                    call(
-                        "sed s/occupations.*/occupations=\\'fixed\\',/ <" +
-                        self.localtmp +
-                        "/pw.inp | sed s/ELECTRONS/ELECTRONS\\\\n\ \ startingwfc=\\'file\\',\\\\n\ \ startingpot=\\'file\\',/ | sed s/conv_thr.*/conv_thr="
-                        + utils.num2str(self.conv_thr) +
-                        ",/ | sed s/tot_magnetization.*/tot_magnetization=" +
-                        utils.num2str(self.totmag) + ",/ >" + self.localtmp +
-                        "/pw2.inp", shell=True
-                    )
-                    call('cp ' + self.localtmp + '/pw2.inp ' + self.scratch,
-                        shell=True)
+                    self.writehundinputfile()
+                    shutil.copy(self.localtmp + '/pw2.inp', self.scratch)
                     if self.use_environ:
-                        call('cp ' + self.localtmp + '/environ.in ' +
-                            self.scratch)
+                        shutil.copy(self.localtmp + '/environ.in',
+                                    self.scratch)
 
                     cmd = 'cd ' + self.scratch + ' ; ' + self.exedir + 'cp.x ' + self.serflags + ' -in pw2.inp'
                     p = Popen(cmd, shell=True, stdin=PIPE,
                           stdout=PIPE, close_fds=True)
                     self.cinp, self.cout = (p.stdin, p.stdout)
             else:
-                call('cp ' + self.localtmp + '/pw.inp ' + self.scratch,
-                     shell=True)
+                shutil.copy(self.localtmp + '/pw.inp', self.scratch)
                 if self.use_environ:
-                    call('cp ' + self.localtmp + '/environ.in ' + self.scratch,
-                         shell=True)
+                    shutil.copy(self.localtmp + '/environ.in', self.scratch)
                 if self.calculation != 'hund':
-                    cmd = 'cd ' + self.scratch + ' ; ' + self.exedir + 'pw.x ' + self.serflags + ' -in pw.inp'
+                    if self.useprocsubset():
+                        cmd = self.mpicommand(self.exedir + 'pw.x ' +
+                                              self.parflags + ' -in pw.inp')
+                    else:
+                        cmd = 'cd ' + self.scratch + ' ; ' + self.exedir + 'pw.x ' + self.serflags + ' -in pw.inp'
                     p = Popen(cmd, shell=True, stdin=PIPE,
                               stdout=PIPE, close_fds=True)
                     self.cinp, self.cout = (p.stdin, p.stdout)
@@ -2297,29 +2664,206 @@ class espresso(Calculator):
                     call(
                         'cd ' + self.scratch + ' ; ' + self.exedir + 'pw.x ' +
                         self.serflags + ' -in pw.inp >>' + self.log, shell=True)
-                    call(
-                        "sed s/occupations.*/occupations=\\'fixed\\',/ <" +
-                        self.localtmp +
-                        "/pw.inp | sed s/ELECTRONS/ELECTRONS\\\\n\ \ startingwfc=\\'file\\',\\\\n\ \ startingpot=\\'file\\',/ | sed s/conv_thr.*/conv_thr="
-                        + utils.num2str(self.conv_thr) +
-                        ",/ | sed s/tot_magnetization.*/tot_magnetization=" +
-                        utils.num2str(self.totmag) + ",/ >" + self.localtmp +
-                        "/pw2.inp", shell=True
-                    )
-                    call('cp ' + self.localtmp + '/pw2.inp ' + self.scratch,
-                         shell=True)
+                    self.writehundinputfile()
+                    shutil.copy(self.localtmp + '/pw2.inp', self.scratch)
                     if self.use_environ:
-                        call('cp ' + self.localtmp + '/environ.in ' +
-                             self.scratch)
+                        shutil.copy(self.localtmp + '/environ.in',
+                                    self.scratch)
 
                     cmd = 'cd ' + self.scratch + ' ; ' + self.exedir + 'pw.x ' + self.serflags + ' -in pw2.inp'
                     p = Popen(cmd, shell=True, stdin=PIPE,
                               stdout=PIPE, close_fds=True)
                     self.cinp, self.cout = (p.stdin, p.stdout)
 
+            self.parser = pwparser.PWOutputParser(self.cout, self.log,
+                                                  self.natoms, self.logindex)
+            if self.drainoutput:
+                self.parser.start_drain()
+            self.started = True
+
+    def poolable(self):
+        """Whether pw.x of this calculator can be kept in (or taken
+        from) the session pool."""
+        return (self.sessionpool is not None and self.cancalc and
+                self.calculation == 'ase3' and self.ion_dynamics == 'ase3')
+
+    def borrowsession(self, aio=False):
+        """Take over a pooled pw.x session for the input just written
+        and pass it the current positions. Returns whether there was
+        one. Otherwise, the pw.x about to be started is prepared for
+        pooling. With aio, only sessions started by astart in the
+        running event loop are taken."""
+        self.sessionkey = None
+        self.pwidle = False
+        if not self.poolable():
+            return False
+        extra = [self.exedir, self.parflags, self.serflags, self.site.batch]
+        if aio:
+            # asyncio pipes only work in the loop they were created in
+            extra.append('asyncio %x' % id(asyncio.get_running_loop()))
+        if self.use_environ:
+            with open(self.localtmp + '/environ.in') as f:
+                extra.append(f.read())
+        if self.proclist:
+            with open(self.mycpus) as f:
+                extra.append(f.read())
+        self.sessionkey = inputkey(self.localtmp + '/pw.inp', *extra)
+        session = self.sessionpool.borrow(self.sessionkey)
+        if session is None:
+            self.sessionlog = (self.log, os.path.getsize(self.log)
+                               if os.path.exists(self.log) else 0)
+            return False
+        self.session = session
+        self.cinp, self.cout, self.parser = (session.cinp, session.cout,
+                                             session.parser)
+        self.aproc = session.aproc
+        self.parser.setlog(self.log, self.logindex, session.preamble)
+        self.ownscratch = self.scratch
+        self.scratch = session.scratch
+        self.started = True
+        self.send_positions(self.atoms)
+        if not aio:
+            self.cinp.flush()
+        return True
+
+    def parksession(self):
+        """Hand the idle pw.x over to the session pool."""
+        if self.session is not None:
+            session = self.session
+        else:
+            session = Session(self.sessionkey, self.cinp, self.cout,
+                              self.parser, self.scratch,
+                              preamble(*self.sessionlog), self.aproc)
+        self.parser.flush()
+        self.session = None
+        self.aproc = None
+        self.started = False
+        self.pwidle = False
+        if self.ownscratch is not None:
+            self.scratch = self.ownscratch
+            self.ownscratch = None
+        else:
+            # the session keeps running in our scratch directory, so
+            # the next pw.x of this calculator needs another one
+            self.scratch = self.newscratch()
+        self.sessionpool.release(session)
+
+    def useprocsubset(self):
+        """Whether pw.x runs only on the processes in self.mycpus
+        (procrange or procs), which needs a perSpecProcMpiExec template."""
+        return self.proclist and hasattr(self.site, 'perSpecProcMpiExec')
+
+    def mpicommand(self, program):
+        """Command running program on this calculator's processes."""
+        if self.useprocsubset():
+            return self.site.perSpecProcMpiExec % (
+                self.mycpus, self.myncpus, self.scratch, program)
+        return self.site.perProcMpiExec % (self.scratch, program)
+
+    @timed('start')
+    async def astart(self):
+        """Start pw.x as an asyncio subprocess. Calculators started this
+        way do not take part in the single_calculator bookkeeping, so
+        many of them can run concurrently in one event loop."""
+        if not self.started:
+            if self.calculation not in ('ase3', 'relax', 'scf', 'vc-relax',
+                                        'vc-md', 'md'):
+                raise NotImplementedError(
+                    'calculation=\'%s\' is not supported by the asyncio '
+                    'interface' % self.calculation)
+            if self.borrowsession(aio=True):
+                return
+            inputs = ['pw.inp']
+            if self.use_environ:
+                inputs.append('environ.in')
+            if self.site.batch:
+                if not (hasattr(self.site, 'perProcMpiExec') or
+                        self.useprocsubset()):
+                    raise NotImplementedError(
+                        'the asyncio interface requires a perProcMpiExec '
+                        'command template in espsite.py')
+                pernode = subdirs.pernodeexec(self.site)
+                for x in inputs:
+                    if pernode is None:
+                        shutil.copy(self.localtmp + '/' + x, self.scratch)
+                        continue
+                    p = await asyncio.create_subprocess_shell(
+                        pernode + ' cp ' + self.localtmp + '/' + x + ' ' +
+                        self.scratch, cwd=self.localtmp)
+                    await p.wait()
+                cmd = self.mpicommand(
+                    self.exedir + 'pw.x ' + self.parflags + ' -in pw.inp')
+                cwd = self.localtmp
+            else:
+                for x in inputs:
+                    shutil.copy(self.localtmp + '/' + x, self.scratch)
+                if self.useprocsubset():
+                    # the command changes to the scratch directory
+                    cmd = self.mpicommand(
+                        self.exedir + 'pw.x ' + self.parflags + ' -in pw.inp')
+                    cwd = None
+                else:
+                    cmd = (self.exedir + 'pw.x ' + self.serflags +
+                           ' -in pw.inp')
+                    cwd = self.scratch
+            self.aproc = await asyncio.create_subprocess_shell(
+                cmd, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE, cwd=cwd)
+            self.cinp, self.cout = (self.aproc.stdin, self.aproc.stdout)
+            self.parser = pwparser.PWOutputParser(self.cout, self.log,
+                                                  self.natoms, self.logindex)
             self.started = True
 
-    def stop(self):
+    @timed('stop')
+    async def astop(self, park=False):
+        """Coroutine version of stop for pw.x started by astart."""
+        if (self.started and park and self.pwidle and
+                self.sessionkey is not None):
+            self.parksession()
+            return
+        if self.started:
+            if self.ion_dynamics == 'ase3':
+                # sending 'Q' to espresso tells it to quit cleanly
+                self.cinp.write(b'Q')
+            try:
+                await self.cinp.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # espresso may have already shut down
+                pass
+            await self.parser.adrain(skipped=self.scfevent)
+            self.collectclocks()
+            self.parser.close()
+            self.cinp.close()
+            await self.aproc.wait()
+            self.aproc = None
+            self.started = False
+        self.session = None
+        self.pwidle = False
+        if self.ownscratch is not None:
+            self.scratch = self.ownscratch
+            self.ownscratch = None
+
+    @timed('stop')
+    def stop(self, park=False):
+        """Stop pw.x. With park, an idle pw.x is kept in the session pool
+        instead if pooling applies (it then does not write its final
+        files, e.g. calc.save)."""
+        if (self.started and park and self.pwidle and
+                self.sessionkey is not None):
+            self.parksession()
+            return
+        if self.started and self.aproc is not None:
+            # started by astart and no event loop to drain the output:
+            # ask pw.x to quit and let it go
+            try:
+                if self.ion_dynamics == 'ase3':
+                    self.cinp.write(b'Q')
+                self.cinp.close()
+            except BaseException:
+                pass
+            self.parser.close()
+            self.aproc = None
+            self.started = False
         if self.started:
             if self.ion_dynamics == 'ase3':
                 # sending 'Q' to espresso tells it to quit cleanly
@@ -2331,14 +2875,9 @@ class espresso(Calculator):
                     pass
             else:
                 self.cinp.flush()
-            s = open(self.log, 'a')
-            a = self.cout.readline().decode('utf-8')
-            s.write(a)
-            while a != '':
-                a = self.cout.readline().decode('utf-8')
-                s.write(a)
-                s.flush()
-            s.close()
+            self.parser.drain(skipped=self.scfevent)
+            self.collectclocks()
+            self.parser.close()
             try:
                 self.cinp.close()
             except:
@@ -2348,6 +2887,32 @@ class espresso(Calculator):
             except:
                 pass
             self.started = False
+        self.session = None
+        self.pwidle = False
+        if self.ownscratch is not None:
+            self.scratch = self.ownscratch
+            self.ownscratch = None
+
+    def newscratch(self):
+        """Create a scratch directory for pw.x, removed at exit."""
+        with self.timings.phase('scratch setup'):
+            scratch = subdirs.mkscratch(self.localtmp, self.site)
+        if self.output is not None:
+            if 'removewf' in self.output:
+                removewf = self.output['removewf']
+            else:
+                removewf = True
+            if 'removesave' in self.output:
+                removesave = self.output['removesave']
+            else:
+                removesave = False
+        else:
+            removewf = True
+            removesave = False
+        atexit.register(self.timings.wrap('cleanup', subdirs.cleanup),
+                        self.localtmp, scratch,
+                        removewf, removesave, self, self.site)
+        return scratch
 
     def topath(self, filename):
         if os.path.isabs(filename):
@@ -2355,7 +2920,52 @@ class espresso(Calculator):
         else:
             return os.path.join(self.sdir, filename)
 
-    def save_output(self, filename='calc.tgz'):
+    def indexlog(self):
+        """Bring the index of the log up to date and return it."""
+        if self.started:
+            # the drain thread may be feeding the index concurrently
+            with self.parser.cond:
+                self.parser.flush()
+                self.logindex.update()
+        else:
+            self.logindex.update()
+        return self.logindex
+
+    def writearchive(self, filename, members, exclude=(), codec=None):
+        """Archive members of the scratch directory to filename
+        (see the archive and chunkstore options of the calculator)."""
+        if self.chunkstore is not None:
+            self.chunkstore.put(filename, self.scratch, members, exclude)
+            return
+        opts = {'codec': None, 'level': None, 'threads': None}
+        if self.archiveopts is not None:
+            opts.update(self.archiveopts)
+        if codec is not None:
+            opts['codec'] = codec
+        archive.write(filename, self.scratch, members, exclude,
+                      opts['codec'], opts['level'], opts['threads'])
+
+    def readarchive(self, filename, directory=None):
+        """Restore an archive (or chunk store snapshot) written by
+        writearchive into directory (default: the scratch directory)."""
+        if directory is None:
+            directory = self.scratch
+        if self.chunkstore is not None and filename in self.chunkstore:
+            self.chunkstore.get(filename, directory)
+        else:
+            archive.extract(filename, directory)
+
+    def find_occupations(self):
+        """On-site occupation and PAW files in the scratch directory."""
+        return (subdirs.find(self.scratch, 'calc.occup*') +
+                subdirs.find(self.scratch, 'calc.paw'))
+
+    def density_files(self):
+        """Files in calc.save describing the charge (and spin) density."""
+        return ['calc.save/charge-density.*', 'calc.save/data-file*.xml',
+                'calc.save/spin-polarization.*', 'calc.save/magnetization.*']
+
+    def save_output(self, filename='calc.tgz', codec=None):
         """
         Save the contents of calc.save directory.
         """
@@ -2363,8 +2973,7 @@ class espresso(Calculator):
         self.update(self.atoms)
         self.stop()
 
-        call('tar czf ' + filename + ' --directory=' + self.scratch +
-             ' calc.save', shell=True)
+        self.writearchive(filename, ['calc.save'], codec=codec)
 
     def load_output(self, filename='calc.tgz'):
         """
@@ -2373,10 +2982,9 @@ class espresso(Calculator):
         self.stop()
         self.topath(filename)
 
-        call('tar xzf ' + filename + ' --directory=' + self.scratch,
-             shell=True)
+        self.readarchive(filename)
 
-    def save_flev_output(self, filename='calc.tgz'):
+    def save_flev_output(self, filename='calc.tgz', codec=None):
         """
         Save the contents of calc.save directory + Fermi level
         & on-site density matrices (if present).
@@ -2389,10 +2997,8 @@ class espresso(Calculator):
         print('%.15e\n#Fermi level in eV' % ef, file=f)
         f.close()
 
-        call(
-            'tar czf ' + filename + ' --directory=' + self.scratch +
-            ' calc.save `find . -name "calc.occup*";find . -name "calc.paw"`',
-            shell=True)
+        self.writearchive(filename, ['calc.save'] + self.find_occupations(),
+                          codec=codec)
 
     def load_flev_output(self, filename='calc.tgz'):
         """
@@ -2402,14 +3008,13 @@ class espresso(Calculator):
         self.stop()
         self.topath(filename)
 
-        call('tar xzf ' + filename + ' --directory=' + self.scratch,
-             shell=True)
+        self.readarchive(filename)
 
         self.fermi_input = True
         with open(self.scratch + '/calc.save/fermilevel.txt', 'r') as f:
             self.inputfermilevel = float(f.readline())
 
-    def save_chg(self, filename='chg.tgz'):
+    def save_chg(self, filename='chg.tgz', codec=None):
         """
         Save charge density.
         """
@@ -2417,13 +3022,9 @@ class espresso(Calculator):
         self.update(self.atoms)
         self.stop()
 
-        call(
-            'tar czf ' + filename + ' --directory=' + self.scratch +
-            ' calc.save/charge-density.dat calc.save/data-file.xml `cd ' +
-            self.scratch +
-            ';find calc.save -name "spin-polarization.*";find calc.save -name "magnetization.*";find . -name "calc.occup*";find . -name "calc.paw"`',
-            shell=True
-        )
+        self.writearchive(filename,
+                          self.density_files() + self.find_occupations(),
+                          codec=codec)
 
     def load_chg(self, filename='chg.tgz'):
         """
@@ -2432,27 +3033,25 @@ class espresso(Calculator):
         self.stop()
         self.topath(filename)
 
-        call('tar xzf ' + filename + ' --directory=' + self.scratch,
-             shell=True)
+        self.readarchive(filename)
 
-    def save_wf(self, filename='wf.tgz'):
+    def save_wf(self, filename='wf.tgz', codec=None):
         """Save wave functions."""
         self.topath(filename)
         self.update(self.atoms)
         self.stop()
 
-        call('tar czf ' + filename + ' --directory=' + self.scratch +
-             ' --exclude=calc.save .', shell=True)
+        self.writearchive(filename, os.listdir(self.scratch),
+                          exclude=('calc.save',), codec=codec)
 
     def load_wf(self, filename='wf.tgz'):
         """Load wave functions."""
         self.stop()
         self.topath(filename)
 
-        call('tar xzf ' + filename + ' --directory=' + self.scratch,
-             shell=True)
+        self.readarchive(filename)
 
-    def save_flev_chg(self, filename='chg.tgz'):
+    def save_flev_chg(self, filename='chg.tgz', codec=None):
         """
         Save charge density and Fermi level.
         Useful for subsequent bandstructure or density of states
@@ -2465,13 +3064,9 @@ class espresso(Calculator):
         f = open(self.scratch + '/calc.save/fermilevel.txt', 'w')
         print('%.15e\n#Fermi level in eV' % ef, file=f)
         f.close()
-        call(
-            'tar czf ' + filename + ' --directory=' + self.scratch +
-            ' calc.save/charge-density.dat calc.save/data-file.xml `cd ' +
-            self.scratch +
-            ';find calc.save -name "spin-polarization.*";find calc.save -name "magnetization.*";find . -name "calc.occup*";find . -name "calc.paw"` calc.save/fermilevel.txt',
-            shell=True
-        )
+        self.writearchive(filename,
+                          self.density_files() + self.find_occupations() +
+                          ['calc.save/fermilevel.txt'], codec=codec)
 
     def load_flev_chg(self, filename='efchg.tgz'):
         """
@@ -2482,12 +3077,10 @@ class espresso(Calculator):
         self.stop()
         self.topath(filename)
 
-        call('tar xzf ' + filename + ' --directory=' + self.scratch,
-             shell=True)
+        self.readarchive(filename)
         self.fermi_input = True
-        f = open(self.scratch + '/calc.save/fermilevel.txt', 'r')
-        self.inputfermilevel = float(f.readline().decode('utf-8'))
-        f.close()
+        with open(self.scratch + '/calc.save/fermilevel.txt', 'r') as f:
+            self.inputfermilevel = float(f.readline())
 
     def get_final_structure(self):
         """
@@ -2496,15 +3089,16 @@ class espresso(Calculator):
         """
         self.stop()
 
-        cmd = 'grep -a -n Giannozzi ' + self.log + '| tail -1'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        n = int(p.readline().decode('utf-8').split()[0].strip(':'))
+        n = self.indexlog().header
+        if n is None:
+            raise RuntimeError(
+                'Espresso executable doesn\'t seem to have been started.')
 
-        s = open(self.log, 'r')
+        f = open(self.log, 'rb')
         # skip over previous runs in log in case the current log has been
         # appended to old ones
-        for i in range(n):
-            s.readline()
+        f.seek(n)
+        s = TextIOWrapper(f, encoding='utf-8')
 
         a = s.readline()
         while a[:11] != '     celldm':
@@ -2572,17 +3166,26 @@ class espresso(Calculator):
         else:
             return self.energy_zero
 
+    async def aget_potential_energy(self, atoms=None, force_consistent=False):
+        """Coroutine version of get_potential_energy: pw.x is run as an
+        asyncio subprocess, so the event loop can drive many
+        calculators at the same time, e.g.
+        energies = await asyncio.gather(
+            *[c.aget_potential_energy(a) for c, a in zip(calcs, images)])
+        """
+        if atoms is None:
+            atoms = self.atoms
+        await self.aupdate(atoms)
+        if force_consistent:
+            return self.energy_free
+        else:
+            return self.energy_zero
+
     def get_nonselfconsistent_energies(self, type='beefvdw'):
         self.stop()
-        cmd = 'grep -a -32 "BEEF-vdW xc energy contributions" ' + self.log + ' | tail -32'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s = p.readlines()
-        xc = np.array([])
-        for i, l in enumerate(s):
-            l_ = float(l.split(":")[-1]) * Rydberg
-            xc = np.append(xc, l_)
-        assert len(xc) == 32
-        return xc
+        beef = self.indexlog().beef
+        assert beef is not None
+        return beef[1] * Rydberg
 
     def get_xc_functional(self):
         return self.xc
@@ -2594,24 +3197,19 @@ class espresso(Calculator):
         """
         self.stop()
 
-        cmd = 'grep -a -3 "total   stress" ' + self.log + ' | tail -3'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s = p.readlines()
-
-        if len(s) != 3:
+        stress = self.indexlog().stress
+        if stress is None:
             raise RuntimeError(
                 'Stress was not calculated\nconsider specifying '
                 'calcstress or running a unit cell relaxation.'
             )
 
-        stress = np.empty((3, 3), dtype=float)
-        for i in range(3):
-            stress[i][:] = [float(x) for x in s[i].split()[:3]]
-
-        return stress * Rydberg / Bohr**3
+        return stress[1] * Rydberg / Bohr**3
 
     def get_stress(self, dummyself=None):
         """Returns stress tensor in Voigt notation """
+        if self.calcstress and 'stress' in self.results:
+            return self.results['stress'].copy()
         if self.calcstress:
             # ASE convention for the stress tensor appears to differ
             # from the PWscf one by a factor of -1
@@ -2631,23 +3229,18 @@ class espresso(Calculator):
         Units are Bohr magnetons per unit cell, directly read PWscf log.
         Returns (0,0) if no magnetization is found in log.
         """
-        cmd = 'grep -a "total magnetization" ' + self.log + ' | tail -1'
-        p1 = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s1 = p1.readlines()
-
-        cmd = 'grep -a "absolute magnetization" ' + self.log + ' | tail -1'
-        p2 = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s2 = p2.readlines()
+        index = self.indexlog()
+        s1 = index.totmag
+        s2 = index.absmag
 
-        if len(s1) == 0:
-            assert len(s2) == 0
+        if s1 is None:
+            assert s2 is None
             return (0, 0)
         else:
-            assert len(s1) == 1
-            assert len(s2) == 1
-            s1_ = s1[0].split("=")[-1]
+            assert s2 is not None
+            s1_ = s1[1].split("=")[-1]
             totmag = float(s1_.split("Bohr")[0])
-            s2_ = s2[0].split("=")[-1]
+            s2_ = s2[1].split("=")[-1]
             absmag = float(s2_.split("Bohr")[0])
             return (totmag, absmag)
 
@@ -2655,38 +3248,21 @@ class espresso(Calculator):
         return self.ST
 
     def checkerror(self):
-        cmd = 'grep -a -n Giannozzi ' + self.log + ' | tail -1'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        try:
-            out = p.readline().decode('utf-8')
-            n = int(out.split()[0].strip(':'))
-        except BaseException:
+        index = self.indexlog()
+        if index.header is None:
             raise RuntimeError(
                 'Espresso executable doesn\'t seem to have been started.')
 
-        cmd = ('tail -n +%d ' % n) + self.log + ' | grep -a -n %%%%%%%%%%%%%%%% |tail -2'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s = p.readlines()
-
-        if len(s) < 2:
+        # last message framed by %%%% lines in the current run
+        if index.banner is None:
             return
-
-        a = int(s[0].decode('utf-8').split()[0].strip(':')) + 1
-        b = int(s[1].decode('utf-8').split()[0].strip(':')) - a
-
-        if b < 1:
+        msg = index.banner[1]
+        if len(msg) == 0:
             return
 
-        cmd = ('tail -n +%d ' % (a + n - 1)) + self.log + ('|head -%d' % b)
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        err = p.readlines()
-
-        if err[0].decode('utf-8').lower().find('error') < 0:
+        if msg.split('\n', 1)[0].lower().find('error') < 0:
             return
 
-        msg = ''
-        for e in err:
-            msg += e.decode('utf-8')
         raise RuntimeError(msg[:len(msg) - 1])
 
     def relax_cell_and_atoms(
@@ -2885,11 +3461,10 @@ class espresso(Calculator):
         if self.site.batch and parallel:
             cdir = os.getcwd()
             os.chdir(self.localtmp)
-            call(self.site.perHostMpiExec + ' cp ' + self.localtmp + '/' +
-                 inp + ' ' + self.scratch, shell=True)
+            subdirs.copy(self.localtmp + '/' + inp, self.scratch, self.site)
             if self.use_environ:
-                call(self.site.perHostMpiExec + ' cp ' + self.localtmp +
-                     '/environ.in' + ' ' + self.scratch, shell=True)
+                subdirs.copy(self.localtmp + '/environ.in', self.scratch,
+                             self.site)
 
             if piperead:
                 p = self.site.do_perProcMpiExec_outputonly(
@@ -2902,11 +3477,9 @@ class espresso(Calculator):
             os.chdir(cdir)
         else:
             if self.use_environ:
-                call('cp {}/environ.in {}'.format(self.localtmp, self.scratch),
-                     shell=True)
+                shutil.copy(self.localtmp + '/environ.in', self.scratch)
 
-            call('cp {}/{} {}'.format(self.localtmp, inp, self.scratch),
-                 shell=True)
+            shutil.copy(self.localtmp + '/' + inp, self.scratch)
             cmd = 'cd {} ; {} {} -in {}'.format(
                 self.scratch, binary, self.serflags, inp + ll)
             if piperead:
@@ -2972,14 +3545,11 @@ class espresso(Calculator):
         if self.fermi_input:
             return self.inputfermilevel
         self.stop()
-        try:
-            cmd = 'grep -a Fermi ' + self.log + '|tail -1'
-            p = Popen(cmd, shell=True, stdout=PIPE).stdout
-            efermi = float(p.readline().decode('utf-8').split()[-2])
-        except BaseException:
+        fermi = self.indexlog().fermi
+        if fermi is None:
             raise RuntimeError(
                 'get_fermi_level called before DFT calculation was run')
-        return efermi
+        return fermi[1]
 
     def calc_pdos(self,
                   Emin=None,
@@ -2995,7 +3565,9 @@ class espresso(Calculator):
                   sigma=None,
                   nscf_fermilevel=False,
                   add_higher_channels=True,
-                  get_overlap_integrals=False):
+                  get_overlap_integrals=False,
+                  projections_dtype=complex,
+                  projections_file=None):
         """Calculate (projected) density of states.
         - Emin,Emax,DeltaE define the energy window.
         - nscf=True will cause a non-selfconsistent calculation to be performed
@@ -3007,9 +3579,16 @@ class espresso(Calculator):
         - slab=True: use triangle method insead of tetrahedron method
           (for 2D system perp. to z-direction)
         - sigma != None sets/overrides the smearing to calculate the DOS
-          (also overrides tetrahedron/triangle settings)
+          (also overrides tetrahedron/triangle settings). In this case, the
+          k-resolved eigenvalues and projections are kept, so further calls
+          with the same nscf settings only differing in Emin, Emax, DeltaE,
+          sigma or ngauss (default 0: gaussian) are evaluated in python
+          without running projwfc.x again (except for non-collinear runs)
         - get_overlap_integrals=True: also return k-point- and band-resolved
           projections (which are summed up and smeared to obtain the PDOS)
+        - projections_dtype=np.complex64 halves the memory needed for the
+          projections; with projections_file, they are stored in that
+          memory-mapped .npy file
 
         Returns an array containing the energy window,
         the DOS over the same range,
@@ -3020,6 +3599,8 @@ class espresso(Calculator):
         m-resolved PDOS over the energy window.
         In case of spin-polarization, total up is followed by total down, by
         first m with spin up, etc...
+        These arrays are views into the contiguous array of all PDOS,
+        available with its index as calc.pdoscube (see projwfc.PDOSCube).
 
         Quantum Espresso with the tetrahedron method for PDOS can be
         obtained here:
@@ -3027,111 +3608,124 @@ class espresso(Calculator):
         """
         efermi = self.get_fermi_level()
 
-        # run a nscf calculation with e.g. tetrahedra or more k-points etc.
-        if nscf:
-            if not hasattr(self, 'natoms'):
-                self.atoms2species()
-                self.natoms = len(self.atoms)
-            if self.use_environ:
-                self.writeenvinputfile()
-            self.writeinputfile(
-                filename='pwnscf.inp',
-                mode='nscf',
-                usetetrahedra=tetrahedra,
-                overridekpts=kpts,
-                overridekptshift=kptshift,
-                overridenbands=nbands,
-                suppressforcecalc=True)
-            self.run_espressox(self.exedir + 'pw.x', 'pwnscf.inp',
-                               'pwnscf.log')
-            if nscf_fermilevel:
-                cmd = 'grep -a Fermi ' + self.localtmp + '/pwnscf.log|tail -1'
-                p = Popen(cmd, shell=True, stdout=PIPE).stdout
-                efermi = float(p.readline().decode('utf-8').split()[-2])
-
-        # remove old wave function projections
-        call('rm -f ' + self.scratch + '/*_wfc*', shell=True)
-        # create input for projwfc.x
-        f = open(self.localtmp + '/pdos.inp', 'w')
-        print('&PROJWFC\n  prefix=\'calc\',\n  outdir=\'.\',', file=f)
-        if Emin is not None:
-            print('  Emin = ' + utils.num2str(Emin + efermi) + ',', file=f)
-        if Emax is not None:
-            print('  Emax = ' + utils.num2str(Emax + efermi) + ',', file=f)
-        if DeltaE is not None:
-            print('  DeltaE = ' + utils.num2str(DeltaE) + ',', file=f)
-        if slab:
-            print('  lslab = .true.,', file=f)
-        if ngauss is not None:
-            print('  ngauss = ' + str(ngauss) + ',', file=f)
-        if sigma is not None:
-            print(
-                '  degauss = ' + utils.num2str(sigma / Rydberg) + ',', file=f)
-        print('/', file=f)
-        f.close()
-        # run projwfc.x
-        self.run_espressox('projwfc.x', 'pdos.inp', 'pdos.log')
-
-        # read in total density of states
-        dos = np.loadtxt(self.scratch + '/calc.pdos_tot')
-        if len(dos[0]) > 3:
-            nspin = 2
-            self.dos_total = [dos[:, 1], dos[:, 2]]
+        # with an explicit broadening, the projections of a previous
+        # projwfc.x run on the same state can be re-broadened in python
+        rebroaden = sigma is not None and not self.noncollinear
+        pdoskey = repr((nscf, tetrahedra, slab, kpts, kptshift, nbands,
+                        nscf_fermilevel))
+        cache = self.pdoscache
+        savedir = self.scratch + '/calc.save'
+        if (rebroaden and cache is not None and cache[0] == pdoskey and
+                cache[1] == statefingerprint(savedir)):
+            efermi, projected = cache[2:]
         else:
-            nspin = 1
-            self.dos_total = dos[:, 1]
-        self.dos_energies = dos[:, 0] - efermi
-        npoints = len(self.dos_energies)
-
-        channels = {'s': 0, 'p': 1, 'd': 2, 'f': 3}
-        # read in projections onto atomic orbitals
-        self.pdos = [{} for i in range(self.natoms)]
-        cmd = 'ls ' + self.scratch + '/calc.pdos_atm*'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        proj = p.readlines()
-
-        proj.sort()
-        for i, inp in enumerate(proj):
-            inpfile = inp.strip().decode('utf-8')
-            pdosinp = np.genfromtxt(inpfile)
-            spl = inpfile.split('#')
-            iatom = int(spl[1].split('(')[0]) - 1
-            channel = spl[2].split('(')[1].rstrip(')').replace('_j', ',j=')
-            jpos = channel.find('j=')
-            if jpos < 0:
-                # ncomponents = 2*l+1 +1  (latter for m summed up)
-                ncomponents = (2 * channels[channel[0]] + 2) * nspin
+            projected = None
+            # run a nscf calculation with e.g. tetrahedra or more k-points etc.
+            if nscf:
+                if not hasattr(self, 'natoms'):
+                    self.atoms2species()
+                    self.natoms = len(self.atoms)
+                if self.use_environ:
+                    self.writeenvinputfile()
+                self.writeinputfile(
+                    filename='pwnscf.inp',
+                    mode='nscf',
+                    usetetrahedra=tetrahedra,
+                    overridekpts=kpts,
+                    overridekptshift=kptshift,
+                    overridenbands=nbands,
+                    suppressforcecalc=True)
+                self.run_espressox(self.exedir + 'pw.x', 'pwnscf.inp',
+                                   'pwnscf.log')
+                if nscf_fermilevel:
+                    index = pwparser.LogIndex(self.localtmp + '/pwnscf.log')
+                    index.update()
+                    efermi = index.fermi[1]
+
+            # remove old wave function projections
+            subdirs.remove(self.scratch + '/*_wfc*')
+            # create input for projwfc.x
+            f = open(self.localtmp + '/pdos.inp', 'w')
+            print('&PROJWFC\n  prefix=\'calc\',\n  outdir=\'.\',', file=f)
+            if Emin is not None:
+                print('  Emin = ' + utils.num2str(Emin + efermi) + ',', file=f)
+            if Emax is not None:
+                print('  Emax = ' + utils.num2str(Emax + efermi) + ',', file=f)
+            if DeltaE is not None:
+                print('  DeltaE = ' + utils.num2str(DeltaE) + ',', file=f)
+            if slab:
+                print('  lslab = .true.,', file=f)
+            if ngauss is not None:
+                print('  ngauss = ' + str(ngauss) + ',', file=f)
+            if sigma is not None:
+                print(
+                    '  degauss = ' + utils.num2str(sigma / Rydberg) + ',', file=f)
+            print('/', file=f)
+            f.close()
+            # run projwfc.x
+            self.run_espressox('projwfc.x', 'pdos.inp', 'pdos.log')
+
+            if rebroaden:
+                projected = projwfc.ProjectedStates(
+                    self.localtmp + '/pdos.log',
+                    savedir + '/atomic_proj.xml')
+                self.pdoscache = (pdoskey, statefingerprint(savedir),
+                                  efermi, projected)
+
+        if projected is not None:
+            if ngauss is None:
+                ngauss = 0
+            energies = projected.energy_grid(
+                None if Emin is None else Emin + efermi,
+                None if Emax is None else Emax + efermi,
+                DeltaE, sigma)
+            dos = projected.dos(energies, sigma, ngauss)
+            nspin = len(dos)
+            if nspin == 2:
+                self.dos_total = [dos[0], dos[1]]
             else:
-                # ncomponents = 2*j+1 +1  (latter for m summed up)
-                ncomponents = int(2. * float(channel[jpos + 2:])) + 2
-            if channel not in self.pdos[iatom]:
-                self.pdos[iatom][channel] = np.zeros(
-                    (ncomponents, npoints),
-                    dtype=float
-                )
-                first = True
+                self.dos_total = dos[0]
+            self.dos_energies = energies - efermi
+            self.pdoscube = projected.pdos(
+                energies, sigma, self.natoms, ngauss, add_higher_channels)
+            self.pdos = self.pdoscube.todicts()
+        else:
+            # read in total density of states
+            dos = projwfc.read_pdos_file(self.scratch + '/calc.pdos_tot')
+            if len(dos[0]) > 3:
+                nspin = 2
+                self.dos_total = [dos[:, 1], dos[:, 2]]
             else:
-                first = False
-            if add_higher_channels or first:
-                for j in range(ncomponents):
-                    self.pdos[iatom][channel][j] += pdosinp[:, (j + 1)]
+                nspin = 1
+                self.dos_total = dos[:, 1]
+            self.dos_energies = dos[:, 0] - efermi
+
+            # read in projections onto atomic orbitals
+            self.pdoscube = projwfc.load_pdos(
+                self.scratch, self.natoms, nspin,
+                add_higher_channels=add_higher_channels)
+            self.pdos = self.pdoscube.todicts()
 
         if get_overlap_integrals:
             return (self.dos_energies,
                     self.dos_total,
                     self.pdos,
-                    self.__get_atomic_projections__())
+                    self.__get_atomic_projections__(projections_dtype,
+                                                    projections_file))
         else:
             return self.dos_energies, self.dos_total, self.pdos
 
     def calc_bandstructure(self,
                            kptpath,
                            nbands=None,
-                           atomic_projections=False):
+                           atomic_projections=False,
+                           projections_dtype=complex,
+                           projections_file=None):
         """Calculate bandstructure along kptpath (= array of k-points).
         If nbands is not None, override number of bands set in calculator.
         If atomic_projections is True, calculate orbital character of
-        each band at each k-point.
+        each band at each k-point (see calc_pdos for projections_dtype and
+        projections_file).
 
         Returns an array of energies.
         (if spin-polarized spin is first index;
@@ -3180,156 +3774,74 @@ class espresso(Calculator):
             self.run_espressox('projwfc.x', 'pdos.inp', 'pdos.log')
             # remove unneeded pdos files containing only a tiny E-range of two
             # points
-            call('rm -f ' + self.scratch + '/projtmp*', shell=True)
-
-            return energies, self.__get_atomic_projections__()
-
-    def __get_atomic_projections__(self):
-        f = open(self.scratch + '/calc.save/atomic_proj.xml', 'r')
-        cmd = 'grep -a -n Giannozzi ' + self.localtmp + '/pdos.log|tail -1'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        n = p.readline().decode('utf-8').split()[0].strip(':').strip()
-
-        cmd = 'tail -n +' + n + ' ' + self.localtmp + '/pdos.log|grep "state #"'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        # identify states from projwfc.x's stdout
-        states = []
-        for x in p.readlines():
-            y = x.split('atom')[1]
-            iatom = int(y.split()[0]) - 1
-            z = y.replace(')\n', '').split('=')
-            if y.find('m_j') < 0:
-                l = int(z[1].replace('m', ''))
-                m = int(z[2])
-                states.append([iatom, l, m])
-            else:
-                j = float(z[1].replace('l', ''))
-                l = int(z[2].replace('m_j', ''))
-                mj = float(z[3])
-                states.append([iatom, j, l, mj])
-
-        # read in projections from atomic_proj.xml
-        a = f.readline().decode('utf-8')
-        while a.find('<NUMBER_OF_B') < 0:
-            a = f.readline().decode('utf-8')
-        nbnd = int(f.readline().decode('utf-8').strip())
-        a = f.readline().decode('utf-8')
-        while a.find('<NUMBER_OF_K') < 0:
-            a = f.readline().decode('utf-8')
-        nkp = int(f.readline().decode('utf-8').strip())
-        a = f.readline().decode('utf-8')
-        while a.find('<NUMBER_OF_S') < 0:
-            a = f.readline().decode('utf-8')
-        spinpol = int(f.readline().decode('utf-8').strip()) == 2
-
-        if spinpol:
-            proj1 = []
-            proj2 = []
-            proj = proj1
-        else:
-            proj = []
-
-        while a.find('<ATM') < 0 and a != '':
-            a = f.readline().decode('utf-8')
-        if a == '':
-            raise RuntimeError('no projections found')
-
-        while True:
-            while a.find('<ATM') < 0 and a != '':
-                if spinpol and a.find('<SP') >= 0:
-                    if a.find('N.1') > 0:
-                        proj = proj1
-                    else:
-                        proj = proj2
-                a = f.readline().decode('utf-8')
-            if a == '':
-                break
-            pr = np.empty(nbnd, dtype=complex)
-            for i in range(nbnd):
-                b = f.readline().decode('utf-8').split(',')
-                pr[i] = float(b[0]) + 1j * float(b[1])
-            proj.append(pr)
-            a = f.readline().decode('utf-8')
-
-        f.close()
-
-        if spinpol:
-            projections = np.array([proj1, proj2])
-            return states, np.reshape(projections,
-                                      (2, nkp, len(proj1) / nkp, nbnd))
+            subdirs.remove(self.scratch + '/projtmp*')
+
+            return energies, self.__get_atomic_projections__(
+                projections_dtype, projections_file)
+
+    def __get_atomic_projections__(self, dtype=complex, mmapfile=None):
+        states = projwfc.read_states(self.localtmp + '/pdos.log')
+        projections = projwfc.read_atomic_proj(
+            self.scratch + '/calc.save/atomic_proj.xml', nproj=len(states),
+            dtype=dtype, mmapfile=mmapfile)
+        if projections.shape[0] == 2:
+            return states, projections
         else:
-            projections = np.array(proj)
-            return states, np.reshape(projections,
-                                      (nkp, len(proj) / nkp, nbnd))
+            return states, projections[0]
 
-    def get_eigenvalues(self, kpt=None, spin=None, efermi=None):
+    def get_bands(self):
+        """Eigenvalues, occupations and k-points of the last pw.x run
+        as a pwsave.Bands object (read once per state of calc.save)."""
         self.stop()
+        savedir = self.scratch + '/calc.save'
+        state = statefingerprint(savedir)
+        if self.bandcache is None or self.bandcache[0] != state:
+            self.bandcache = (state, pwsave.read_bands(savedir))
+        return self.bandcache[1]
+
+    def get_spin_index(self, spin):
+        if spin == 'up':
+            return 0
+        if spin == 'down':
+            return 1
+        return spin
 
-        if self.spinpol:
-            cmd = "grep -a eigenval1.xml " + self.scratch + "/calc.save/data-file.xml|tr '\"' ' '|awk '{print $(NF-1)}'"
-            p = Popen(cmd, shell=True, stdout=PIPE).stdout
-            kptdirs1 = [x.strip() for x in p.readlines()]
-
-            kptdirs1.sort()
-            cmd = "grep -a eigenval2.xml " + self.scratch + "/calc.save/data-file.xml|tr '\"' ' '|awk '{print $(NF-1)}'"
-            p = Popen(cmd, shell=True, stdout=PIPE).stdout
-            kptdirs2 = [x.strip() for x in p.readlines()]
-
-            kptdirs2.sort()
-            kptdirs = kptdirs1 + kptdirs2
-        else:
-            cmd = "grep -a eigenval.xml " + self.scratch + "/calc.save/data-file.xml|tr '\"' ' '|awk '{print $(NF-1)}'"
-            p = Popen(cmd, shell=True, stdout=PIPE).stdout
-            kptdirs = [x.strip() for x in p.readlines()]
-            kptdirs.sort()
-
-        nkp2 = len(kptdirs) / 2
-        if kpt is None:  # get eigenvalues at all k-points
-            if self.spinpol:
-                if spin == 'up' or spin == 0:
-                    kp = kptdirs[:nkp2]
-                if spin == 'down' or spin == 1:
-                    kp = kptdirs[nkp2:]
-                else:
-                    kp = kptdirs
-            else:
-                kp = kptdirs
-        else:  # get eigenvalues at specific k-point
-            if self.spinpol:
-                if spin == 'up' or spin == 0:
-                    kp = [kptdirs[kpt]]
-                if spin == 'down' or spin == 1:
-                    kp = [kptdirs[kpt + nkp2]]
-                else:
-                    kp = [kptdirs[kpt], kptdirs[kpt + nkp2 * 2]]
-            else:
-                kp = [kptdirs[kpt]]
-
-        if efermi is None:
-            ef = 0.
-        else:
-            ef = efermi
-
-        eig = []
-        for k in kp:
-            f = open(self.scratch + '/calc.save/' + k, 'r')
-            a = f.readline().decode('utf-8')
-            while a.upper().find('<EIG') < 0:
-                a = f.readline().decode('utf-8')
-            nbnd = int(a.split('"')[-2])
-            eig.append(Hartree * np.fromfile(
-                f, dtype=float, count=nbnd, sep=' ') - ef)
-            f.close()
-
-        spinall = spin not in ('up', 'down', 0, 1)
-        if kpt is not None and spinall:
-            return np.array(eig[0])
-        elif kpt is None and spinall and self.spinpol:
-            return np.reshape(np.array(eig), (2, nkp2, nbnd))
-        else:
-            return np.array(eig)
-
-    def read_3d_grid(self, stream, log):
+    def get_eigenvalues(self, kpt=None, spin=None, efermi=None):
+        """Eigenvalues (in eV, relative to efermi if given) at k-point
+        kpt or, if kpt is None, at all k-points. Without spin (None),
+        both spin channels are returned for spin-polarized calculations
+        (spin is then the first index). spin may be 0/'up' or 1/'down'.
+        """
+        eig = self.get_bands().eigenvalues
+        if efermi is not None:
+            eig = eig - efermi
+        spin = self.get_spin_index(spin)
+        if spin is None:
+            if len(eig) == 1:
+                eig = eig[0]
+            if kpt is None:
+                return eig.copy()
+            return eig[..., kpt, :].copy()
+        if kpt is None:
+            return eig[spin].copy()
+        return eig[spin, kpt].copy()
+
+    def get_occupation_numbers(self, kpt=0, spin=0):
+        """Occupations (at most 2 without and 1 with spin polarization)
+        of the bands at k-point kpt."""
+        return self.get_bands().occupations[self.get_spin_index(spin),
+                                            kpt].copy()
+
+    def get_k_point_weights(self):
+        return self.get_bands().weights.copy()
+
+    def read_3d_grid(self, stream, log, npyfile=None):
+        """Read a DATAGRID_3D block from pp.x's output stream and log the
+        surrounding output. Returns (origin,cell,data).
+        The values are converted in chunks of lines straight into a
+        preallocated (Fortran-ordered) array, or, if npyfile is given,
+        into a memory-mapped .npy file of that name.
+        """
         with open(self.localtmp + '/' + log, 'a') as f:
             x = stream.readline().decode('utf-8')
             while x != '' and x[:11] != 'DATAGRID_3D':
@@ -3346,23 +3858,139 @@ class espresso(Calculator):
             for i in range(3):
                 cell[i][:] = [float(_) for _ in stream.readline().split()]
 
-            data = []
-            ntotal = np.prod(n)
-            while len(data) < ntotal:
-                data += [float(_) for _ in stream.readline().split()]
-            data = np.reshape(data, n, order='F')
+            if npyfile is None:
+                data = np.empty(n, order='F')
+            else:
+                data = np.lib.format.open_memmap(
+                    npyfile, mode='w+', dtype=np.float64, shape=tuple(n),
+                    fortran_order=True)
+            flat = data.reshape(-1, order='F')
+            ntotal = flat.size
+            # the number of values per line tells how many lines are left,
+            # so nothing beyond the grid is consumed
+            chunk = np.fromstring(stream.readline(), sep=' ')
+            perline = max(len(chunk), 1)
+            i = 0
+            while True:
+                if i + len(chunk) > ntotal:
+                    raise RuntimeError('error reading 3D data grid')
+                flat[i:i + len(chunk)] = chunk
+                i += len(chunk)
+                if i >= ntotal:
+                    break
+                nlines = min(-(-(ntotal - i) // perline), 65536)
+                chunk = np.fromstring(
+                    b''.join(itertools.islice(stream, nlines)), sep=' ')
+                if len(chunk) == 0:
+                    raise RuntimeError('error reading 3D data grid')
 
             x = stream.readline().decode('utf-8')
             while x != '':
                 f.write(x)
                 x = stream.readline().decode('utf-8')
 
+        if npyfile is not None:
+            data.flush()
         return (origin, cell, data)
 
-    def extract_charge_density(self, spin='both'):
+    def extract_grid(self, inp, inputpp, log, npyfile=None, parallel=False,
+                     scale=None):
+        """Run pp.x with inputpp (unless the result is in the grid cache)
+        and read its 3D grid. The data is multiplied by scale if given.
+        Returns (origin,cell,data).
+        """
+        self.stop()
+        key = None
+        if self.gridcache is not None:
+            key = self.gridcache.key(('grid', inputpp, scale),
+                                     self.scratch + '/calc.save')
+            r = self.gridcache.get(key)
+            if r is not None:
+                origin, cell, data = r
+                if npyfile is None:
+                    data = data.copy()
+                else:
+                    x = np.lib.format.open_memmap(
+                        npyfile, mode='w+', dtype=np.float64,
+                        shape=data.shape, fortran_order=True)
+                    x[:] = data
+                    x.flush()
+                    data = x
+                return (origin.copy(), cell.copy(), data)
+        suffix = getattr(self.ppxthread, 'suffix', '')
+        if suffix:
+            # concurrent pp.x runs of extract_many need their own files
+            inp = os.path.splitext(inp)[0] + suffix + '.inp'
+            log = os.path.splitext(log)[0] + suffix + '.log'
+            filplot = 'tmp' + suffix + '.pp'
+            inputpp = list(inputpp) + [['filplot', filplot]]
+        p = self.run_ppx(inp, inputpp=inputpp, piperead=True,
+                         parallel=parallel)
+        origin, cell, data = self.read_3d_grid(p, log, npyfile)
+        p.close()
+        if suffix and os.path.exists(self.scratch + '/' + filplot):
+            os.remove(self.scratch + '/' + filplot)
+        if scale is not None:
+            data *= scale
+        if key is not None:
+            self.gridcache.put(key, (origin, cell, data))
+        return (origin, cell, data)
+
+    def extract_many(self, quantities, maxworkers=None):
+        """
+        Extracts several quantities with pp.x at once.
+        quantities is a list of (name, kwargs) pairs, where name is one of
+        the keys of ppx_quantities or the name of an extract_ method, and
+        kwargs are passed to that method, e.g.
+        calc.extract_many([('charge', {}), ('potential', {}),
+                           ('ildos', {'emin': -1.0})])
+        The serial pp.x runs are done concurrently by up to maxworkers
+        threads (default: number of cpus); runs using all MPI ranks
+        (wavefunction densities) follow one after another.
+        Returns a dictionary of the (origin,cell,data) tuples keyed by
+        name; names occurring more than once get their position in
+        quantities appended (e.g. 'ildos_2').
+        """
+        self.stop()
+        # bring the index up to date before threads query it
+        self.indexlog()
+        names = [x[0] for x in quantities]
+        jobs = []
+        for i, (name, kwargs) in enumerate(quantities):
+            method = getattr(self, ppx_quantities.get(name, name))
+            if names.count(name) > 1:
+                name = '%s_%d' % (name, i)
+            jobs.append((name, method, kwargs, i))
+
+        def run(job):
+            name, method, kwargs, i = job
+            self.ppxthread.suffix = '_many%d' % i
+            try:
+                return name, method(**kwargs)
+            finally:
+                self.ppxthread.suffix = ''
+
+        serial = [j for j in jobs
+                  if j[1].__name__ != 'extract_wavefunction_density']
+        parallel = [j for j in jobs if j not in serial]
+        if maxworkers is None:
+            maxworkers = multiprocessing.cpu_count()
+        results = {}
+        if serial:
+            nworkers = max(1, min(maxworkers, len(serial)))
+            with ThreadPoolExecutor(nworkers) as pool:
+                for name, r in pool.map(run, serial):
+                    results[name] = r
+        for job in parallel:
+            name, r = run(job)
+            results[name] = r
+        return results
+
+    def extract_charge_density(self, spin='both', npyfile=None):
         """
         Obtains the charge density as a numpy array after a DFT calculation.
         Returns (origin,cell,density).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
         if spin == 'both' or spin == 0:
             s = 0
@@ -3373,14 +4001,11 @@ class espresso(Calculator):
         else:
             raise ValueError('unknown spin component')
 
-        p = self.run_ppx(
+        return self.extract_grid(
             'charge.inp',
-            inputpp=[['plot_num', 0], ['spin_component', s]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'charge.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 0], ['spin_component', s]],
+            'charge.log',
+            npyfile)
 
     def xsf_charge_density(self, xsf, spin='both'):
         """
@@ -3403,10 +4028,11 @@ class espresso(Calculator):
             parallel=False,
             log='charge.log')
 
-    def extract_total_potential(self, spin='both'):
+    def extract_total_potential(self, spin='both', npyfile=None):
         """
         Obtains the total potential as a numpy array after a DFT calculation.
         Returns (origin,cell,potential).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
         if spin == 'both' or spin == 0:
             s = 0
@@ -3417,14 +4043,12 @@ class espresso(Calculator):
         else:
             raise ValueError('unknown spin component')
 
-        p = self.run_ppx(
+        return self.extract_grid(
             'totalpot.inp',
-            inputpp=[['plot_num', 1], ['spin_component', s]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'totalpot.log')
-        p.close()
-        return (origin, cell, data * Rydberg)
+            [['plot_num', 1], ['spin_component', s]],
+            'totalpot.log',
+            npyfile,
+            scale=Rydberg)
 
     def xsf_total_potential(self, xsf, spin='both'):
         """
@@ -3447,18 +4071,17 @@ class espresso(Calculator):
             parallel=False,
             log='totalpot.log')
 
-    def extract_local_ionic_potential(self):
+    def extract_local_ionic_potential(self, npyfile=None):
         """Obtains the local ionic potential as a numpy array after a DFT calculation.
         Returns (origin,cell,potential).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'vbare.inp',
-            inputpp=[['plot_num', 2]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'vbare.log')
-        p.close()
-        return (origin, cell, data * Rydberg)
+            [['plot_num', 2]],
+            'vbare.log',
+            npyfile,
+            scale=Rydberg)
 
     def xsf_local_ionic_potential(self, xsf):
         """
@@ -3472,18 +4095,16 @@ class espresso(Calculator):
             parallel=False,
             log='vbare.log')
 
-    def extract_local_dos_at_efermi(self):
+    def extract_local_dos_at_efermi(self, npyfile=None):
         """Obtains the local DOS at the Fermi level as a numpy array
         after a DFT calculation. Returns (origin,cell,ldos).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'ldosef.inp',
-            inputpp=[['plot_num', 3]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'ldosef.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 3]],
+            'ldosef.log',
+            npyfile)
 
     def xsf_local_dos_at_efermi(self, xsf):
         """
@@ -3497,18 +4118,16 @@ class espresso(Calculator):
             parallel=False,
             log='ldosef.log')
 
-    def extract_local_entropy_density(self):
+    def extract_local_entropy_density(self, npyfile=None):
         """Obtains the local entropy density as a numpy array after a
         DFT calculation. Returns (origin,cell,density).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'lentr.inp',
-            inputpp=[['plot_num', 4]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'lentr.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 4]],
+            'lentr.log',
+            npyfile)
 
     def xsf_local_entropy_density(self, xsf):
         """
@@ -3522,19 +4141,17 @@ class espresso(Calculator):
             parallel=False,
             log='lentr.log')
 
-    def extract_stm_data(self, bias):
+    def extract_stm_data(self, bias, npyfile=None):
         """
         Obtains STM data as a numpy array after a DFT calculation.
         Returns (origin,cell,stmdata).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'stm.inp',
-            inputpp=[['plot_num', 5], ['sample_bias', bias / Rydberg]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'stm.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 5], ['sample_bias', bias / Rydberg]],
+            'stm.log',
+            npyfile)
 
     def xsf_stm_data(self, xsf, bias):
         """
@@ -3548,18 +4165,16 @@ class espresso(Calculator):
             parallel=False,
             log='stm.log')
 
-    def extract_magnetization_density(self):
+    def extract_magnetization_density(self, npyfile=None):
         """Obtains the magnetization density as a numpy array after a
         DFT calculation. Returns (origin,cell,density).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'magdens.inp',
-            inputpp=[['plot_num', 6]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'magdens.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 6]],
+            'magdens.log',
+            npyfile)
 
     def xsf_magnetization_density(self, xsf):
         """
@@ -3577,9 +4192,10 @@ class espresso(Calculator):
                                      band,
                                      kpoint=0,
                                      spin='up',
-                                     gamma_with_sign=False):
+                                     gamma_with_sign=False, npyfile=None):
         """Obtains the amplitude of a given wave function as a numpy array after
         a DFT calculation. Returns (origin,cell,amplitude).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
         if spin == 'up' or spin == 1:
             s = 0
@@ -3596,10 +4212,8 @@ class espresso(Calculator):
         else:
             raise ValueError('unknown spin component')
         if self.spinpol:
-            cmd = 'grep -a "number of k points=" ' + self.log + '|tail -1|tr \'=\' \' \''
-            p = Popen(cmd, shell=True, stdout=PIPE).stdout
-            nkp = int(p.readline().decode('utf-8').split()[4])
-            kp = kpoint + nkp / 2 * s
+            nkp = self.indexlog().nkpts
+            kp = kpoint + nkp // 2 * s
         else:
             kp = kpoint
         inputpp = [['plot_num', 7], ['kpoint', kp], ['kband', band]]
@@ -3607,11 +4221,12 @@ class espresso(Calculator):
             inputpp.append(['lsign', '.true.'])
         if self.noncollinear:
             inputpp.append(['spin_component', s])
-        p = self.run_ppx(
-            'wfdens.inp', inputpp=inputpp, piperead=True, parallel=True)
-        origin, cell, data = self.read_3d_grid(p, 'wfdens.log')
-        p.close()
-        return (origin, cell, data)
+        return self.extract_grid(
+            'wfdens.inp',
+            inputpp,
+            'wfdens.log',
+            npyfile,
+            parallel=True)
 
     def xsf_wavefunction_density(self,
                                  xsf,
@@ -3638,10 +4253,8 @@ class espresso(Calculator):
         else:
             raise ValueError('unknown spin component')
         if self.spinpol:
-            cmd = 'grep -a "number of k points=" ' + self.log + '|tail -1|tr \'=\' \' \''
-            p = Popen(cmd, shell=True, stdout=PIPE).stdout
-            nkp = int(p.readline().decode('utf-8').split()[4])
-            kp = kpoint + nkp / 2 * s
+            nkp = self.indexlog().nkpts
+            kp = kpoint + nkp // 2 * s
         else:
             kp = kpoint
         inputpp = [['plot_num', 7], ['kpoint', kp], ['kband', band]]
@@ -3656,19 +4269,17 @@ class espresso(Calculator):
             parallel=True,
             log='wfdens.log')
 
-    def extract_electron_localization_function(self):
+    def extract_electron_localization_function(self, npyfile=None):
         """
         Obtains the ELF as a numpy array after a DFT calculation.
         Returns (origin,cell,elf).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'elf.inp',
-            inputpp=[['plot_num', 8]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'elf.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 8]],
+            'elf.log',
+            npyfile)
 
     def xsf_electron_localization_function(self, xsf):
         """
@@ -3682,18 +4293,16 @@ class espresso(Calculator):
             parallel=False,
             log='elf.log')
 
-    def extract_density_minus_atomic(self):
+    def extract_density_minus_atomic(self, npyfile=None):
         """Obtains the charge density minus atomic charges as a numpy array
         after a DFT calculation. Returns (origin,cell,density).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'dens_wo_atm.inp',
-            inputpp=[['plot_num', 9]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'dens_wo_atm.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 9]],
+            'dens_wo_atm.log',
+            npyfile)
 
     def xsf_density_minus_atomic(self, xsf):
         """
@@ -3707,10 +4316,12 @@ class espresso(Calculator):
             parallel=False,
             log='dens_wo_atm.log')
 
-    def extract_int_local_dos(self, spin='both', emin=None, emax=None):
+    def extract_int_local_dos(self, spin='both', emin=None, emax=None,
+                              npyfile=None):
         """
         Obtains the integrated ldos as a numpy array after a DFT calculation.
         Returns (origin,cell,ldos).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
         if spin == 'both' or spin == 0:
             s = 0
@@ -3728,11 +4339,7 @@ class espresso(Calculator):
         if emax is not None:
             inputpp.append(['emax', emax - efermi])
 
-        p = self.run_ppx(
-            'ildos.inp', inputpp=inputpp, piperead=True, parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'ildos.log')
-        p.close()
-        return (origin, cell, data)
+        return self.extract_grid('ildos.inp', inputpp, 'ildos.log', npyfile)
 
     def xsf_int_local_dos(self, xsf, spin='both', emin=None, emax=None):
         """
@@ -3762,18 +4369,17 @@ class espresso(Calculator):
             parallel=False,
             log='ildos.log')
 
-    def extract_ionic_and_hartree_potential(self):
+    def extract_ionic_and_hartree_potential(self, npyfile=None):
         """Obtains the sum of ionic and Hartree potential as a numpy array
         after a DFT calculation. Returns (origin,cell,potential).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'potih.inp',
-            inputpp=[['plot_num', 11]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'potih.log')
-        p.close()
-        return (origin, cell, data * Rydberg)
+            [['plot_num', 11]],
+            'potih.log',
+            npyfile,
+            scale=Rydberg)
 
     def xsf_ionic_and_hartree_potential(self, xsf):
         """
@@ -3787,18 +4393,17 @@ class espresso(Calculator):
             parallel=False,
             log='potih.log')
 
-    def extract_sawtooth_potential(self):
+    def extract_sawtooth_potential(self, npyfile=None):
         """Obtains the saw tooth potential as a numpy array
         after a DFT calculation. Returns (origin,cell,potential).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'sawtooth.inp',
-            inputpp=[['plot_num', 12]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'sawtooth.log')
-        p.close()
-        return (origin, cell, data * Rydberg)
+            [['plot_num', 12]],
+            'sawtooth.log',
+            npyfile,
+            scale=Rydberg)
 
     def xsf_sawtooth_potential(self, xsf):
         """
@@ -3812,9 +4417,10 @@ class espresso(Calculator):
             parallel=False,
             log='sawtooth.log')
 
-    def extract_noncollinear_magnetization(self, spin='all'):
+    def extract_noncollinear_magnetization(self, spin='all', npyfile=None):
         """Obtains the non-collinear magnetization as a numpy array
         after a DFT calculation. Returns (origin,cell,magnetization).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
         if spin == 'all' or spin == 'charge' or spin == 0:
             s = 0
@@ -3826,14 +4432,11 @@ class espresso(Calculator):
             s = 3
         else:
             raise ValueError('unknown spin component')
-        p = self.run_ppx(
+        return self.extract_grid(
             'noncollmag.inp',
-            inputpp=[['plot_num', 13], ['spin_component', s]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'noncollmag.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 13], ['spin_component', s]],
+            'noncollmag.log',
+            npyfile)
 
     def xsf_noncollinear_magnetization(self, xsf, spin='all'):
         """
@@ -3856,9 +4459,10 @@ class espresso(Calculator):
             plot=[['fileout', self.topath(xsf)]],
             parallel=False)
 
-    def extract_ae_charge_density(self, spin='both'):
+    def extract_ae_charge_density(self, spin='both', npyfile=None):
         """Obtains the all-electron (PAW) charge density as a numpy array
         after a DFT calculation. Returns (origin,cell,density)
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
         if spin == 'both' or spin == 0:
             s = 0
@@ -3869,14 +4473,11 @@ class espresso(Calculator):
         else:
             raise ValueError('unknown spin component')
 
-        p = self.run_ppx(
+        return self.extract_grid(
             'aecharge.inp',
-            inputpp=[['plot_num', 17], ['spin_component', s]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'aecharge.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 17], ['spin_component', s]],
+            'aecharge.log',
+            npyfile)
 
     def xsf_ae_charge_density(self, xsf, spin='both'):
         """
@@ -3899,18 +4500,16 @@ class espresso(Calculator):
             parallel=False,
             log='aecharge.log')
 
-    def extract_noncollinear_xcmag(self):
+    def extract_noncollinear_xcmag(self, npyfile=None):
         """Obtains the xc magnetic field for a non-collinear system as a numpy array
         after a DFT calculation. Returns (origin,cell,field).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'ncxcmag.inp',
-            inputpp=[['plot_num', 18]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'ncxcmag.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 18]],
+            'ncxcmag.log',
+            npyfile)
 
     def xsf_noncollinear_xcmag(self, xsf):
         """ Writes the xc magnetic field for a non-collinear system from
@@ -3923,18 +4522,16 @@ class espresso(Calculator):
             parallel=False,
             log='ncxcmag.log')
 
-    def extract_reduced_density_gradient(self):
+    def extract_reduced_density_gradient(self, npyfile=None):
         """Obtains the reduced density gradient as a numpy array after
         a DFT calculation. Returns (origin,cell,gradient).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'redgrad.inp',
-            inputpp=[['plot_num', 19]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'redgrad.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 19]],
+            'redgrad.log',
+            npyfile)
 
     def xsf_reduced_density_gradient(self, xsf):
         """
@@ -3948,18 +4545,16 @@ class espresso(Calculator):
             parallel=False,
             log='redgrad.log')
 
-    def extract_middle_density_hessian_eig(self):
+    def extract_middle_density_hessian_eig(self, npyfile=None):
         """Obtains the middle Hessian eigenvalue as a numpy array after
         a DFT calculation. Returns (origin,cell,density).
+        With npyfile, the data is written to that .npy file and memory-mapped.
         """
-        p = self.run_ppx(
+        return self.extract_grid(
             'mideig.inp',
-            inputpp=[['plot_num', 20]],
-            piperead=True,
-            parallel=False)
-        origin, cell, data = self.read_3d_grid(p, 'mideig.log')
-        p.close()
-        return (origin, cell, data)
+            [['plot_num', 20]],
+            'mideig.log',
+            npyfile)
 
     def xsf_middle_density_hessian_eig(self, xsf):
         """Writes the middle Hessian eigenvalue from a DFT calculation
@@ -3993,15 +4588,9 @@ class espresso(Calculator):
             return (position_array[max_diff_index] +
                     position_array[max_diff_index + 1]) / 2.
 
-    def get_work_function(self, pot_filename="pot.xsf", edir=3):
-        """Calculates the work function of a calculation by subtracting
-        the electrostatic potential of the vacuum (from averaging the
-        output of pp.x num_plot 11 in the z direction by default) from
-        the Fermi energy. Values used for average.x come from the espresso
-        example for work function for a surface.
-        """
-        self.update(self.atoms)
-        self.stop()
+    def average_potential(self, pot_filename="pot.xsf", edir=3):
+        """Run pp.x (num_plot 11) and average.x and return the array of
+        (position, planar average, macroscopic average) along edir."""
         self.run_ppx(
             'wf_pp.in',
             log='wf_pp.log',
@@ -4020,14 +4609,12 @@ class espresso(Calculator):
         print('3.835000000', file=f)
         print('', file=f)
         f.close()
-        call('cp ' + self.localtmp + '/avg.in ' + self.scratch, shell=True)
-        call('cd ' + self.scratch + ' ; ' + 'average.x < avg.in >>' +
-             self.localtmp + '/avg.out', shell=True)
-        call('cp ' + self.scratch + '/avg.dat ' + self.localtmp, shell=True)
+        shutil.copy(self.localtmp + '/avg.in', self.scratch)
+        with open(self.localtmp + '/avg.in') as f, \
+                open(self.localtmp + '/avg.out', 'a') as out:
+            call('average.x', cwd=self.scratch, stdin=f, stdout=out)
+        shutil.copy(self.scratch + '/avg.dat', self.localtmp)
 
-        # Pick a good place to sample vacuum level
-        cell_length = self.atoms.cell[edir - 1][edir - 1] / Bohr
-        vacuum_pos = self.find_max_empty_space(edir) * cell_length
         avg_out = open(self.localtmp + '/avg.dat', 'r')
         record = False
         average_data = []
@@ -4039,15 +4626,43 @@ class espresso(Calculator):
                 record = False
             if record:
                 average_data.append([float(i) for i in line.split()])
+        avg_out.close()
+        return np.array(average_data)
+
+    def get_work_function(self, pot_filename="pot.xsf", edir=3):
+        """Calculates the work function of a calculation by subtracting
+        the electrostatic potential of the vacuum (from averaging the
+        output of pp.x num_plot 11 in the z direction by default) from
+        the Fermi energy. Values used for average.x come from the espresso
+        example for work function for a surface.
+        """
+        self.update(self.atoms)
+        self.stop()
+        key = None
+        average_data = None
+        if self.gridcache is not None:
+            key = self.gridcache.key(('workfunction', pot_filename, edir),
+                                     self.scratch + '/calc.save')
+            r = self.gridcache.get(key)
+            if r is not None:
+                average_data = r[0]
+        if average_data is None:
+            average_data = self.average_potential(pot_filename, edir)
+            if key is not None:
+                self.gridcache.put(key, (average_data,))
+
+        # Pick a good place to sample vacuum level
+        cell_length = self.atoms.cell[edir - 1][edir - 1] / Bohr
+        vacuum_pos = self.find_max_empty_space(edir) * cell_length
         # [1] is planar average [2] is macroscopic average
         vacuum_energy = average_data[np.abs(
-            np.array(average_data)[..., 0] - vacuum_pos).argmin()][1]
+            average_data[..., 0] - vacuum_pos).argmin()][1]
 
         # Get the latest Fermi energy
-        cmd = 'grep -a -n "Fermi" ' + self.log + ' | tail -1'
-        fermi_data = Popen(cmd, shell=True, stdout=PIPE).stdout
-        fermi_energy = float(fermi_data.readline().decode('utf-8').split()[-2])
-        fermi_data.close()
+        fermi = self.indexlog().fermi
+        if fermi is None:
+            raise RuntimeError('no Fermi energy found in the log of pw.x')
+        fermi_energy = fermi[1]
 
         # if there's a dipole, we need to return 2 work functions - one for
         # either direction away from the slab
@@ -4059,10 +4674,8 @@ class espresso(Calculator):
             # to converge at that distance rather than *1 or *2
             vac_pos1 = (vacuum_pos - cell_length * eopreg * 2.5) % cell_length
             vac_pos2 = (vacuum_pos + cell_length * eopreg * 2.5) % cell_length
-            vac_index1 = np.abs(
-                np.array(average_data)[..., 0] - vac_pos1).argmin()
-            vac_index2 = np.abs(
-                np.array(average_data)[..., 0] - vac_pos2).argmin()
+            vac_index1 = np.abs(average_data[..., 0] - vac_pos1).argmin()
+            vac_index2 = np.abs(average_data[..., 0] - vac_pos2).argmin()
             vacuum_energy1 = average_data[vac_index1][1]
             vacuum_energy2 = average_data[vac_index2][1]
             wf = [
@@ -4118,36 +4731,17 @@ class espresso(Calculator):
         """Get number of steps for convered scf. Returns an array.
         Option 'all' gives all numbers of steps in log,
         not only for the latest scf."""
-        if all:
-            tail = 'tail'
-        else:
-            tail = 'tail -1'
-        cmd = 'grep -a "convergence has been achieved in" ' + self.log + ' | ' + tail
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s = p.readlines()
-
-        if not all:
-            assert len(s) < 2
-        if len(s) == 0:
+        steps = self.indexlog().scf_steps
+        if len(steps) == 0:
             return None
+        elif all:
+            return list(steps)
         else:
-            out = []
-            for s_ in s:
-                tmp = s_.split('in')
-                out.append(int(tmp[-1].split('iterations')[0]))
-            return out
+            return [steps[-1]]
 
     def get_number_of_bfgs_steps(self):
         """Get total number of internal BFGS steps."""
-        cmd = 'grep -a "bfgs converged in" ' + self.log + ' | tail -1'
-        p = Popen(cmd, shell=True, stdout=PIPE).stdout
-        s = p.readlines()
-        assert len(s) < 2
-        if len(s) == 0:
-            return None
-        else:
-            tmp = s[0].split('and')
-            return int(tmp[-1].split('bfgs')[0])
+        return self.indexlog().bfgs_steps
 
     def get_forces(self, atoms):
         self.update(atoms)
@@ -4155,3 +4749,11 @@ class espresso(Calculator):
             return self.forces.copy()
         else:
             return self.forces
+
+    async def aget_forces(self, atoms):
+        """Coroutine version of get_forces (see aget_potential_energy)."""
+        await self.aupdate(atoms)
+        if self.newforcearray:
+            return self.forces.copy()
+        else:
+            return self.forces
@@ -0,0 +1,167 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# tar archives of scratch directories streamed through
+# (multi-threaded) compression codecs
+
+import glob
+import gzip
+import multiprocessing
+import os
+import tarfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class ParallelGzipWriter:
+    """
+    File-like object compressing the data written to it in blocks of
+    blocksize bytes on a pool of threads. Each block becomes a gzip
+    member of its own, so the output is a valid gzip file (readable by
+    gzip, tar and python's gzip module).
+    """
+
+    def __init__(self, fileobj, level=6, threads=None,
+                 blocksize=4 * 1024**2):
+        self.fileobj = fileobj
+        self.level = level
+        self.blocksize = blocksize
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        self.threads = max(threads, 1)
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buf = bytearray()
+
+    def compress(self, block):
+        # zlib releases the GIL while compressing
+        c = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return c.compress(block) + c.flush()
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.blocksize:
+            block = bytes(self.buf[:self.blocksize])
+            del self.buf[:self.blocksize]
+            self.pending.append(self.executor.submit(self.compress, block))
+            # bound the memory held by blocks in flight
+            while len(self.pending) > 2 * self.threads:
+                self.fileobj.write(self.pending.popleft().result())
+        return len(data)
+
+    def close(self):
+        if self.buf:
+            self.pending.append(self.executor.submit(self.compress,
+                                                     bytes(self.buf)))
+            self.buf = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+
+def gzwriter(fileobj, level, threads):
+    return ParallelGzipWriter(fileobj, 6 if level is None else level,
+                              threads)
+
+
+def zstdwriter(fileobj, level, threads):
+    if threads is None:
+        threads = -1
+    c = zstandard.ZstdCompressor(level=3 if level is None else level,
+                                 threads=threads)
+    return c.stream_writer(fileobj, closefd=False)
+
+
+# codecs for writing archives: name -> function returning a file-like
+# object compressing into fileobj (None: uncompressed tar)
+codecs = {'gz': gzwriter, 'zst': zstdwriter, 'none': None}
+
+# codecs chosen by file name extension if none is given explicitly
+extensions = [('.tar.zst', 'zst'), ('.tzst', 'zst'), ('.tar', 'none')]
+
+
+def codecfor(filename):
+    for ext, codec in extensions:
+        if filename.endswith(ext):
+            return codec
+    return 'gz'
+
+
+def write(filename, directory, members, exclude=(), codec=None,
+          level=None, threads=None):
+    """
+    Write the members (paths relative to directory; patterns like
+    'calc.save/magnetization.*' are expanded) as a tar archive to
+    filename, skipping anything with a path component in exclude.
+    The tar stream is compressed with codec ('gz': block-parallel gzip,
+    'zst': multi-threaded zstd, 'none': uncompressed), chosen by the
+    extension of filename if None. threads defaults to all cpus.
+    """
+    if codec is None:
+        codec = codecfor(filename)
+    if codec not in codecs:
+        raise ValueError('unknown archive codec %r' % codec)
+    if codec == 'zst' and zstandard is None:
+        raise ImportError('the zstd codec requires the zstandard module')
+
+    def skip(info):
+        if any(x in exclude for x in info.name.split('/')):
+            return None
+        return info
+
+    with open(filename, 'wb') as f:
+        if codecs[codec] is None:
+            out = f
+        else:
+            out = codecs[codec](f, level, threads)
+        try:
+            with tarfile.open(fileobj=out, mode='w|') as tar:
+                for x in members:
+                    paths = glob.glob(os.path.join(directory, x))
+                    for path in sorted(paths):
+                        tar.add(path, arcname=os.path.relpath(path,
+                                                              directory),
+                                filter=skip)
+        finally:
+            if out is not f:
+                out.close()
+
+
+def reader(f):
+    """Decompressing file-like object for the archive f, whose format
+    is detected from its first bytes."""
+    magic = f.read(4)
+    f.seek(0)
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if magic == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError(
+                'reading zstd archives requires the zstandard module')
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    return f
+
+
+def extract(filename, directory):
+    """Extract the (gzip, zstd or uncompressed) tar archive filename
+    into directory, streaming it."""
+    with open(filename, 'rb') as f:
+        with tarfile.open(fileobj=reader(f), mode='r|') as tar:
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(directory, filter='tar')
+            else:
+                tar.extractall(directory)
@@ -0,0 +1,272 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# content-addressed store of deduplicated file chunks, holding named
+# snapshots of (parts of) scratch directories
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# random 64 bit values for each byte value, summed over a sliding
+# window to find content-defined chunk boundaries
+_GEAR = np.random.RandomState(20130).randint(
+    0, 2**63, size=256, dtype=np.int64).astype(np.uint64)
+
+_WINDOW = 48
+
+
+def chunkboundaries(data, minsize, maxsize, mask, final):
+    """Ends of the content-defined chunks in the bytes data. A chunk
+    ends where the sum of _GEAR over the last _WINDOW bytes has all
+    bits of mask cleared, but not before minsize and at most after
+    maxsize bytes. Unless final, the trailing partial chunk is left
+    out (it may still grow)."""
+    n = len(data)
+    cuts = []
+    if n > _WINDOW:
+        c = np.cumsum(_GEAR[np.frombuffer(data, dtype=np.uint8)])
+        hit = ((c[_WINDOW:] - c[:-_WINDOW]) & np.uint64(mask)) == 0
+        candidates = np.nonzero(hit)[0] + _WINDOW + 1
+    else:
+        candidates = np.zeros(0, dtype=int)
+    pos = 0
+    while True:
+        i = np.searchsorted(candidates, pos + minsize)
+        if i < len(candidates) and candidates[i] - pos <= maxsize:
+            pos = int(candidates[i])
+        elif n - pos >= maxsize:
+            pos += maxsize
+        else:
+            break
+        cuts.append(pos)
+    if final and pos < n:
+        cuts.append(n)
+    return cuts
+
+
+class ChunkStore:
+    """
+    Deduplicating store under the directory root. Files are split into
+    content-defined chunks (about avgsize bytes on average), which are
+    stored once under their SHA-256 in root/chunks (zlib compressed if
+    level > 0) and reference counted in root/store.db, together with
+    the manifests of the named snapshots. Chunks no longer referenced
+    by any snapshot are deleted by gc. A ChunkStore can be shared by
+    several threads.
+    """
+
+    def __init__(self, root, avgsize=1024**2, minsize=64 * 1024,
+                 maxsize=8 * 1024**2, level=1, timeout=600.):
+        self.root = root
+        self.chunkdir = os.path.join(root, 'chunks')
+        if not os.path.isdir(self.chunkdir):
+            os.makedirs(self.chunkdir, exist_ok=True)
+        self.mask = 2**int(np.log2(avgsize)) - 1
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.level = level
+        self.db = sqlite3.connect(os.path.join(root, 'store.db'),
+                                  timeout=timeout, isolation_level=None,
+                                  check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            'hash TEXT PRIMARY KEY, refs INTEGER)')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'name TEXT PRIMARY KEY, manifest TEXT, time REAL)')
+
+    def chunkpath(self, h):
+        return os.path.join(self.chunkdir, h[:2], h[2:])
+
+    def writechunk(self, data):
+        """Store the chunk data unless present; returns its hash."""
+        h = hashlib.sha256(data).hexdigest()
+        path = self.chunkpath(h)
+        if os.path.exists(path):
+            # protect the chunk from a concurrent gc
+            os.utime(path)
+            return h
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+        if self.level > 0:
+            data = b'z' + zlib.compress(data, self.level)
+        else:
+            data = b'r' + data
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return h
+
+    def readchunk(self, h):
+        with open(self.chunkpath(h), 'rb') as f:
+            data = f.read()
+        if data[:1] == b'z':
+            return zlib.decompress(data[1:])
+        return data[1:]
+
+    def writefile(self, path, blocksize=16 * 1024**2):
+        """Split the file path into chunks and store them. Returns the
+        list of chunk hashes."""
+        hashes = []
+        pending = b''
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(blocksize)
+                data = pending + block
+                final = len(block) == 0
+                start = 0
+                for end in chunkboundaries(data, self.minsize, self.maxsize,
+                                           self.mask, final):
+                    hashes.append(self.writechunk(data[start:end]))
+                    start = end
+                pending = data[start:]
+                if final:
+                    return hashes
+
+    def put(self, name, directory, members, exclude=()):
+        """Store the members of directory (relative paths or glob
+        patterns, as in archive.write) as snapshot name, replacing an
+        existing snapshot of that name."""
+        entries = []
+
+        def addfile(p):
+            entries.append({'path': os.path.relpath(p, directory),
+                            'mode': os.stat(p).st_mode & 0o7777,
+                            'chunks': self.writefile(p)})
+
+        for x in members:
+            for path in sorted(glob.glob(os.path.join(directory, x))):
+                if os.path.basename(path) in exclude:
+                    continue
+                if not os.path.isdir(path):
+                    addfile(path)
+                    continue
+                for root, dirs, files in os.walk(path):
+                    dirs[:] = sorted(d for d in dirs if d not in exclude)
+                    entries.append({'path': os.path.relpath(root, directory),
+                                    'dir': True})
+                    for fname in sorted(files):
+                        if fname not in exclude:
+                            addfile(os.path.join(root, fname))
+        refs = [h for e in entries for h in e.get('chunks', [])]
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                old = db.execute('SELECT manifest FROM snapshots WHERE name=?',
+                                 (name,)).fetchone()
+                for h in refs:
+                    db.execute('INSERT OR IGNORE INTO chunks VALUES (?,0)',
+                               (h,))
+                    db.execute('UPDATE chunks SET refs=refs+1 WHERE hash=?',
+                               (h,))
+                if old is not None:
+                    self.release(json.loads(old[0]))
+                db.execute('INSERT OR REPLACE INTO snapshots VALUES (?,?,?)',
+                           (name, json.dumps(entries), time.time()))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def release(self, entries):
+        for e in entries:
+            for h in e.get('chunks', []):
+                self.db.execute('UPDATE chunks SET refs=refs-1 WHERE hash=?',
+                                (h,))
+
+    def __contains__(self, name):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM snapshots WHERE name=?',
+                                   (name,)).fetchone() is not None
+
+    def names(self):
+        with self.lock:
+            return [x[0] for x in self.db.execute(
+                'SELECT name FROM snapshots ORDER BY time')]
+
+    def get(self, name, directory):
+        """Restore snapshot name into directory."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT manifest FROM snapshots WHERE name=?',
+                (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        for e in json.loads(row[0]):
+            path = os.path.join(directory, e['path'])
+            if e.get('dir'):
+                if not os.path.isdir(path):
+                    os.makedirs(path, exist_ok=True)
+                continue
+            d = os.path.dirname(path)
+            if not os.path.isdir(d):
+                os.makedirs(d, exist_ok=True)
+            with open(path, 'wb') as f:
+                for h in e['chunks']:
+                    f.write(self.readchunk(h))
+            os.chmod(path, e['mode'])
+
+    def delete(self, name):
+        """Remove snapshot name (its chunks are freed by gc)."""
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT manifest FROM snapshots WHERE name=?',
+                                 (name,)).fetchone()
+                if row is not None:
+                    self.release(json.loads(row[0]))
+                    db.execute('DELETE FROM snapshots WHERE name=?', (name,))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def gc(self, grace=3600.):
+        """Delete unreferenced chunks not used within the last grace
+        seconds (so snapshots being written concurrently keep theirs).
+        Returns the number of bytes freed."""
+        freed = 0
+        now = time.time()
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for (h,) in db.execute(
+                        'SELECT hash FROM chunks WHERE refs<=0').fetchall():
+                    path = self.chunkpath(h)
+                    try:
+                        st = os.stat(path)
+                        if now - st.st_mtime < grace:
+                            continue
+                        os.remove(path)
+                        freed += st.st_size
+                    except OSError:
+                        pass
+                    db.execute('DELETE FROM chunks WHERE hash=?', (h,))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return freed
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,122 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# cache of quantities extracted with pp.x
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def statefingerprint(savedir):
+    """Fingerprint of the state written by pw.x to savedir (name, size
+    and modification time of all files), or None if there is none."""
+    h = hashlib.sha1()
+    found = False
+    for root, dirs, files in os.walk(savedir):
+        dirs.sort()
+        for name in sorted(files):
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            h.update(('%s/%s %d %d\n' % (root, name, st.st_size,
+                                         st.st_mtime_ns)).encode())
+            found = True
+    if not found:
+        return None
+    return h.hexdigest()
+
+
+class GridCache:
+    """
+    Least recently used cache of tuples of numpy arrays (e.g. the
+    (origin,cell,data) tuples read from pp.x), limited to maxsize bytes.
+    If directory is given, entries are also stored there as compressed
+    .npz files and found again by later calculators.
+    """
+
+    def __init__(self, maxsize=256 * 1024**2, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def key(self, params, savedir):
+        """Key for the pp.x parameters params (any repr-able object) and
+        the state in savedir. Returns None if there is no saved state."""
+        state = statefingerprint(savedir)
+        if state is None:
+            return None
+        return hashlib.sha1((repr(params) + state).encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """Return the tuple of arrays stored under key or None."""
+        with self.lock:
+            arrays = self.entries.get(key)
+            if arrays is not None:
+                self.entries.move_to_end(key)
+                return arrays
+        if self.directory is not None:
+            try:
+                with np.load(self.filename(key)) as f:
+                    arrays = tuple(f['arr_%d' % i]
+                                   for i in range(len(f.files)))
+            except (IOError, ValueError, KeyError):
+                return None
+            self.add(key, arrays)
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a copy of the tuple of arrays under key. Tuples with
+        memory-mapped arrays (np.memmap) are only stored in directory,
+        as their files may be changed or overwritten later."""
+        arrays = tuple(np.asanyarray(a) for a in arrays)
+        if (any(isinstance(a, np.memmap) for a in arrays) or
+                sum(a.nbytes for a in arrays) > self.maxsize):
+            self.remove(key)
+        else:
+            self.add(key, tuple(np.array(a) for a in arrays))
+        if self.directory is not None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, exist_ok=True)
+            # write under a temporary name, so readers never see
+            # a partial file
+            tmp = self.filename(key + '.%d' % os.getpid())
+            np.savez_compressed(tmp, *arrays)
+            os.replace(tmp, self.filename(key))
+
+    def add(self, key, arrays):
+        nbytes = sum(a.nbytes for a in arrays)
+        with self.lock:
+            if key in self.entries:
+                self.size -= sum(a.nbytes for a in self.entries.pop(key))
+            if nbytes > self.maxsize:
+                return
+            self.entries[key] = arrays
+            self.size += nbytes
+            while self.size > self.maxsize:
+                k, old = self.entries.popitem(last=False)
+                self.size -= sum(a.nbytes for a in old)
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= sum(a.nbytes for a in self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -6,8 +6,10 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 #****************************************************************************
 
+import selectors
+
 from espresso import espresso, KohnShamConvergenceError
-from sys import stderr
+from espresso import pwparser
 
 # keep track of ourselves so we can automatically stop us
 # when a new multi-espresso object is created
@@ -38,6 +40,8 @@ class multiespresso:
 
         arg = kwargs.copy()
         arg['single_calculator'] = False
+        # output is multiplexed by wait_for_total_energies
+        arg['drainoutput'] = False
         arg['numcalcs'] = ncalc
         self.ncalc = ncalc
         self.outdirprefix = outdirprefix
@@ -53,39 +57,66 @@ class multiespresso:
             espressos.append(esp)
 
     def wait_for_total_energies(self):
+        """
+        Wait until all calculators needing a recalculation have
+        produced their energies and forces. The output of all pw.x
+        processes is multiplexed with a selector, so progress of every
+        image is parsed as soon as it is written.
+        """
         s = open(self.mtxt, 'a')
         for i in range(self.ncalc):
             self.calculators[i].init_only(self.images[i])
             self.done[i] = False
-        notdone = True
-        while notdone:
-            notdone = False
-            for i in range(self.ncalc):
-                if self.calculators[i].recalculate:
-                    if not self.done[i]:
-                        a = self.calculators[i].cerr.readline()
-                        notdone |= (a != '' and a[:17] != '!    total energy')
-                        if a[:13] == '     stopping':
-                            raise RuntimeError(
-                                'problem with calculator #%d' % i)
-                        elif a[:20] == '     convergence NOT':
-                            raise KohnShamConvergenceError(
-                                'calculator #%d did not converge' % i)
-                        elif a[1:17] != '    total energy':
-                            stderr.write(a)
-                        else:
-                            if a[0] != '!':
-                                self.done[i] = False
-                                print('current free energy (calc. %3d; in scf cycle) :' % i, a.split(
-                                )[-2], 'Ry', file=s)
-                            else:
-                                self.done[i] = True
-                                print('current free energy (calc. %3d; ionic step) :  ' % i, a.split(
-                                )[-2], 'Ry', file=s)
-                            s.flush()
+        sel = selectors.DefaultSelector()
+        for i in range(self.ncalc):
+            calc = self.calculators[i]
+            if calc.recalculate:
+                # events queued by previous reads come first
+                for ev in list(calc.parser.events):
+                    self.process_event(i, ev, s)
+                if not self.done[i]:
+                    sel.register(calc.parser, selectors.EVENT_READ, i)
+        while sel.get_map():
+            for key, mask in sel.select():
+                i = key.data
+                for ev in key.fileobj.read_available():
+                    self.process_event(i, ev, s)
+                if self.done[i]:
+                    sel.unregister(key.fileobj)
+        sel.close()
         print('', file=s)
         s.close()
 
+    def process_event(self, i, ev, s):
+        """
+        Report the progress of calculator i and mark it done once
+        the event its read will stop at is queued. Events are left in
+        the parser's queue for the calculator's read.
+        """
+        calc = self.calculators[i]
+        if ev.kind == pwparser.STOPPING:
+            raise RuntimeError('problem with calculator #%d' % i)
+        elif ev.kind == pwparser.NOT_CONVERGED:
+            raise KohnShamConvergenceError(
+                'calculator #%d did not converge' % i)
+        elif ev.kind == pwparser.SCF_ENERGY:
+            print('current free energy (calc. %3d; in scf cycle) :' % i,
+                  '%.8f' % ev.value, 'Ry', file=s)
+            s.flush()
+        elif ev.kind == pwparser.TOTAL_ENERGY:
+            print('current free energy (calc. %3d; ionic step) :  ' % i,
+                  '%.8f' % ev.value, 'Ry', file=s)
+            s.flush()
+            if calc.dontcalcforces and calc.ion_dynamics != 'ase3':
+                self.done[i] = True
+        elif ev.kind == pwparser.ASE_FORCES:
+            self.done[i] = True
+        elif ev.kind == pwparser.FORCES:
+            if calc.ion_dynamics != 'ase3' or calc.calculation == 'scf':
+                self.done[i] = True
+        elif ev.kind == pwparser.EOF:
+            self.done[i] = True
+
     def set_images(self, images):
         if len(images) != self.ncalc:
             raise ValueError(
@@ -0,0 +1,373 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# readers for the output of projwfc.x
+
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from ase.units import Rydberg, Hartree
+
+from . import pwparser
+
+
+def read_states(log, wfc=False):
+    """Identify the atomic states from the stdout of the latest
+    projwfc.x run in log. Returns a list of [iatom,l,m] or,
+    with spin-orbit coupling, [iatom,j,l,m_j]. If wfc is True,
+    the index of the atomic wavefunction is appended to each state."""
+    index = pwparser.LogIndex(log)
+    index.update()
+    states = []
+    with open(log, 'rb') as f:
+        if index.header is not None:
+            f.seek(index.header)
+        for x in f:
+            if x.find(b'state #') < 0:
+                continue
+            y = x.decode('utf-8').split('atom')[1]
+            iatom = int(y.split()[0]) - 1
+            z = y.replace(')\n', '').split('=')
+            if y.find('m_j') < 0:
+                l = int(z[1].replace('m', ''))
+                m = int(z[2])
+                states.append([iatom, l, m])
+            else:
+                j = float(z[1].replace('l', ''))
+                l = int(z[2].replace('m_j', ''))
+                mj = float(z[3])
+                states.append([iatom, j, l, mj])
+            if wfc:
+                states[-1].append(int(y.split('wfc')[1].split()[0]))
+    return states
+
+
+def read_atomic_proj(filename, nproj=None, dtype=complex, mmapfile=None):
+    """
+    Read the projections of the Kohn-Sham states onto the atomic
+    wavefunctions from projwfc.x's atomic_proj.xml.
+    Returns an array of shape (nspin,nkp,nproj,nbnd) filled block by
+    block while the file is streamed. dtype may be complex64 to halve
+    the memory needed; if mmapfile is given, the array is a memory-mapped
+    .npy file of that name. nproj is only needed if the file does not
+    state the number of atomic wavefunctions.
+    """
+    with open(filename, 'rb') as f:
+        nbnd = nkp = None
+        nspin = 1
+        for a in f:
+            a = a.lstrip()
+            if a.startswith(b'<NUMBER_OF_BANDS'):
+                nbnd = int(next(f))
+            elif a.startswith(b'<NUMBER_OF_K-POINTS'):
+                nkp = int(next(f))
+            elif a.startswith(b'<NUMBER_OF_SPIN_COMPONENTS'):
+                if int(next(f)) == 2:
+                    nspin = 2
+            elif a.startswith(b'<NUMBER_OF_ATOMIC_WFC'):
+                nproj = int(next(f))
+            elif a.startswith(b'<PROJECTIONS'):
+                break
+        if nbnd is None or nkp is None or nproj is None:
+            raise RuntimeError('no projections found')
+
+        shape = (nspin, nkp, nproj, nbnd)
+        if mmapfile is None:
+            proj = np.zeros(shape, dtype=dtype)
+        else:
+            proj = np.lib.format.open_memmap(mmapfile, mode='w+',
+                                             dtype=dtype, shape=shape)
+
+        ik = 0
+        ispin = 0
+        iproj = 0
+        found = False
+        for a in f:
+            a = a.lstrip()
+            if a.startswith(b'<ATMWFC'):
+                # nbnd lines of 're,im'
+                x = np.fromstring(
+                    b''.join(itertools.islice(f, nbnd)).replace(b',', b' '),
+                    sep=' ')
+                proj[ispin, ik, iproj].real = x[0::2]
+                proj[ispin, ik, iproj].imag = x[1::2]
+                iproj += 1
+                found = True
+            elif a.startswith(b'<K-POINT.'):
+                ik = int(a[9:a.index(b'>')]) - 1
+                iproj = 0
+            elif a.startswith(b'<SPIN.'):
+                ispin = int(a[6:a.index(b'>')]) - 1
+                iproj = 0
+        if not found:
+            raise RuntimeError('no projections found')
+
+    if mmapfile is not None:
+        proj.flush()
+    return proj
+
+
+# angular momentum of the PDOS channels
+_CHANNELS = {'s': 0, 'p': 1, 'd': 2, 'f': 3}
+
+
+def read_pdos_file(filename):
+    """Read one of projwfc.x's PDOS files into an array of its columns
+    (energy, ldos, pdos components)."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'#'):
+        data = data[data.find(b'\n') + 1:]
+    ncol = len(data[:data.find(b'\n')].split())
+    return np.fromstring(data, sep=' ').reshape(-1, ncol)
+
+
+def parse_pdos_filename(filename):
+    """Returns the atom index and the channel (e.g. 'p' or 'p,j=1.5')
+    of a PDOS file named like calc.pdos_atm#1(H)_wfc#1(s)."""
+    spl = filename.split('#')
+    iatom = int(spl[1].split('(')[0]) - 1
+    channel = spl[2].split('(')[1].rstrip(')').replace('_j', ',j=')
+    return iatom, channel
+
+
+def channel_components(channel, nspin):
+    """Number of PDOS components (m summed up and m resolved)."""
+    jpos = channel.find('j=')
+    if jpos < 0:
+        # ncomponents = 2*l+1 +1  (latter for m summed up)
+        return (2 * _CHANNELS[channel[0]] + 2) * nspin
+    else:
+        # ncomponents = 2*j+1 +1  (latter for m summed up)
+        return int(2. * float(channel[jpos + 2:])) + 2
+
+
+class PDOSCube:
+    """
+    Projected DOS of all atoms in one contiguous array data, indexed by
+    (atom, channel, component, energy). channels lists the channel labels
+    ('s','p',... or e.g. 'p,j=0.5'), channelindex maps them to the second
+    index and ncomponents to their number of (m summed up, m/spin
+    resolved) components; unused entries are zero. present tells which
+    (atom, channel) pairs have projections.
+    """
+
+    def __init__(self, natoms, channels, nspin, npoints):
+        self.channels = channels
+        self.channelindex = dict((c, i) for i, c in enumerate(channels))
+        self.ncomponents = dict((c, channel_components(c, nspin))
+                                for c in channels)
+        ncomp = max(self.ncomponents.values()) if channels else 0
+        self.data = np.zeros((natoms, len(channels), ncomp, npoints))
+        self.present = np.zeros((natoms, len(channels)), dtype=bool)
+
+    def get(self, iatom, channel):
+        """Array of the components of channel of atom iatom (a view)."""
+        return self.data[iatom, self.channelindex[channel],
+                         :self.ncomponents[channel]]
+
+    def todicts(self):
+        """List (index: atom) of dictionaries of channel arrays, all views
+        into data."""
+        pdos = [{} for i in range(len(self.data))]
+        for iatom, c in zip(*np.nonzero(self.present)):
+            channel = self.channels[c]
+            pdos[iatom][channel] = self.get(iatom, channel)
+        return pdos
+
+
+def load_pdos(directory, natoms, nspin, prefix='calc',
+              add_higher_channels=True, maxworkers=None):
+    """
+    Read all PDOS files prefix.pdos_atm* in directory with a pool of
+    threads and collect them in a PDOSCube. Projections onto several
+    wavefunctions of the same channel of an atom are summed up if
+    add_higher_channels is True; otherwise only the first one is kept.
+    """
+    names = sorted(x for x in os.listdir(directory)
+                   if x.startswith(prefix + '.pdos_atm'))
+    labels = [parse_pdos_filename(x) for x in names]
+    channels = sorted(set(x[1] for x in labels),
+                      key=lambda c: (_CHANNELS[c[0]], c))
+    files = [os.path.join(directory, x) for x in names]
+    if maxworkers is None:
+        maxworkers = min(32, multiprocessing.cpu_count() + 4)
+    with ThreadPoolExecutor(max(1, maxworkers)) as pool:
+        arrays = pool.map(read_pdos_file, files)
+        cube = None
+        for (iatom, channel), pdosinp in zip(labels, arrays):
+            if cube is None:
+                cube = PDOSCube(natoms, channels, nspin, len(pdosinp))
+            c = cube.channelindex[channel]
+            if add_higher_channels or not cube.present[iatom, c]:
+                n = cube.ncomponents[channel]
+                cube.data[iatom, c, :n] += pdosinp[:, 1:n + 1].T
+                cube.present[iatom, c] = True
+    if cube is None:
+        cube = PDOSCube(natoms, [], nspin, 0)
+    return cube
+
+
+def read_values(f, n):
+    """Read lines of f until n numbers have been collected."""
+    x = []
+    while len(x) < n:
+        line = next(f)
+        x.extend(np.fromstring(line.replace(b',', b' '), sep=' '))
+    return np.array(x[:n])
+
+
+def read_eigenvalues(filename):
+    """Read the k-point weights (normalized to the number of electrons
+    per band and spin channel, i.e. 2 without and 1 with spin
+    polarization) and the eigenvalues in eV, indexed (spin,k,band),
+    from projwfc.x's atomic_proj.xml."""
+    with open(filename, 'rb') as f:
+        nbnd = nkp = None
+        nspin = 1
+        unit = Rydberg
+        ik = 0
+        for a in f:
+            a = a.lstrip()
+            if a.startswith(b'<NUMBER_OF_BANDS'):
+                nbnd = int(next(f))
+            elif a.startswith(b'<NUMBER_OF_K-POINTS'):
+                nkp = int(next(f))
+            elif a.startswith(b'<NUMBER_OF_SPIN_COMPONENTS'):
+                if int(next(f)) == 2:
+                    nspin = 2
+            elif a.startswith(b'<UNITS_FOR_ENERGY'):
+                if a.find(b'Hartree') >= 0:
+                    unit = Hartree
+                elif a.find(b'eV') >= 0:
+                    unit = 1.0
+            elif a.startswith(b'<WEIGHT_OF_K-POINTS'):
+                wk = read_values(f, nkp)
+            elif a.startswith(b'<EIGENVALUES'):
+                eig = np.empty((nspin, nkp, nbnd))
+            elif a.startswith(b'<K-POINT.'):
+                ik = int(a[9:a.index(b'>')]) - 1
+            elif a.startswith(b'<EIG.'):
+                eig[int(a[5:6]) - 1, ik] = read_values(f, nbnd)
+            elif a.startswith(b'<EIG'):
+                eig[0, ik] = read_values(f, nbnd)
+            elif a.startswith(b'</EIGENVALUES') or a.startswith(
+                    b'<PROJECTIONS'):
+                break
+    wk = wk * (2.0 / nspin / np.sum(wk))
+    return wk, eig * unit
+
+
+def w0gauss(x, ngauss):
+    """Broadening function of QE's w0gauss: Gaussian (ngauss=0),
+    Methfessel-Paxton of order ngauss > 0, Marzari-Vanderbilt cold
+    smearing (-1) or the derivative of the Fermi-Dirac function (-99)."""
+    if ngauss == -99:
+        x = np.minimum(np.abs(x), 200.0)
+        return 1.0 / (2.0 + np.exp(-x) + np.exp(x))
+    sqrtpm1 = 1.0 / np.sqrt(np.pi)
+    if ngauss == -1:
+        arg = np.minimum((x - 1.0 / np.sqrt(2.0))**2, 200.0)
+        return sqrtpm1 * np.exp(-arg) * (2.0 - np.sqrt(2.0) * x)
+    arg = np.minimum(x * x, 200.0)
+    w = np.exp(-arg) * sqrtpm1
+    if ngauss > 0:
+        hd = 0.0
+        hp = np.exp(-arg)
+        ni = 0
+        a = sqrtpm1
+        for i in range(1, ngauss + 1):
+            hd = 2.0 * x * hp - 2.0 * ni * hd
+            ni += 1
+            a = -a / (i * 4.0)
+            hp = 2.0 * x * hd - 2.0 * ni * hp
+            ni += 1
+            w = w + a * hp
+    return w
+
+
+def broaden(energies, eig, weights, sigma, ngauss=0, chunk=4096):
+    """Sum of the broadened delta functions at eig (shape (n,)) with
+    weights (shape (m,n)) on the grid energies, all in eV.
+    Returns an array of shape (m,len(energies))."""
+    out = np.zeros((len(weights), len(energies)))
+    for i in range(0, len(eig), chunk):
+        x = (energies[None, :] - eig[i:i + chunk, None]) / sigma
+        out += np.dot(weights[:, i:i + chunk], w0gauss(x, ngauss))
+    return out / sigma
+
+
+class ProjectedStates:
+    """
+    k-resolved eigenvalues and projection weights of a projwfc.x run,
+    from which the DOS and PDOS can be obtained for any energy grid and
+    broadening without running projwfc.x again (collinear calculations
+    without spin-orbit coupling only).
+    """
+
+    def __init__(self, log, atomicproj):
+        self.states = read_states(log, wfc=True)
+        if any(len(x) != 4 for x in self.states):
+            raise NotImplementedError(
+                'spin-orbit projections cannot be re-broadened')
+        self.wk, self.eig = read_eigenvalues(atomicproj)
+        proj = read_atomic_proj(atomicproj, nproj=len(self.states))
+        self.nspin = len(self.eig)
+        self.weights = np.abs(proj)**2
+
+    def energy_grid(self, Emin=None, Emax=None, DeltaE=None, sigma=0.0):
+        """Absolute energy grid as chosen by projwfc.x."""
+        if Emin is None:
+            Emin = np.min(self.eig) - 3.0 * sigma
+        if Emax is None:
+            Emax = np.max(self.eig) + 3.0 * sigma
+        if DeltaE is None:
+            DeltaE = 0.01
+        ne = int(round((Emax - Emin) / DeltaE))
+        return Emin + DeltaE * np.arange(ne + 1)
+
+    def dos(self, energies, sigma, ngauss=0):
+        """Total DOS for each spin, shape (nspin,len(energies))."""
+        dos = np.empty((self.nspin, len(energies)))
+        for s in range(self.nspin):
+            w = np.repeat(self.wk, self.eig.shape[2])[None, :]
+            dos[s] = broaden(energies, self.eig[s].ravel(), w, sigma,
+                             ngauss)[0]
+        return dos
+
+    def pdos(self, energies, sigma, natoms, ngauss=0,
+             add_higher_channels=True):
+        """PDOS as a PDOSCube laid out like projwfc.x's output files."""
+        ls = sorted(set(x[1] for x in self.states))
+        channels = [c for c in _CHANNELS if _CHANNELS[c] in ls]
+        cube = PDOSCube(natoms, channels, self.nspin, len(energies))
+        # broadened projections onto each state
+        nstates = len(self.states)
+        sdos = np.empty((self.nspin, nstates, len(energies)))
+        for s in range(self.nspin):
+            w = self.weights[s] * self.wk[:, None, None]
+            w = w.transpose(1, 0, 2).reshape(nstates, -1)
+            sdos[s] = broaden(energies, self.eig[s].ravel(), w, sigma,
+                              ngauss)
+        first = {}
+        for i, (iatom, l, m, wfc) in enumerate(self.states):
+            channel = channels[ls.index(l)]
+            c = cube.channelindex[channel]
+            if first.setdefault((iatom, c), wfc) != wfc and \
+                    not add_higher_channels:
+                continue
+            cube.present[iatom, c] = True
+            for s in range(self.nspin):
+                # ldos (sum over m) followed by the m-resolved pdos,
+                # spin channels interleaved
+                cube.data[iatom, c, s] += sdos[s, i]
+                cube.data[iatom, c, self.nspin * m + s] += sdos[s, i]
+        return cube
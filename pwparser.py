@@ -0,0 +1,699 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# single-pass parser for the stdout stream of pw.x
+
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# event types
+SCF_ITERATION = 'scf_iteration'
+SCF_ENERGY = 'scf_energy'
+SCF_STEP = 'scf_step'
+TOTAL_ENERGY = 'total_energy'
+SMEARING = 'smearing'
+EXX = 'exx'
+HUBBARD = 'hubbard'
+END_OF_SCF = 'end_of_scf'
+FORCES = 'forces'
+ASE_FORCES = 'ase_forces'
+ERROR = 'error'
+NOT_CONVERGED = 'not_converged'
+STOPPING = 'stopping'
+EOF = 'eof'
+
+# events after which the log file is flushed
+_FLUSH_EVENTS = frozenset((SCF_ITERATION, TOTAL_ENERGY, FORCES, ASE_FORCES,
+                           ERROR, NOT_CONVERGED, STOPPING, EOF))
+
+# progress events the drain thread may discard if nobody consumes them
+_PROGRESS_EVENTS = frozenset((SCF_ITERATION, SCF_ENERGY, SCF_STEP))
+
+# occupation blocks of DFT+U runs
+_NO_OCC, _INITIAL_OCC, _FINAL_OCC = 0, 1, 2
+
+# times in pw.x's clock report, e.g. 0.13s, 1m 3.45s or 1h23m
+_CLOCK_TIME = re.compile(rb'([0-9.]+)\s*([dhms])')
+_CLOCK_UNITS = {b'd': 86400., b'h': 3600., b'm': 60., b's': 1.}
+
+
+def clocktime(s):
+    """Seconds of a time in pw.x's clock report."""
+    x = _CLOCK_TIME.findall(s)
+    if not x:
+        raise ValueError('no time in %r' % s)
+    return sum(float(t) * _CLOCK_UNITS[u] for t, u in x)
+
+
+class PWEvent:
+    """Event emitted by PWOutputParser: kind is one of the event types
+    defined in this module, value the parsed quantity (if any) and
+    line the (raw) line the event was triggered by. TOTAL_ENERGY and
+    NOT_CONVERGED events also carry the records of the SCF cycle they
+    end in scf."""
+
+    __slots__ = ('kind', 'value', 'line', 'scf')
+
+    def __init__(self, kind, value=None, line=b'', scf=None):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.scf = scf
+
+    def __repr__(self):
+        return 'PWEvent(%r, %r)' % (self.kind, self.value)
+
+
+class PWOutputParser:
+    """Streaming parser for pw.x's stdout.
+
+    Every line passed to feed is appended to the log and classified
+    once by its first token. Lines of interest are turned into PWEvent
+    objects, everything else is only logged. Multi-line blocks (forces,
+    messages) are consumed by the parser itself, which emits a single
+    event once the block is complete.
+    The parsed quantities of the current ionic step are also kept as
+    attributes of the parser (energy, smearing, forces, atom_occ,
+    magmoms, error), so they remain available no matter who consumed
+    the corresponding events. Each SCF iteration of the ionic step
+    is recorded in scf as [iteration, energy, estimated accuracy (both
+    in Ry), seconds since the start of the step] and, once complete,
+    reported by an SCF_STEP event. The ionic steps of relaxations run
+    by pw.x itself start at the end of the previous SCF cycle. The lines of pw.x's clock report are
+    collected in clocks, mapping each routine to its (cumulative) 'cpu'
+    and 'wall' time in seconds, number of 'calls' and 'caller'. If a
+    LogIndex is given, it is kept up to date with the lines written to
+    the log.
+
+    stream is the pipe connected to pw.x's stdout: either a file
+    object, read by next_event, or an asyncio.StreamReader, read by
+    anext_event. File objects are read unbuffered through their file
+    descriptor, so a parser can be registered with a selector (see
+    fileno and read_available) to multiplex several pw.x processes,
+    or drained continuously by a background thread (see start_drain),
+    so pw.x never blocks on a full pipe while nobody is reading.
+    """
+
+    def __init__(self, stream, log, natoms, index=None):
+        self.stream = stream
+        try:
+            self.fd = stream.fileno()
+        except AttributeError:
+            self.fd = None
+        self.buf = b''
+        self.cond = threading.Condition()
+        self.thread = None
+        self.eof = False
+        self.failure = None
+        self.maxqueue = 0
+        self.natoms = natoms
+        self.index = index
+        if index is not None:
+            index.update()
+        self.log = open(log, 'ab')
+        self.events = deque()
+        self.block = None
+        self.occstate = _NO_OCC
+        self.want_exx = False
+        self.energy = None
+        self.smearing = None
+        self.exx = False
+        self.forces = None
+        self.error = None
+        self.clocks = {}
+        self.clockcaller = None
+        self.new_step()
+        self.dispatch = {
+            b'!': (b'!    total energy', self.on_total_energy),
+            b'total': (b'     total energy', self.on_scf_energy),
+            b'iteration': (b'     iteration #', self.on_iteration),
+            b'End': (b'     End of self-consistent calculation',
+                     self.on_end_of_scf),
+            b'convergence': (b'     convergence NOT', self.on_not_converged),
+            b'stopping': (b'     stopping', self.on_stopping),
+            b'smearing': (b'     smearing contrib', self.on_smearing),
+            b'Forces': (b'     Forces acting', self.on_forces),
+            b'!ASE': (b' !ASE', self.on_ase_forces),
+            b'atom': (b'atom ', self.on_atom),
+            b'---': (b' --- exit write_ns ---', self.on_exit_write_ns),
+            b'Called': (b'     Called by', self.on_called),
+            b'estimated': (b'     estimated scf accuracy', self.on_accuracy),
+        }
+
+    def new_step(self):
+        """Forget the Hubbard occupations and magnetic moments
+        of the previous ionic step."""
+        self.atom_occ = {}
+        self.magmoms = np.zeros(self.natoms)
+        # where the output of the step starts in the indexed log
+        self.logoffset = 0 if self.index is None else self.index.offset
+        # when the step started and its first output arrived
+        self.stepstart = time.perf_counter()
+        self.cyclestart = self.stepstart
+        self.firstoutput = None
+        self.scf = []
+
+    def feed(self, line):
+        """Process one line of output (b'' meaning end of output).
+        Returns a PWEvent or None."""
+        if self.firstoutput is None:
+            self.firstoutput = time.perf_counter()
+        if not line:
+            self.block = None
+            ev = PWEvent(EOF)
+        elif self.block is not None:
+            ev = self.block(line)
+        else:
+            self.write(line)
+            ev = self.classify(line)
+        if ev is not None and ev.kind in _FLUSH_EVENTS:
+            self.log.flush()
+        return ev
+
+    def write(self, line):
+        if self.log.closed:
+            # output still drained after close
+            return
+        self.log.write(line)
+        if self.index is not None:
+            self.index.feed(line)
+
+    def classify(self, line):
+        x = line.split(None, 1)
+        if not x:
+            # groups of the clock report are separated by blank lines
+            self.clockcaller = None
+            return None
+        entry = self.dispatch.get(x[0])
+        if entry is not None:
+            if line.startswith(entry[0]):
+                return entry[1](line)
+        elif x[0][:4] == b'%%%%':
+            return self.on_banner(line)
+        elif line.endswith(b'calls)\n') or line.endswith(b'WALL\n'):
+            return self.on_clock(line)
+        if self.want_exx and b'EXX' in line:
+            self.want_exx = False
+            self.exx = True
+            return PWEvent(EXX, None, line)
+        return None
+
+    def fileno(self):
+        return self.fd
+
+    def readline(self):
+        """Read one line from the stream (b'' at its end)."""
+        if self.fd is None:
+            return self.stream.readline()
+        while True:
+            i = self.buf.find(b'\n') + 1
+            if i:
+                line = self.buf[:i]
+                self.buf = self.buf[i:]
+                return line
+            data = os.read(self.fd, 65536)
+            if not data:
+                line = self.buf
+                self.buf = b''
+                return line
+            self.buf += data
+
+    def read_available(self):
+        """Read the data available on the stream with a single read
+        (which blocks only if there is none), parse all complete lines
+        and queue the resulting events for next_event.
+        Returns the list of new events."""
+        new = self.parse_data(os.read(self.fd, 65536))
+        self.events.extend(new)
+        return new
+
+    def parse_data(self, data):
+        """Parse the complete lines of a chunk of data read from the
+        stream (b'' meaning its end) and return the resulting events."""
+        if data:
+            self.buf += data
+            lines = self.buf.split(b'\n')
+            self.buf = lines.pop()
+            lines = [x + b'\n' for x in lines]
+        else:
+            lines = [self.buf, b''] if self.buf else [b'']
+            self.buf = b''
+        new = []
+        for line in lines:
+            ev = self.feed(line)
+            if ev is not None:
+                new.append(ev)
+        return new
+
+    def start_drain(self, maxqueue=1024):
+        """Read and parse the stream in a background thread from now on.
+        Events are queued for next_event; once more than maxqueue events
+        are pending, SCF progress events are discarded."""
+        if self.thread is None and self.fd is not None:
+            self.maxqueue = maxqueue
+            self.thread = threading.Thread(target=self.drainloop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def drainloop(self):
+        failure = None
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                with self.cond:
+                    for ev in self.parse_data(data):
+                        if (ev.kind not in _PROGRESS_EVENTS or
+                                len(self.events) < self.maxqueue):
+                            self.events.append(ev)
+                    self.cond.notify_all()
+                if not data:
+                    return
+        except BaseException as e:
+            failure = e
+        finally:
+            # wake up the reader even if reading or parsing failed,
+            # next_event raises the exception
+            with self.cond:
+                self.failure = failure
+                self.eof = True
+                self.cond.notify_all()
+
+    def next_event(self):
+        """Read from the stream until the next event occurs and return it.
+        At the end of the stream, an EOF event is returned. If the
+        background thread failed, its exception is raised (once)."""
+        if self.thread is not None:
+            with self.cond:
+                while not self.events and not self.eof:
+                    self.cond.wait()
+                if self.events:
+                    return self.events.popleft()
+                if self.failure is not None:
+                    failure, self.failure = self.failure, None
+                    raise failure
+                return PWEvent(EOF)
+        if self.events:
+            return self.events.popleft()
+        while True:
+            ev = self.feed(self.readline())
+            if ev is not None:
+                return ev
+
+    async def anext_event(self):
+        """Coroutine version of next_event for asyncio streams."""
+        if self.events:
+            return self.events.popleft()
+        while True:
+            ev = self.feed(await self.stream.readline())
+            if ev is not None:
+                return ev
+
+    def push_back(self, ev):
+        """Return an event to the parser, so it will be
+        the next one returned by next_event."""
+        with self.cond:
+            self.events.appendleft(ev)
+
+    def wait_for(self, *kinds, skipped=None):
+        """Skip events until one of the given kinds (or EOF) is found
+        and return it. skipped is called with each event skipped."""
+        while True:
+            ev = self.next_event()
+            if ev.kind in kinds or ev.kind == EOF:
+                return ev
+            if skipped is not None:
+                skipped(ev)
+
+    async def await_for(self, *kinds, skipped=None):
+        """Coroutine version of wait_for for asyncio streams."""
+        while True:
+            ev = await self.anext_event()
+            if ev.kind in kinds or ev.kind == EOF:
+                return ev
+            if skipped is not None:
+                skipped(ev)
+
+    def drain(self, skipped=None):
+        """Consume the stream up to its end, calling skipped with each
+        event."""
+        self.wait_for(skipped=skipped)
+
+    async def adrain(self, skipped=None):
+        """Coroutine version of drain for asyncio streams."""
+        await self.await_for(skipped=skipped)
+
+    def flush(self):
+        with self.cond:
+            self.log.flush()
+
+    def close(self):
+        with self.cond:
+            self.log.close()
+
+    def setlog(self, log, index=None, preamble=b''):
+        """Log (and index) to log from now on, e.g. when another
+        calculator takes over the pw.x process. preamble (output of
+        the process written before) is logged first."""
+        with self.cond:
+            self.log.close()
+            self.log = open(log, 'ab')
+            self.index = index
+            if index is not None:
+                index.update()
+            for line in preamble.splitlines(True):
+                self.write(line)
+            self.log.flush()
+
+    # line handlers
+
+    def on_called(self, line):
+        self.clockcaller = line.split()[-1].rstrip(b':').decode()
+        return None
+
+    def on_clock(self, line):
+        name, sep, rest = line.partition(b':')
+        try:
+            cpu, rest = rest.split(b'CPU', 1)
+            wall, rest = rest.split(b'WALL', 1)
+            if b'calls' in rest:
+                calls = int(rest.strip()[1:].split()[0])
+            else:
+                calls = 1
+            self.clocks[name.strip().decode()] = {
+                'cpu': clocktime(cpu), 'wall': clocktime(wall),
+                'calls': calls, 'caller': self.clockcaller}
+        except ValueError:
+            pass
+        return None
+
+    def on_total_energy(self, line):
+        self.energy = float(line.split()[-2])
+        self.smearing = None
+        self.exx = False
+        self.want_exx = True
+        self.occstate = _NO_OCC
+        return PWEvent(TOTAL_ENERGY, self.energy, line, self.endcycle())
+
+    def on_scf_energy(self, line):
+        e = float(line.split()[-2])
+        if self.scf and self.scf[-1][2] is None:
+            self.scf[-1][1] = e
+        return PWEvent(SCF_ENERGY, e, line)
+
+    def on_iteration(self, line):
+        n = int(line.split(b'#')[1].split()[0])
+        if n == 1:
+            self.occstate = _INITIAL_OCC
+            # next ionic step of a relaxation run by pw.x itself
+            self.scf = []
+        self.scf.append([n, None, None,
+                         time.perf_counter() - self.cyclestart])
+        return PWEvent(SCF_ITERATION, n, line)
+
+    def on_accuracy(self, line):
+        # also printed for the converged energy, after the iterations
+        if not self.scf or self.scf[-1][2] is not None:
+            return None
+        try:
+            self.scf[-1][2] = float(line.split()[-2])
+        except ValueError:
+            return None
+        return PWEvent(SCF_STEP, tuple(self.scf[-1]), line)
+
+    def on_end_of_scf(self, line):
+        self.occstate = _FINAL_OCC
+        return PWEvent(END_OF_SCF, None, line)
+
+    def on_not_converged(self, line):
+        return PWEvent(NOT_CONVERGED, None, line, self.endcycle())
+
+    def endcycle(self):
+        """Records of the SCF cycle just ended; the next one (of the
+        next ionic step) is timed from now on."""
+        self.cyclestart = time.perf_counter()
+        return [tuple(x) for x in self.scf]
+
+    def on_stopping(self, line):
+        return PWEvent(STOPPING, None, line)
+
+    def on_smearing(self, line):
+        self.smearing = float(line.split()[-2])
+        self.want_exx = False
+        return PWEvent(SMEARING, self.smearing, line)
+
+    def on_exit_write_ns(self, line):
+        if self.occstate == _INITIAL_OCC:
+            self.occstate = _NO_OCC
+        return None
+
+    def on_atom(self, line):
+        # 'atom    1   Tr[ns(na)] =   1.00000'
+        # 'atom    1   Tr[ns(na)] (up, down, total) =   ...'
+        if self.occstate == _NO_OCC:
+            return None
+        a = line.decode('utf-8')
+        iatom = int(a[8:10]) - 1
+        if a[12:25] == 'Tr[ns(na)] = ':
+            occ = float(a[27:35]) / 2.
+            mag = None
+        elif a[12:42] == 'Tr[ns(na)] (up, down, total) =':
+            up, down, occ = float(a[42:52]), float(a[53:62]), float(a[63:71])
+            mag = up - down
+        else:
+            return None
+        occ_i = self.atom_occ.setdefault(iatom, {})
+        if self.occstate == _INITIAL_OCC:
+            occ_i[0] = occ
+        else:
+            occ_i['ks'] = occ
+            if mag is not None and iatom < self.natoms:
+                self.magmoms[iatom] = mag
+        return PWEvent(HUBBARD, (iatom, occ), line)
+
+    def on_banner(self, line):
+        # error and warning messages are framed by lines of %
+        self.banner_token = line.split(None, 1)[0]
+        self.banner_lines = []
+        self.block = self.in_banner
+        return None
+
+    def on_forces(self, line):
+        # the first natoms 'force' lines after the header are the total forces
+        self.block_line = line
+        self.block_rows = []
+        self.block = self.in_forces
+        return None
+
+    def on_ase_forces(self, line):
+        # positions followed by forces, not written to the log
+        self.block_line = line
+        self.block_rows = []
+        self.block = self.in_ase_forces
+        return None
+
+    # multi-line blocks
+
+    def in_banner(self, line):
+        self.write(line)
+        if line.split(None, 1)[:1] != [self.banner_token]:
+            self.banner_lines.append(line.decode('utf-8'))
+            return None
+        self.block = None
+        msg = ''.join(self.banner_lines).rstrip('\n')
+        if len(msg) == 0 or msg.split('\n', 1)[0].lower().find('error') < 0:
+            return None
+        self.error = msg
+        return PWEvent(ERROR, msg, line)
+
+    def in_forces(self, line):
+        self.write(line)
+        if line.find(b'force') >= 0:
+            self.block_rows.append([float(x) for x in line.split()[-3:]])
+            if len(self.block_rows) == self.natoms:
+                return self.end_forces(FORCES)
+        return None
+
+    def in_ase_forces(self, line):
+        self.block_rows.append(line)
+        if len(self.block_rows) == 2 * self.natoms:
+            self.block_rows = [[float(x) for x in y.split()]
+                               for y in self.block_rows[self.natoms:]]
+            return self.end_forces(ASE_FORCES)
+        return None
+
+    def end_forces(self, kind):
+        self.block = None
+        forces = np.array(self.block_rows, dtype=float).reshape(
+            (self.natoms, 3))
+        self.forces = forces
+        return PWEvent(kind, forces, self.block_line)
+
+
+class LogIndex:
+    """Index of the quantities the calculator queries from its log.
+
+    Lines written by PWOutputParser are fed to the index as they are
+    logged; output that reached the log by other means (e.g. a pw.x run
+    redirected directly to the log, or logs of previous sessions) is
+    picked up by update(), which only scans the bytes beyond the
+    indexed offset. Only the results of the latest pw.x run (i.e. after
+    the last Giannozzi header) are kept, except for the list of SCF
+    iteration counts.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.reset()
+        self.dispatch = {
+            b'P.': self.on_header,
+            b'"P.': self.on_header,
+            b'the': self.on_fermi,
+            b'total': self.on_total,
+            b'absolute': self.on_absolute,
+            b'convergence': self.on_convergence,
+            b'bfgs': self.on_bfgs,
+            b'BEEF-vdW': self.on_beef,
+            b'number': self.on_number,
+        }
+
+    def reset(self):
+        self.offset = 0
+        self.block = None
+        self.header = None
+        self.fermi = None
+        self.stress = None
+        self.totmag = None
+        self.absmag = None
+        self.banner = None
+        self.beef = None
+        self.nkpts = None
+        self.bfgs_steps = None
+        self.scf_steps = []
+
+    def update(self):
+        """Index the part of the log not seen yet."""
+        try:
+            size = os.path.getsize(self.log)
+        except OSError:
+            return
+        if size < self.offset:
+            # log has been replaced
+            self.reset()
+        if size == self.offset:
+            return
+        with open(self.log, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if line[-1:] != b'\n':
+                    # incomplete last line, leave it for the next update
+                    break
+                self.feed(line)
+
+    def feed(self, line):
+        start = self.offset
+        self.offset += len(line)
+        if self.block is not None:
+            try:
+                self.block(line)
+            except (ValueError, IndexError):
+                # not the block layout we expected
+                self.block = None
+            return
+        x = line.split(None, 1)
+        if not x:
+            return
+        handler = self.dispatch.get(x[0])
+        if handler is not None:
+            handler(line, start)
+        elif x[0][:4] == b'%%%%':
+            self.banner_lines = []
+            self.banner_token = x[0]
+            self.banner_offset = start
+            self.block = self.in_banner
+
+    # line handlers
+
+    def on_header(self, line, start):
+        if line.find(b'Giannozzi') < 0:
+            return
+        # a new run starts, forget the results of the previous one
+        self.header = self.offset
+        self.fermi = None
+        self.stress = None
+        self.totmag = None
+        self.absmag = None
+        self.banner = None
+        self.beef = None
+        self.nkpts = None
+        self.bfgs_steps = None
+
+    def on_fermi(self, line, start):
+        if line.find(b'Fermi') < 0:
+            return
+        try:
+            self.fermi = (start, float(line.split()[-2]))
+        except ValueError:
+            pass
+
+    def on_total(self, line, start):
+        if line.startswith(b'     total   stress'):
+            self.stress_rows = []
+            self.stress_offset = start
+            self.block = self.in_stress
+        elif line.startswith(b'     total magnetization'):
+            self.totmag = (start, line.decode('utf-8'))
+
+    def on_absolute(self, line, start):
+        if line.startswith(b'     absolute magnetization'):
+            self.absmag = (start, line.decode('utf-8'))
+
+    def on_convergence(self, line, start):
+        if line.startswith(b'     convergence has been achieved in'):
+            tmp = line.split(b'in')
+            self.scf_steps.append(int(tmp[-1].split(b'iterations')[0]))
+
+    def on_bfgs(self, line, start):
+        if line.startswith(b'     bfgs converged in'):
+            tmp = line.split(b'and')
+            self.bfgs_steps = int(tmp[-1].split(b'bfgs')[0])
+
+    def on_beef(self, line, start):
+        if line.find(b'xc energy contributions') >= 0:
+            self.beef_values = []
+            self.beef_offset = start
+            self.block = self.in_beef
+
+    def on_number(self, line, start):
+        if line.startswith(b'     number of k points='):
+            self.nkpts = int(line.replace(b'=', b' ').split()[4])
+
+    # multi-line blocks
+
+    def in_stress(self, line):
+        self.stress_rows.append([float(x) for x in line.split()[:3]])
+        if len(self.stress_rows) == 3:
+            self.stress = (self.stress_offset, np.array(self.stress_rows))
+            self.block = None
+
+    def in_beef(self, line):
+        self.beef_values.append(float(line.split(b':')[-1]))
+        if len(self.beef_values) == 32:
+            self.beef = (self.beef_offset, np.array(self.beef_values))
+            self.block = None
+
+    def in_banner(self, line):
+        if line.split(None, 1)[:1] == [self.banner_token]:
+            self.banner = (self.banner_offset, ''.join(self.banner_lines))
+            self.block = None
+        else:
+            self.banner_lines.append(line.decode('utf-8'))
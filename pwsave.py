@@ -0,0 +1,158 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# readers for the xml files pw.x writes to the calc.save directory
+
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from ase.units import Rydberg, Hartree
+
+_UNITS = {'hartree': Hartree, 'rydberg': Rydberg, 'ev': 1.0}
+
+
+def textarray(elem):
+    return np.fromstring(elem.text.replace(',', ' '), sep=' ')
+
+
+class Bands:
+    """
+    Kohn-Sham eigenvalues (in eV) and occupations indexed by
+    (spin,k,band) together with the k-point coordinates (in units of
+    2 pi / alat, as given by pw.x) and weights (normalized to 1).
+    Occupations are numbers of electrons per state, i.e. at most 2
+    without and 1 with spin polarization (or non-collinear spins).
+    """
+
+    def __init__(self, eigenvalues, occupations, weights, kpts):
+        self.eigenvalues = eigenvalues
+        self.occupations = occupations
+        self.weights = weights
+        self.kpts = kpts
+
+    def get_band_gap(self):
+        """Smallest gap between fully occupied and empty states (in eV;
+        0 for metals)."""
+        occ = self.occupations > 0.5 * self.occupations.max()
+        homo = np.max(np.where(occ, self.eigenvalues, -np.inf))
+        lumo = np.min(np.where(occ, np.inf, self.eigenvalues))
+        return max(lumo - homo, 0.0)
+
+
+def read_bands(savedir):
+    """Read the eigenvalues, occupations and k-points from savedir,
+    either from data-file-schema.xml (QE >= 6.2) or from data-file.xml
+    and the per-k-point eigenval.xml files of older versions."""
+    schema = os.path.join(savedir, 'data-file-schema.xml')
+    if os.path.exists(schema):
+        return read_schema_bands(schema)
+    return read_legacy_bands(savedir)
+
+
+def read_schema_bands(filename):
+    """Stream the band_structure section of data-file-schema.xml."""
+    lsda = False
+    noncolin = False
+    kpts = []
+    weights = []
+    eig = []
+    occ = []
+    for event, elem in ET.iterparse(filename):
+        tag = elem.tag
+        if tag == 'lsda':
+            lsda = elem.text.strip() == 'true'
+        elif tag == 'noncolin':
+            noncolin = elem.text.strip() == 'true'
+        elif tag == 'ks_energies':
+            k = elem.find('k_point')
+            kpts.append(textarray(k))
+            weights.append(float(k.attrib['weight']))
+            eig.append(textarray(elem.find('eigenvalues')))
+            occ.append(textarray(elem.find('occupations')))
+            elem.clear()
+        elif tag == 'band_structure':
+            break
+    if not eig:
+        raise RuntimeError('no eigenvalues found in ' + filename)
+    nkp = len(eig)
+    eig = np.array(eig) * Hartree
+    occ = np.array(occ)
+    if lsda:
+        # up and down states are stored one after the other
+        nbnd = eig.shape[1] // 2
+        eig = eig.reshape(nkp, 2, nbnd).transpose(1, 0, 2)
+        occ = occ.reshape(nkp, 2, nbnd).transpose(1, 0, 2)
+    else:
+        eig = eig[None]
+        occ = occ[None]
+        if not noncolin:
+            occ = 2.0 * occ
+    weights = np.array(weights)
+    return Bands(np.ascontiguousarray(eig), np.ascontiguousarray(occ),
+                 weights / weights.sum(), np.array(kpts))
+
+
+def read_legacy_bands(savedir):
+    """Read data-file.xml and the eigenval.xml files it links to."""
+    kpts = []
+    weights = []
+    files = [[], []]
+    nspin = 1
+    section = False
+    for event, elem in ET.iterparse(os.path.join(savedir, 'data-file.xml'),
+                                    events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'EIGENVALUES':
+                section = True
+            continue
+        if not section:
+            continue
+        if tag == 'K-POINT_COORDS':
+            kpts.append(textarray(elem))
+        elif tag == 'WEIGHT':
+            weights.append(float(elem.text))
+        elif tag.startswith('DATAFILE'):
+            ispin = 1 if tag == 'DATAFILE.2' else 0
+            nspin = max(nspin, ispin + 1)
+            files[ispin].append(elem.attrib['iotk_link'])
+        elif tag == 'EIGENVALUES':
+            break
+    if not files[0]:
+        raise RuntimeError('no eigenvalues found in ' + savedir)
+    nkp = len(files[0])
+    eig = None
+    for ispin in range(nspin):
+        for ik, name in enumerate(files[ispin]):
+            e, f, unit = read_eigenval(os.path.join(savedir, name))
+            if eig is None:
+                eig = np.empty((nspin, nkp, len(e)))
+                occ = np.empty((nspin, nkp, len(e)))
+            eig[ispin, ik] = e * unit
+            occ[ispin, ik] = f
+    if nspin == 1:
+        occ *= 2.0
+    weights = np.array(weights)
+    return Bands(eig, occ, weights / weights.sum(), np.array(kpts))
+
+
+def read_eigenval(filename):
+    """Eigenvalues, occupations and energy unit of one eigenval.xml."""
+    e = f = None
+    unit = Hartree
+    for event, elem in ET.iterparse(filename):
+        if elem.tag == 'UNITS_FOR_ENERGIES':
+            unit = _UNITS.get(elem.attrib.get('UNITS', '').lower(), Hartree)
+        elif elem.tag == 'EIGENVALUES':
+            e = textarray(elem)
+        elif elem.tag == 'OCCUPATIONS':
+            f = textarray(elem)
+    if f is None:
+        f = np.zeros_like(e)
+    return e, f, unit
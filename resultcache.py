@@ -0,0 +1,188 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# persistent cache of pw.x results keyed by the input and pseudopotentials
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from . import upf
+from .sessionpool import inputkey
+
+# input lines naming directories, which do not affect the results
+_PATH_KEYS = ('pseudo_dir=', 'outdir=', 'wfcdir=')
+
+
+def packarray(a):
+    if a is None:
+        return None
+    return np.ascontiguousarray(a, dtype=np.float64).tobytes()
+
+
+def unpackarray(b, shape):
+    if b is None:
+        return None
+    return np.frombuffer(b, dtype=np.float64).reshape(shape).copy()
+
+
+def packocc(atom_occ):
+    """JSON of the Hubbard occupations {atom: {0: initial,
+    'ks': final}} as parsed by pwparser."""
+    if not atom_occ:
+        return None
+    return json.dumps([[int(i), x.get(0), x.get('ks')]
+                       for i, x in sorted(atom_occ.items())])
+
+
+def unpackocc(s):
+    if s is None:
+        return {}
+    occ = {}
+    for i, initial, ks in json.loads(s):
+        x = occ.setdefault(i, {})
+        if initial is not None:
+            x[0] = initial
+        if ks is not None:
+            x['ks'] = ks
+    return occ
+
+
+class ResultCache:
+    """
+    SQLite database of pw.x results (energy, free energy, forces,
+    stress, magnetic moments, Hubbard occupations) keyed by the SHA-256
+    of the setup (the generated input file without coordinates and
+    directory names, and the checksums of the pseudopotential files
+    used) and the atomic positions.
+
+    directory is created if needed and holds the database file
+    results.db. Once the stored results exceed maxsize bytes, the least
+    recently used entries are evicted. With shared=True (the default),
+    the database is kept in rollback-journal mode, which, unlike WAL,
+    works for many writers on a shared (network) filesystem; writers
+    wait up to timeout seconds for each other's locks. A ResultCache can
+    be shared by calculators in several threads.
+    """
+
+    def __init__(self, directory, maxsize=256 * 1024**2, shared=True,
+                 timeout=600.):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.maxsize = maxsize
+        self.db = sqlite3.connect(os.path.join(directory, 'results.db'),
+                                  timeout=timeout, isolation_level=None,
+                                  check_same_thread=False)
+        self.lock = threading.RLock()
+        if shared:
+            self.db.execute('PRAGMA journal_mode=DELETE')
+        else:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, natoms INTEGER, energy REAL, '
+            'free_energy REAL, forces BLOB, stress BLOB, magmoms BLOB, '
+            'size INTEGER, atime REAL)')
+        columns = [x[1] for x in
+                   self.db.execute('PRAGMA table_info(results)')]
+        if 'atom_occ' not in columns:
+            self.db.execute('ALTER TABLE results ADD COLUMN atom_occ TEXT')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS results_atime ON results (atime)')
+
+    def setupkey(self, inputfile, upffiles):
+        """Hash the input file inputfile (without the coordinates and
+        lines naming directories) and the contents of the
+        pseudopotential files."""
+        extra = []
+        for path in upffiles:
+            extra.append(os.path.basename(path))
+            extra.append(upf.header(path).checksum)
+        return inputkey(inputfile, *extra, skip=_PATH_KEYS)
+
+    def key(self, setupkey, atoms):
+        """Key of the results for the positions of atoms in the setup
+        setupkey."""
+        # adding 0.0 turns -0.0 into 0.0
+        x = np.round(atoms.get_scaled_positions(wrap=False), 12) + 0.0
+        h = hashlib.sha256(setupkey.encode())
+        h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the dictionary of results stored under key or None."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT natoms, energy, free_energy, forces, stress, '
+                'magmoms, atom_occ FROM results WHERE key=?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                self.db.execute('UPDATE results SET atime=? WHERE key=?',
+                                (time.time(), key))
+            except sqlite3.OperationalError:
+                # the access time is only a hint for eviction
+                pass
+        natoms = row[0]
+        return {
+            'energy': row[1],
+            'free_energy': row[2],
+            'forces': unpackarray(row[3], (natoms, 3)),
+            'stress': unpackarray(row[4], (6,)),
+            'magmoms': unpackarray(row[5], (natoms,)),
+            'atom_occ': unpackocc(row[6])
+        }
+
+    def put(self, key, natoms, energy, free_energy, forces=None,
+            stress=None, magmoms=None, atom_occ=None):
+        """Store results under key and evict old entries if needed."""
+        blobs = [packarray(forces), packarray(stress), packarray(magmoms)]
+        occ = packocc(atom_occ)
+        size = len(key) + 64 + sum(len(b) for b in blobs if b is not None)
+        if occ is not None:
+            size += len(occ)
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute(
+                    'INSERT OR REPLACE INTO results (key, natoms, energy, '
+                    'free_energy, forces, stress, magmoms, size, atime, '
+                    'atom_occ) VALUES (?,?,?,?,?,?,?,?,?,?)',
+                    [key, natoms, energy, free_energy] + blobs +
+                    [size, time.time(), occ])
+                total = db.execute('SELECT COALESCE(SUM(size),0) '
+                                   'FROM results').fetchone()[0]
+                if total > self.maxsize:
+                    excess = total - self.maxsize
+                    for k, s in db.execute(
+                            'SELECT key, size FROM results ORDER BY atime'
+                            ).fetchall():
+                        if excess <= 0:
+                            break
+                        db.execute('DELETE FROM results WHERE key=?', (k,))
+                        excess -= s
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM results')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,68 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# detection of SCF cycles which will not converge in time
+
+import numpy as np
+
+# settings of diagnose used by espresso(scfabort=True)
+defaults = {
+    'miniter': 12,  # iterations before the first diagnosis
+    'window': 8,  # iterations the trend is fitted to
+    'minrate': 0.02,  # slowest acceptable decrease (decades/iteration)
+    'maxnoise': 1.0,  # scatter (decades) around the trend for sloshing
+    'margin': 1.0,  # projected iterations tolerated, in electron_maxstep
+}
+
+
+def diagnose(accuracy, conv_thr, maxsteps, miniter=12, window=8,
+             minrate=0.02, maxnoise=1.0, margin=1.0):
+    """
+    Fit a straight line to log10 of the last window estimated SCF
+    accuracies (in Ry) and return why the SCF cycle is not expected to
+    reach conv_thr within margin*maxsteps iterations, or None if it
+    is (or fewer than miniter iterations were done). The cycle is
+    flagged if the accuracy decreases by less than minrate decades per
+    iteration or, extrapolating the trend, needs too many iterations.
+    The reason names charge sloshing if the accuracies scatter by more
+    than maxnoise decades around the trend.
+    A cycle projected to need more than maxsteps iterations fails at
+    electron_maxstep anyway, so margin only saves time if it is at
+    most 1. Smaller margins abort earlier but also catch cycles whose
+    convergence would have sped up later (e.g. once the mixing history
+    builds up), as the projection assumes a constant rate.
+    """
+    n = len(accuracy)
+    window = max(window, 3)
+    if n < max(miniter, window):
+        return None
+    y = np.log10(np.maximum(np.asarray(accuracy[-window:], dtype=float),
+                            1e-300))
+    if not np.all(np.isfinite(y)):
+        return None
+    x = np.arange(n - window, n, dtype=float)
+    slope, intercept = np.polyfit(x, y, 1)
+    noise = np.std(y - (slope * x + intercept))
+    trend = ('%+.3f decades/iteration over the last %d iterations'
+             % (slope, window))
+    if slope > -minrate:
+        if noise > maxnoise:
+            return ('charge sloshing: estimated scf accuracy scatters by '
+                    '%.2f decades without decreasing (%s)' % (noise, trend))
+        if slope > 0:
+            return 'estimated scf accuracy increasing (%s)' % trend
+        return 'estimated scf accuracy stagnating (%s)' % trend
+    needed = n + (np.log10(conv_thr) - (slope * (n - 1) + intercept)) / slope
+    if needed > margin * maxsteps:
+        if noise > maxnoise:
+            kind = 'charge sloshing'
+        else:
+            kind = 'slow convergence'
+        return ('%s: projected to need %d iterations, electron_maxstep is '
+                '%d (%s)' % (kind, needed, maxsteps, trend))
+    return None
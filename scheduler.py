@@ -0,0 +1,163 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# queue of espresso calculations of different sizes sharing the
+# processes of one (batch) allocation
+
+import asyncio
+import multiprocessing
+
+import numpy as np
+
+from espresso import espresso, espsite
+from espresso.utils import runcoroutine
+
+
+class Job:
+    """A queued calculation of atoms on nprocs processes; energy,
+    forces (if requested) and error are filled in when it has run."""
+
+    def __init__(self, atoms, nprocs, forces, kwargs):
+        self.atoms = atoms
+        self.nprocs = nprocs
+        self.wantforces = forces
+        self.kwargs = kwargs
+        self.ranks = None
+        self.calc = None
+        self.energy = None
+        self.forces = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.energy is not None or self.error is not None
+
+
+class Scheduler:
+    """
+    Runs a queue of espresso calculations on slices of the processes
+    procs (by default site.procs in batch jobs, otherwise one entry per
+    cpu of this machine). Each job gets as many processes as asked for
+    when it is submitted. Whenever a job finishes, its processes are
+    returned to the pool and the first queued jobs that fit into the
+    free processes are started right away, so small jobs fill the gaps
+    left by large ones.
+
+    Jobs are launched with the perSpecProcMpiExec command template of
+    espsite.py, which is required in batch jobs and for jobs on more
+    than one process.
+    """
+
+    def __init__(self, procs=None, outdirprefix='job', **kwargs):
+        """kwargs are passed to all espresso calculators (submit can
+        override them per job)."""
+        site = espsite.Config()
+        if procs is None:
+            procs = getattr(site, 'procs', None)
+        if procs is None:
+            if site.batch:
+                raise ValueError('espsite.py does not list the processes '
+                                 '(site.procs) of the batch job')
+            procs = ['localhost'] * multiprocessing.cpu_count()
+        self.perjob = hasattr(site, 'perSpecProcMpiExec')
+        if site.batch and not self.perjob:
+            raise ValueError('running jobs on parts of a batch allocation '
+                             'requires a perSpecProcMpiExec command '
+                             'template in espsite.py')
+        self.procs = sorted(procs)
+        self.outdirprefix = outdirprefix
+        self.arg = kwargs.copy()
+        self.free = list(range(len(self.procs)))
+        self.queue = []
+        self.jobs = []
+
+    def submit(self, atoms, nprocs=1, forces=True, **kwargs):
+        """Queue the calculation of atoms on nprocs processes and
+        return its Job."""
+        if not 0 < nprocs <= len(self.procs):
+            raise ValueError('a job needs between 1 and %d processes, '
+                             'not %d' % (len(self.procs), nprocs))
+        if nprocs > 1 and not self.perjob:
+            raise ValueError('running a job on %d processes requires a '
+                             'perSpecProcMpiExec command template in '
+                             'espsite.py' % nprocs)
+        arg = self.arg.copy()
+        arg.update(kwargs)
+        if 'outdir' not in arg:
+            arg['outdir'] = self.outdirprefix + '_%04d' % len(self.jobs)
+        job = Job(atoms, nprocs, forces, arg)
+        self.queue.append(job)
+        self.jobs.append(job)
+        return job
+
+    def allocate(self, n):
+        """Take n free processes, preferring consecutive entries (those
+        of the same node are adjacent in the sorted procs); returns their
+        indices or None if fewer than n are free."""
+        if n > len(self.free):
+            return None
+        free = np.array(self.free)
+        # smallest window of n free entries in terms of the spread of
+        # the indices it covers
+        spread = free[n - 1:] - free[:len(free) - n + 1]
+        i = int(np.argmin(spread))
+        ranks = self.free[i:i + n]
+        del self.free[i:i + n]
+        return ranks
+
+    def release(self, ranks):
+        self.free = sorted(self.free + ranks)
+
+    def startable(self):
+        """Remove and return the queued jobs that fit into the free
+        processes, in queue order."""
+        started = []
+        for job in list(self.queue):
+            ranks = self.allocate(job.nprocs)
+            if ranks is not None:
+                job.ranks = ranks
+                self.queue.remove(job)
+                started.append(job)
+        return started
+
+    async def runjob(self, job):
+        arg = job.kwargs.copy()
+        arg['single_calculator'] = False
+        arg['procs'] = [self.procs[i] for i in job.ranks]
+        try:
+            job.calc = espresso(**arg)
+            atoms = job.atoms.copy()
+            energy = await job.calc.aget_potential_energy(atoms)
+            if job.wantforces:
+                job.forces = np.array(await job.calc.aget_forces(atoms))
+            job.energy = energy
+        except Exception as e:
+            job.error = e
+        finally:
+            if job.calc is not None:
+                await job.calc.astop()
+
+    async def arun(self):
+        """Run all queued jobs."""
+        running = {}
+        while self.queue or running:
+            for job in self.startable():
+                running[asyncio.ensure_future(self.runjob(job))] = job
+            if not running:
+                break
+            finished, pending = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                self.release(running.pop(task).ranks)
+        return self.jobs
+
+    def run(self):
+        """Run all queued jobs and return the list of all jobs submitted.
+        Failed jobs have their exception in job.error. Coroutines
+        should await arun instead."""
+        return runcoroutine(self.arun())
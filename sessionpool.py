@@ -0,0 +1,186 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# pool of idle ase3-mode pw.x processes, which calculators with the same
+# setup (composition, cell and input parameters) can take over
+
+import atexit
+import hashlib
+import threading
+
+# input lines naming the directory pw.x writes to, which stays with
+# the running process
+_PATH_KEYS = ('outdir=', 'wfcdir=')
+
+# first line of pw.x's output after its setup
+_SCF_START = b'     Self-consistent Calculation'
+
+
+def inputkey(inputfile, *extra, skip=_PATH_KEYS):
+    """Hash of the pw.x input file inputfile without the atomic
+    coordinates and the lines starting with one of skip (by default the
+    output directories), and of the strings extra (e.g. the command
+    line)."""
+    h = hashlib.sha256()
+    positions = False
+    with open(inputfile) as f:
+        for line in f:
+            x = line.split()
+            if positions and len(x) >= 4:
+                try:
+                    for c in x[1:4]:
+                        float(c.replace('d', 'e'))
+                except ValueError:
+                    positions = False
+                else:
+                    # keep the species and constraint flags
+                    line = ' '.join(x[:1] + x[4:]) + '\n'
+            else:
+                positions = False
+            if line.startswith('ATOMIC_POSITIONS'):
+                positions = True
+            if not line.strip().startswith(skip):
+                h.update(line.encode())
+    for s in extra:
+        h.update(b'\0' + str(s).encode())
+    return h.hexdigest()
+
+
+def preamble(log, offset, maxsize=4 * 1024**2):
+    """The setup output (banner, k-points, ...) pw.x wrote to log
+    from offset on, up to its first SCF cycle."""
+    out = []
+    size = 0
+    try:
+        with open(log, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if line.startswith(_SCF_START) or size > maxsize:
+                    break
+                out.append(line)
+                size += len(line)
+    except OSError:
+        pass
+    return b''.join(out)
+
+
+class Session:
+    """An idle ase3-mode pw.x waiting for new positions: its pipes, its
+    output parser, the scratch directory it runs in, the setup part of
+    its output and, if started through asyncio, its process."""
+
+    def __init__(self, key, cinp, cout, parser, scratch, preamble,
+                 aproc=None):
+        self.key = key
+        self.cinp = cinp
+        self.cout = cout
+        self.parser = parser
+        self.scratch = scratch
+        self.preamble = preamble
+        self.aproc = aproc
+
+    def close(self):
+        if self.aproc is not None:
+            # no event loop to drain the output: ask pw.x to quit and
+            # let it go
+            try:
+                self.cinp.write(b'Q')
+                self.cinp.close()
+            except BaseException:
+                pass
+            self.parser.close()
+            return
+        # sending 'Q' to espresso tells it to quit cleanly
+        try:
+            self.cinp.write(b'Q')
+            self.cinp.flush()
+        except IOError:
+            pass
+        self.parser.drain()
+        self.parser.close()
+        for x in (self.cinp, self.cout):
+            try:
+                x.close()
+            except BaseException:
+                pass
+
+
+class SessionPool:
+    """
+    Keeps up to size idle pw.x sessions alive after their calculators
+    stopped them (e.g. for a new cell or composition, or to make room
+    for another single_calculator). A calculator starting pw.x for an
+    input matching a pooled session (apart from the positions) takes it
+    over and only sends it the new positions, which skips the MPI
+    launch, reading the pseudopotentials and the setup of the FFT grids
+    and starts the SCF cycle from the last wave functions of the
+    session. The least recently pooled sessions are stopped first.
+    Idle sessions keep their memory (and, with some MPI libraries,
+    busy-waiting processes).
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def borrow(self, key):
+        """Remove and return the most recently pooled session for key,
+        or None."""
+        with self.lock:
+            for i in range(len(self.sessions) - 1, -1, -1):
+                if self.sessions[i].key == key:
+                    self.hits += 1
+                    return self.sessions.pop(i)
+            self.misses += 1
+        return None
+
+    def release(self, session):
+        """Pool session, stopping the oldest ones beyond size."""
+        with self.lock:
+            self.sessions.append(session)
+            evicted = self.sessions[:max(len(self.sessions) - self.size, 0)]
+            del self.sessions[:len(evicted)]
+        for s in evicted:
+            s.close()
+
+    def discard(self, scratch):
+        """Stop the sessions running in the directory scratch."""
+        with self.lock:
+            gone = [s for s in self.sessions if s.scratch == scratch]
+            self.sessions = [s for s in self.sessions
+                             if s.scratch != scratch]
+        for s in gone:
+            s.close()
+
+    def close(self):
+        """Stop all pooled sessions."""
+        with self.lock:
+            gone = self.sessions
+            self.sessions = []
+        for s in gone:
+            s.close()
+
+
+_shared = None
+
+
+def sharedpool(size):
+    """The pool shared by all calculators of this process, grown to
+    hold at least size sessions."""
+    global _shared
+    if _shared is None:
+        _shared = SessionPool(size)
+        atexit.register(_shared.close)
+    _shared.size = max(_shared.size, size)
+    return _shared
@@ -7,8 +7,74 @@
 #****************************************************************************
 
 # subroutines for creation of subdirectories & clean-up
+# and other file system operations (without spawning shells)
 
+import fnmatch
+import glob
 import os
+import shutil
+import socket
+import tempfile
+from subprocess import call
+
+
+def pernodeexec(site):
+    """Return the command prefix running a command once on each node of
+    a batch job, or None if all processes run on this host (or outside
+    of a batch job), where local file operations suffice."""
+    if not site.batch:
+        return None
+    cmd = getattr(site, 'perHostMpiExec', '')
+    if not cmd:
+        return None
+    procs = getattr(site, 'procs', None)
+    if procs:
+        host = socket.gethostname().split('.')[0]
+        if all(x.split('.')[0] == host for x in procs):
+            return None
+    return cmd
+
+
+def makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+
+
+def copy(src, dst, site=None, cwd=None):
+    """Copy the file src into directory (or to file) dst,
+    on every node of a multi-node batch job if site is given."""
+    pernode = None if site is None else pernodeexec(site)
+    if pernode is None:
+        shutil.copy(src, dst)
+    else:
+        call(pernode + ' cp ' + src + ' ' + dst, shell=True, cwd=cwd)
+
+
+def remove(*patterns):
+    """Remove the files and directories matching the glob patterns,
+    ignoring errors (like rm -rf)."""
+    for pattern in patterns:
+        for x in glob.glob(pattern):
+            if os.path.isdir(x) and not os.path.islink(x):
+                shutil.rmtree(x, ignore_errors=True)
+            else:
+                try:
+                    os.remove(x)
+                except OSError:
+                    pass
+
+
+def find(directory, pattern):
+    """Paths relative to directory of all files below directory whose
+    names match pattern (like find -name)."""
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            if fnmatch.fnmatch(name, pattern):
+                found.append(os.path.relpath(os.path.join(root, name),
+                                             directory))
+    return found
 
 
 def mklocaltmp(odir, site):
@@ -19,54 +85,49 @@ def mklocaltmp(odir, site):
         s = os.getcwd()
         job = ''
     if odir is None or len(odir) == 0:
-        p = os.popen('mktemp -d ' + s + '/qe' + job + '_XXXXX', 'r')
-        tdir = p.readline().strip()
-        p.close()
+        tdir = tempfile.mkdtemp(prefix='qe' + job + '_', dir=s)
     else:
         if odir[0] == '/':
             tdir = odir
         else:
             tdir = s + '/' + odir
-        os.system('mkdir -p ' + tdir)
+        makedirs(tdir)
     return tdir
 
 
 def mkscratch(localtmp, site):
     if site.batch:
-        pernodeexec = site.perHostMpiExec
         job = site.jobid
     else:
-        pernodeexec = ''
         job = ''
-    p = os.popen('mktemp -d ' + site.scratch + '/qe' + job + '_XXXXX', 'r')
-    tdir = p.readline().strip()
-    p.close()
-    if pernodeexec != '':
-        cdir = os.getcwd()
-        os.chdir(localtmp)
-        os.system(pernodeexec + ' mkdir -p ' + tdir)
-        os.chdir(cdir)
+    makedirs(site.scratch)
+    tdir = tempfile.mkdtemp(prefix='qe' + job + '_', dir=site.scratch)
+    pernode = pernodeexec(site)
+    if pernode is not None:
+        call(pernode + ' mkdir -p ' + tdir, shell=True, cwd=localtmp)
     return tdir
 
 
 def cleanup(tmp, scratch, removewf, removesave, calc, site):
     try:
         calc.stop()
+        if getattr(calc, 'sessionpool', None) is not None:
+            # pooled pw.x sessions still running in scratch
+            calc.sessionpool.discard(scratch)
     except BaseException:
         pass
-    if site.batch:
-        pernodeexec = site.perHostMpiExec
-    else:
-        pernodeexec = ''
     if removewf:
-        os.system(
-            'rm -r ' + scratch + '/*.wfc* ' + scratch + '/*.hub* 2>/dev/null')
-    if not removesave:
-        os.system('cp -r ' + scratch + ' ' + tmp)
-    cdir = os.getcwd()
-    os.chdir(tmp)
-    os.system(pernodeexec + ' rm -r ' + scratch + ' 2>/dev/null')
-    os.chdir(cdir)
+        remove(scratch + '/*.wfc*', scratch + '/*.hub*')
+    if not removesave and os.path.isdir(scratch):
+        shutil.copytree(scratch,
+                        os.path.join(tmp, os.path.basename(scratch)),
+                        symlinks=True, dirs_exist_ok=True)
+    pernode = pernodeexec(site)
+    if pernode is None:
+        shutil.rmtree(scratch, ignore_errors=True)
+    else:
+        call(pernode + ' rm -r ' + scratch + ' 2>/dev/null', shell=True,
+             cwd=tmp)
     if hasattr(site,
                'mpdshutdown') and 'QEASE_MPD_ISSHUTDOWN' not in os.environ:
         os.environ['QEASE_MPD_ISSHUTDOWN'] = 'yes'
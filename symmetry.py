@@ -0,0 +1,161 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# symmetry operations of atoms objects and symmetry-reduced
+# finite-displacement force constants
+
+import itertools
+
+import numpy as np
+
+# all 3x3 matrices with entries -1, 0 and 1; every rotation of a lattice
+# in a (reduced) lattice basis is among them
+_CANDIDATES = np.array(list(itertools.product((-1, 0, 1), repeat=9)),
+                       dtype=float).reshape(-1, 3, 3)
+
+
+def lattice_rotations(cell, pbc, symprec=1e-4):
+    """Cartesian rotations mapping the lattice onto itself, which
+    keep each non-periodic direction (up to its sign)."""
+    cell = np.asarray(cell)
+    # R = cell^T W cell^-T acting on cartesian column vectors
+    icell = np.linalg.inv(cell.T)
+    R = np.einsum('ij,njk,kl->nil', cell.T, _CANDIDATES, icell)
+    ok = np.all(np.abs(np.einsum('nij,nkj->nik', R, R) - np.eye(3))
+                < symprec, axis=(1, 2))
+    for k in range(3):
+        if not pbc[k]:
+            other = [i for i in range(3) if i != k]
+            ok &= np.all(_CANDIDATES[:, other, k] == 0, axis=1)
+            ok &= np.all(_CANDIDATES[:, k, other] == 0, axis=1)
+    return R[ok]
+
+
+def operations(atoms, symprec=1e-4):
+    """
+    Symmetry operations of atoms as a list of (R, perm): the cartesian
+    rotation R, combined with a suitable translation, moves atom i onto
+    atom perm[i] (of the same kind). Translations are restricted to the
+    periodic directions and to those mapping the atoms onto each other;
+    for non-periodic systems the lattice of the cell still limits the
+    rotations considered.
+    """
+    pos = atoms.get_positions()
+    numbers = atoms.get_atomic_numbers()
+    pbc = atoms.get_pbc()
+    cell = np.array(atoms.get_cell())
+    # only needed for the periodic directions
+    for k in range(3):
+        if not pbc[k] and np.linalg.norm(cell[k]) < symprec:
+            cell[k] = np.eye(3)[k]
+    icell = np.linalg.inv(cell)
+    same = numbers[:, None] == numbers[None, :]
+    n = len(atoms)
+    ops = []
+    for R in lattice_rotations(cell, pbc, symprec):
+        rpos = pos.dot(R.T)
+        for j0 in np.nonzero(numbers == numbers[0])[0]:
+            t = pos[j0] - rpos[0]
+            d = (rpos + t)[:, None, :] - pos[None, :, :]
+            # wrap the periodic directions
+            f = d.dot(icell)
+            f[..., pbc] -= np.round(f[..., pbc])
+            dist = np.linalg.norm(f.dot(cell), axis=2)
+            match = (dist < symprec) & same
+            if np.all(match.sum(axis=1) == 1):
+                perm = np.argmax(match, axis=1)
+                if len(set(perm)) == n:
+                    ops.append((R, perm))
+                    break
+    return ops
+
+
+def displacementplan(ops, indices, symprec=1e-4):
+    """
+    Choose the displacements needed for the force constants of the
+    atoms indices. Returns a dictionary mapping each representative atom
+    a to its list of (u, need_minus) with the unit vectors u to displace
+    it along (need_minus is False if the displacement along -u follows
+    from that along u by symmetry), and a dictionary mapping every atom
+    in indices to (a, R, perm) with an operation moving a onto it.
+    """
+    plan = {}
+    source = {}
+    for b in indices:
+        if b in source:
+            continue
+        a = b
+        stab = [(R, perm) for R, perm in ops if perm[a] == a]
+        # directions along a, extended by the site symmetry of a until
+        # they span all of space
+        directions = []
+        images = []
+        rank = 0
+        for u in np.eye(3):
+            new = [R.dot(u) for R, perm in stab]
+            r = np.linalg.matrix_rank(np.array(images + new), tol=symprec)
+            if r > rank:
+                images += new
+                rank = r
+                minus = not any(np.allclose(R.dot(u), -u, atol=symprec)
+                                for R, perm in stab)
+                directions.append((u, minus))
+            if rank == 3:
+                break
+        plan[a] = directions
+        for R, perm in ops:
+            c = perm[a]
+            if c in indices and c not in source:
+                source[c] = (a, R, perm)
+    return plan, source
+
+
+def rotateforces(forces, R, perm):
+    """Forces after applying the operation (R, perm)."""
+    out = np.empty_like(forces)
+    out[perm] = forces.dot(R.T)
+    return out
+
+
+def forceconstants(plan, source, ops, forces, deltas, natoms,
+                   symprec=1e-4):
+    """
+    Force constants M[b] (shape (3,natoms,3), M[b][k,j,l] = -dF_jl/du_bk)
+    for every atom b in source. forces[(a, i, sign)] are the forces for
+    the displacement of the representative atom a by sign*deltas[a]
+    along the i-th direction of plan[a]; displacements along -u that
+    were not needed are obtained by symmetry.
+    """
+    M = {}
+    for a, directions in plan.items():
+        stab = [(R, perm) for R, perm in ops if perm[a] == a]
+        vectors = []
+        derivs = []
+        for i, (u, minus) in enumerate(directions):
+            delta = deltas[a]
+            fplus = forces[(a, i, 1)]
+            if minus:
+                fminus = forces[(a, i, -1)]
+            else:
+                for R, perm in stab:
+                    if np.allclose(R.dot(u), -u, atol=symprec):
+                        fminus = rotateforces(fplus, R, perm)
+                        break
+            d = -(fplus - fminus) / (2.0 * delta)
+            for R, perm in stab:
+                vectors.append(R.dot(u))
+                derivs.append(rotateforces(d, R, perm))
+        V = np.array(vectors)
+        D = np.array(derivs).reshape(len(V), -1)
+        M[a] = np.linalg.lstsq(V, D, rcond=None)[0].reshape(3, natoms, 3)
+    out = {}
+    for b, (a, R, perm) in source.items():
+        m = np.empty((3, natoms, 3))
+        m[:, perm, :] = np.einsum('ki,ijm,lm->kjl', R, M[a], R)
+        out[b] = m
+    return out
@@ -0,0 +1,156 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# wall time spent in the phases of calculations (input generation,
+# launching pw.x, waiting for its results, ...)
+
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+
+# reference point of the time stamps in chrome traces
+_T0 = time.perf_counter()
+
+
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL = NullPhase()
+
+
+class Phase:
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timings.add(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Timings:
+    """
+    Record of the wall time of named phases as a list of events
+    (name, start, end, thread, label) with perf_counter times. Events
+    are also added to the Timings parent (if given), e.g. the registry
+    of the whole process. Nested phases are recorded separately, so
+    their times are included in those of the enclosing phases. If not
+    enabled, nothing is recorded.
+    """
+
+    def __init__(self, enabled=True, label='', parent=None):
+        self.enabled = enabled
+        self.label = label
+        self.parent = parent
+        self.events = []
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        """Context manager timing the phase name."""
+        if not self.enabled:
+            return _NULL
+        return Phase(self, name)
+
+    def add(self, name, start, end, thread=None, label=None):
+        if not self.enabled:
+            return
+        if thread is None:
+            thread = threading.get_ident()
+        if label is None:
+            label = self.label
+        with self.lock:
+            self.events.append((name, start, end, thread, label))
+        if self.parent is not None:
+            self.parent.add(name, start, end, thread, label)
+
+    def wrap(self, name, function):
+        """function, timed as phase name when called."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def totals(self):
+        """Dictionary mapping each phase name to its number of
+        occurrences and total time in seconds."""
+        out = {}
+        with self.lock:
+            for name, start, end, thread, label in self.events:
+                x = out.setdefault(name, [0, 0.0])
+                x[0] += 1
+                x[1] += end - start
+        return dict((k, tuple(v)) for k, v in out.items())
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+
+    def __str__(self):
+        lines = ['%-20s %8s %12s' % ('phase', 'count', 'seconds')]
+        for name, (n, t) in sorted(self.totals().items(),
+                                   key=lambda x: -x[1][1]):
+            lines.append('%-20s %8d %12.6f' % (name, n, t))
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, filename):
+        """Write the events as a Chrome trace (JSON), to be viewed in
+        chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for name, start, end, thread, label in events:
+            trace.append({'name': name, 'cat': label or 'espresso',
+                          'ph': 'X', 'pid': pid, 'tid': thread,
+                          'ts': (start - _T0) * 1e6,
+                          'dur': (end - start) * 1e6,
+                          'args': {'calc': label}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+# cumulative timings of all calculators of this process
+registry = Timings()
+
+
+def timed(name):
+    """Decorator timing a method (or coroutine method) as phase name
+    in self.timings."""
+    def decorator(method):
+        if asyncio.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def awrapper(self, *args, **kwargs):
+                timings = getattr(self, 'timings', None)
+                if timings is None or not timings.enabled:
+                    return await method(self, *args, **kwargs)
+                with timings.phase(name):
+                    return await method(self, *args, **kwargs)
+            return awrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            timings = getattr(self, 'timings', None)
+            if timings is None or not timings.enabled:
+                return method(self, *args, **kwargs)
+            with timings.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
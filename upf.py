@@ -0,0 +1,130 @@
+#****************************************************************************
+# Copyright (C) 2013 SUNCAT
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `COPYING'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#****************************************************************************
+
+# metadata of pseudopotential files read from their UPF headers
+
+import hashlib
+import os
+import re
+import threading
+
+from ase.units import Rydberg
+
+# headers read so far, keyed by (path, mtime, size)
+_headers = {}
+_lock = threading.Lock()
+
+_ATTRIBUTE = re.compile(r'([\w.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+_TYPES = {'NC': 'NC', 'SL': 'NC', 'US': 'US', 'USPP': 'US', 'PAW': 'PAW'}
+
+
+def istrue(x):
+    return x.strip().strip('.').upper() in ('T', 'TRUE')
+
+
+class UPFHeader:
+    """
+    Metadata of a pseudopotential file: element, pseudo_type ('NC',
+    'US' or 'PAW'), z_valence and the suggested cutoffs ecutwfc and
+    ecutrho in eV (None if not given). The SHA-256 checksum of the
+    whole file is computed on first access of checksum.
+    """
+
+    def __init__(self, filename, element, pseudo_type, z_valence,
+                 ecutwfc=None, ecutrho=None):
+        self.filename = filename
+        self.element = element
+        self.pseudo_type = pseudo_type
+        self.z_valence = z_valence
+        self.ecutwfc = ecutwfc
+        self.ecutrho = ecutrho
+        self.sha256 = None
+
+    @property
+    def checksum(self):
+        if self.sha256 is None:
+            h = hashlib.sha256()
+            with open(self.filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            self.sha256 = h.hexdigest()
+        return self.sha256
+
+
+def cutoff(x):
+    x = float(x)
+    if x <= 0.0:
+        return None
+    return x * Rydberg
+
+
+def read_header(filename):
+    """Parse the PP_HEADER of the UPF (version 1 or 2) file filename,
+    reading the file only up to the end of the header."""
+    lines = []
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not lines:
+                i = line.find(b'<PP_HEADER')
+                if i < 0:
+                    continue
+                line = line[i + 10:]
+            lines.append(line.decode('utf-8', 'replace'))
+            if line.find(b'/>') >= 0 or line.find(b'</PP_HEADER') >= 0:
+                break
+    if not lines:
+        raise ValueError('no PP_HEADER found in ' + filename)
+    text = ''.join(lines)
+
+    attrs = dict((m.group(1).lower(), m.group(2) if m.group(2) is not None
+                  else m.group(3)) for m in _ATTRIBUTE.finditer(text))
+    if 'z_valence' in attrs:
+        # UPF version 2: header given as attributes
+        if istrue(attrs.get('is_paw', 'F')):
+            ptype = 'PAW'
+        elif istrue(attrs.get('is_ultrasoft', 'F')):
+            ptype = 'US'
+        else:
+            ptype = _TYPES.get(attrs.get('pseudo_type', 'NC').strip().upper(),
+                               'NC')
+        return UPFHeader(filename, attrs.get('element', '').strip(), ptype,
+                         float(attrs['z_valence']),
+                         cutoff(attrs.get('wfc_cutoff', 0)),
+                         cutoff(attrs.get('rho_cutoff', 0)))
+
+    # UPF version 1: one value (followed by a description) per line
+    rows = [x.split() for x in text.split('\n')]
+    rows = [x for x in rows if x and not x[0].startswith('>')]
+    element = rows[1][0]
+    ptype = _TYPES.get(rows[2][0].upper(), 'NC')
+    z_valence = ecutwfc = ecutrho = None
+    for x in rows:
+        label = ' '.join(x).lower()
+        if label.find('z valence') >= 0:
+            z_valence = float(x[0])
+        elif label.find('suggested cutoff') >= 0:
+            ecutwfc = cutoff(x[0])
+            ecutrho = cutoff(x[1])
+    if z_valence is None:
+        raise ValueError('no z_valence found in ' + filename)
+    return UPFHeader(filename, element, ptype, z_valence, ecutwfc, ecutrho)
+
+
+def header(filename):
+    """UPFHeader of filename, cached for the whole process as long as
+    the file's modification time and size do not change."""
+    st = os.stat(filename)
+    key = (filename, st.st_mtime_ns, st.st_size)
+    with _lock:
+        h = _headers.get(key)
+    if h is None:
+        h = read_header(filename)
+        with _lock:
+            _headers[key] = h
+    return h
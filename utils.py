@@ -6,6 +6,9 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 #****************************************************************************
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from ase import constraints
 
@@ -22,6 +25,19 @@ class SpecObject:
         self.U_alpha = U_alpha
 
 
+def runcoroutine(coroutine):
+    """Run coroutine in a new event loop and return its result. If the
+    caller already runs an event loop (e.g. in Jupyter), the new loop
+    runs in another thread, and the caller's loop is blocked until the
+    coroutine is done."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
 # add 'd0' to floating point number to avoid random trailing digits in
 # Fortran input routines
 def num2str(x):
@@ -6,8 +6,15 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 #****************************************************************************
 
+import asyncio
+import os
+import shutil
+import tempfile
+
 from ase.calculators.general import Calculator
 from espresso import espresso
+from espresso import symmetry
+from espresso.utils import runcoroutine
 import numpy as np
 
 
@@ -19,21 +26,40 @@ class vibespresso(Calculator):
     the first calculation to speed up vibrational calculations.
     """
 
-    def __init__(self, outdirprefix='out', **kwargs):
+    def __init__(self, outdirprefix='out', symmetry=False, symprec=1e-4,
+                 **kwargs):
         """
         In addition to the parameters of a standard espresso calculator,
         outdirprefix (default: 'out') can be specified, which will be the
-        prefix of the output of the calculations for different displacements
+        prefix of the output of the calculations for different displacements.
+        With symmetry=True, calculate_displacements only calculates
+        displacements that are inequivalent under the symmetry operations
+        (found with tolerance symprec in Angstrom) of the equilibrium
+        structure and obtains the forces of all others from the force
+        constants rebuilt from them.
         """
 
         self.arg = kwargs.copy()
         self.outdirprefix = outdirprefix
+        self.symmetry = symmetry
+        self.symprec = symprec
         self.counter = 0
         self.equilibriumdensity = outdirprefix + '_equi.tgz'
         self.firststep = True
         self.ready = False
+        # results of calculate_displacements, keyed by positions
+        self.farmresults = {}
+
+    def positionskey(self, atoms):
+        return np.round(atoms.positions, 10).tobytes()
 
     def update(self, atoms):
+        r = self.farmresults.get(self.positionskey(atoms))
+        if r is not None:
+            self.energy_zero, self.energy_free, self.forces = r
+            self.atoms = atoms.copy()
+            self.ready = False
+            return
         if self.atoms is not None:
             x = atoms.positions - self.atoms.positions
             if np.max(x) > 1E-13 or np.min(x) < -1E-13:
@@ -63,16 +89,182 @@ class vibespresso(Calculator):
                 self.esp.stop()
             self.ready = True
 
+        self.energy_zero = self.esp.energy_zero
+        self.energy_free = self.esp.energy_free
+        self.forces = self.esp.forces
+
+    def calculate_displacements(self, images, ncalc=2):
+        """
+        Calculate all displaced structures images (a list of atoms
+        objects or an ase.vibrations.Vibrations object) with ncalc
+        espresso calculators running at the same time. The first image
+        is taken as the equilibrium structure (unless it has been
+        calculated already). In batch jobs, the processes are split
+        among the calculators as for multiespresso (procrange/numcalcs).
+        The equilibrium density is unpacked once and copied to each
+        calculator before each displacement. The results are returned
+        as a list of (energy, forces) and also used by later calls of
+        get_potential_energy/get_forces for these structures (e.g. by
+        Vibrations.run()). With symmetry, the forces (and harmonic
+        energies) of displacements of single atoms are obtained from
+        the force constants of a symmetry-reduced set of displacements.
+        """
+        if hasattr(images, 'iterdisplace'):
+            images = [a for disp, a in images.iterdisplace()]
+        images = list(images)
+        if self.firststep:
+            self.update(images[0])
+            self.farmresults[self.positionskey(images[0])] = (
+                self.energy_zero, self.energy_free, self.forces.copy())
+        todo = images
+        if self.symmetry:
+            self.runjobs(images[:1], ncalc)
+            todo = images[:1] + self.symmetrize_displacements(
+                images[0], images[1:], ncalc)
+        self.runjobs(todo, ncalc)
+        return [self.farmresults[self.positionskey(a)][::2] for a in images]
+
+    def symmetrize_displacements(self, equilibrium, images, ncalc):
+        """Calculate the inequivalent displacements of single atoms in
+        images and store the forces of all of them. Returns the images
+        that could not be treated this way."""
+        eq = equilibrium.positions
+        displaced = []
+        others = []
+        for a in images:
+            d = a.positions - eq
+            moved = np.nonzero(np.abs(d).max(axis=1) > 1e-8)[0]
+            if (len(moved) == 1 and len(a) == len(equilibrium) and
+                    np.allclose(a.cell, equilibrium.cell)):
+                displaced.append((a, moved[0], d[moved[0]]))
+            else:
+                others.append(a)
+        if not displaced:
+            return others
+
+        ops = symmetry.operations(equilibrium, self.symprec)
+        indices = sorted(set(b for a, b, v in displaced))
+        plan, source = symmetry.displacementplan(ops, indices, self.symprec)
+        deltas = {}
+        for a, b, v in displaced:
+            if b in plan and b not in deltas:
+                deltas[b] = np.linalg.norm(v)
+        jobs = {}
+        for b, directions in plan.items():
+            for i, (u, minus) in enumerate(directions):
+                for sign in ((1, -1) if minus else (1,)):
+                    x = equilibrium.copy()
+                    x.positions[b] += sign * deltas[b] * u
+                    jobs[(b, i, sign)] = x
+        self.runjobs(list(jobs.values()), ncalc)
+        forces = dict((k, self.farmresults[self.positionskey(x)][2])
+                      for k, x in jobs.items())
+        M = symmetry.forceconstants(plan, source, ops, forces, deltas,
+                                    len(equilibrium), self.symprec)
+
+        e0, efree0, f0 = self.farmresults[self.positionskey(equilibrium)]
+        for a, b, v in displaced:
+            key = self.positionskey(a)
+            if key in self.farmresults:
+                continue
+            # symmetry images of calculated displacements get the
+            # rotated forces, the others the harmonic ones
+            image = self.displacementimage(equilibrium, b, v, jobs, ops)
+            if image is not None:
+                x, R, perm = image
+                e, efree, f = self.farmresults[self.positionskey(x)]
+                self.farmresults[key] = (e, efree,
+                                         symmetry.rotateforces(f, R, perm))
+                continue
+            # harmonic energy change
+            de = -f0[b].dot(v) + 0.5 * v.dot(M[b][:, b, :]).dot(v)
+            self.farmresults[key] = (e0 + de, efree0 + de,
+                                     f0 - np.einsum('k,kjl->jl', v, M[b]))
+        return others
+
+    def displacementimage(self, equilibrium, b, v, jobs, ops):
+        """The calculated displacement jobs[(a, i, sign)] of equilibrium
+        and the operation (R, perm) mapping it onto the displacement of
+        atom b by v, as (atoms, R, perm), or None."""
+        tol = 1e-3 * np.linalg.norm(v)
+        for (a, i, sign), x in jobs.items():
+            w = x.positions[a] - equilibrium.positions[a]
+            for R, perm in ops:
+                if perm[a] == b and np.allclose(R.dot(w), v, atol=tol):
+                    return x, R, perm
+        return None
+
+    def runjobs(self, images, ncalc):
+        """Calculate the images not calculated yet, starting from the
+        equilibrium density."""
+        runcoroutine(self.arunjobs(images, ncalc))
+
+    async def arunjobs(self, images, ncalc):
+        """Coroutine version of runjobs."""
+        todo = [a for a in images
+                if self.positionskey(a) not in self.farmresults]
+        if todo:
+            ncalc = max(min(ncalc, len(todo)), 1)
+            equidir = tempfile.mkdtemp(
+                prefix=self.outdirprefix + '_equi_',
+                dir=os.path.dirname(self.esp.scratch))
+            try:
+                self.esp.readarchive(self.equilibriumdensity, equidir)
+                await self.runfarm(todo, ncalc, equidir)
+            finally:
+                shutil.rmtree(equidir, ignore_errors=True)
+
+    async def runfarm(self, images, ncalc, equidir):
+        queue = asyncio.Queue()
+        for a in images:
+            queue.put_nowait(a)
+        arg = self.arg.copy()
+        arg['startingpot'] = 'file'
+        arg['single_calculator'] = False
+        arg['numcalcs'] = ncalc
+        calcs = []
+        for i in range(ncalc):
+            arg['outdir'] = self.outdirprefix + '_farm%04d' % i
+            arg['procrange'] = i
+            calcs.append(espresso(**arg))
+
+        async def worker(esp):
+            while not queue.empty():
+                atoms = queue.get_nowait()
+                # every displacement starts from the equilibrium density
+                await esp.astop()
+                shutil.copytree(equidir, esp.scratch, dirs_exist_ok=True)
+                esp.set_atoms(atoms)
+                esp.recalculate = True
+                energy = await esp.aget_potential_energy(atoms)
+                forces = await esp.aget_forces(atoms)
+                self.farmresults[self.positionskey(atoms)] = (
+                    energy, esp.energy_free, np.array(forces))
+
+        tasks = [asyncio.ensure_future(worker(esp)) for esp in calcs]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # the other workers may still be reading from their pw.x,
+            # which astop must not do at the same time
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            for esp in calcs:
+                await esp.astop()
+
     def get_potential_energy(self, atoms, force_consistent=False):
         self.update(atoms)
         if force_consistent:
-            return self.esp.energy_free
+            return self.energy_free
         else:
-            return self.esp.energy_zero
+            return self.energy_zero
 
     def get_forces(self, atoms):
         self.update(atoms)
-        return self.esp.forces
+        return self.forces
 
     def get_name(self):
         return 'VibEspresso'